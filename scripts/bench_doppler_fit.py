@@ -0,0 +1,56 @@
+import numpy as np
+import os, pdb, glob, time, argparse
+from os.path import exists, split, isdir, getsize
+
+# bring functions into scope
+from sdo_clv_pipeline.sdo_io import *
+from sdo_clv_pipeline.sdo_image import *
+
+def get_parser_args():
+    # initialize argparser
+    parser = argparse.ArgumentParser(description="Compare subsampled/robust Dopplergram fits to the full fit")
+    parser.add_argument("--fitsdir", type=str, default="/storage/home/mlp95/scratch/sdo_data/")
+    parser.add_argument("--globexp", type=str, default="")
+    parser.add_argument("--nepochs", type=int, default=1)
+    parser.add_argument("--fractions", type=float, nargs="+", default=[0.5, 0.2, 0.1, 0.05, 0.02, 0.01])
+    parser.add_argument("--n_clip", type=int, nargs="+", default=[0, 2])
+    parser.add_argument("--fit_cbs", action="store_true", default=False)
+    parser.add_argument("--dtype", type=str, default="float64", choices=["float64", "float32"])
+    args = parser.parse_args()
+    return args.fitsdir, args.globexp, args.nepochs, args.fractions, args.n_clip, args.fit_cbs, args.dtype
+
+def run_fit(dop, fit_cbs=False, fit_fraction=1.0, n_clip=0):
+    t0 = time.time()
+    dop.calc_bulk_vel(fit_cbs=fit_cbs, components=("rot",), fit_fraction=fit_fraction, n_clip=n_clip)
+    return time.time() - t0, dop.fit_params.copy(), dop.v_corr.copy(), dop.n_fit
+
+def main():
+    fitsdir, globexp, nepochs, fractions, n_clips, fit_cbs, dtype = get_parser_args()
+    con_files, mag_files, dop_files, aia_files = find_data(fitsdir, globexp=globexp)
+
+    for dop_file in dop_files[:nepochs]:
+        # set up the dopplergram as correct_dopplergram does
+        dop = SDOImage(dop_file, dtype=dtype)
+        dop.calc_geometry()
+        dop.mask_nan = (dop.mu >= 0.1)
+        dop.v_grav = 633
+        dop.calc_spacecraft_vel()
+
+        # the full fit is the reference
+        t_ref, p_ref, v_ref, n_ref = run_fit(dop, fit_cbs=fit_cbs)
+        print(">>> %s: full fit on %s pixels in %.2f s" % (get_date(dop_file).isoformat(), n_ref, t_ref), flush=True)
+        print("%8s %6s %10s %8s %8s %12s %12s %12s" % ("fraction", "n_clip", "n_fit", "time (s)", "speedup",
+                                                        "dp0/p0", "rms dv (m/s)", "max dv (m/s)"))
+
+        for n_clip in n_clips:
+            for fraction in [1.0] + fractions:
+                elapsed, params, v_corr, n_fit = run_fit(dop, fit_cbs=fit_cbs, fit_fraction=fraction, n_clip=n_clip)
+                # change of the leading rotation term and of the fitted velocities
+                dp0 = np.abs(params[0] - p_ref[0]) / np.abs(p_ref[0])
+                dv = np.abs(v_corr - v_ref)
+                print("%8.3f %6d %10d %8.2f %8.2f %12.3e %12.3e %12.3e" % (fraction, n_clip, n_fit, elapsed, t_ref / elapsed,
+                                                                          dp0, np.sqrt(np.nanmean(dv**2)), np.nanmax(dv)), flush=True)
+    return None
+
+if __name__ == "__main__":
+    main()
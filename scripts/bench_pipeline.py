@@ -0,0 +1,182 @@
+import numpy as np
+import os, sys, json, time, shutil, platform, argparse, subprocess, tempfile
+import datetime as dt
+from os.path import exists, isdir
+
+# bring functions into scope
+from sdo_clv_pipeline.paths import root
+from sdo_clv_pipeline.sdo_io import *
+from sdo_clv_pipeline.sdo_process import *
+from sdo_clv_pipeline.sdo_synth import *
+from sdo_clv_pipeline.sdo_pool import WorkerPool
+
+def get_parser_args():
+    # initialize argparser
+    parser = argparse.ArgumentParser(description="Time the pipeline stages on synthetic SDO frames")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 2048, 4096])
+    parser.add_argument("--processes", type=int, nargs="+", default=[1])
+    parser.add_argument("--nepochs", type=int, default=2)
+    parser.add_argument("--workdir", type=str, default=None)
+    parser.add_argument("--output", type=str, default="bench.json")
+    parser.add_argument("--compare", type=str, default=None)
+    parser.add_argument("--rtol", type=float, default=1e-6)
+    parser.add_argument("--geometry_backend", type=str, default="sunpy", choices=["sunpy", "fast"])
+    parser.add_argument("--dtype", type=str, default="float64", choices=["float64", "float32"])
+    parser.add_argument("--ld_method", type=str, default="curve_fit", choices=["linear", "weighted", "curve_fit"])
+    parser.add_argument("--binning", type=int, nargs="+", default=[1], choices=[1, 2, 4, 8])
+    parser.add_argument("--tile_pixels", type=int, default=0)
+    parser.add_argument("--tile_threads", type=int, default=1)
+    args = parser.parse_args()
+    return args
+
+def get_meta(args):
+    # what the numbers were measured with
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=str(root), capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"date": dt.datetime.now().isoformat(), "commit": commit,
+            "python": platform.python_version(), "numpy": np.__version__,
+            "platform": platform.platform(), "cpus": os.cpu_count(),
+            "nepochs": args.nepochs, "geometry_backend": args.geometry_backend,
+            "dtype": args.dtype, "ld_method": args.ld_method,
+            "tile_pixels": args.tile_pixels, "tile_threads": args.tile_threads}
+
+def run_epochs(epochs, processes, binning, outdir, args):
+    # same code path as run_pipe: chunks of epochs, results handed back
+    tile_pixels = args.tile_pixels if (args.tile_pixels > 0) else None
+    options = {"mu_thresh": 0.1, "n_rings": 10, "datadir": outdir,
+               "geometry_backend": args.geometry_backend, "dtype": args.dtype, "prefetch": 1,
+               "ld_method": args.ld_method, "binning": binning,
+               "tile_pixels": tile_pixels, "tile_threads": args.tile_threads}
+    items = [([epoch], options) for epoch in epochs]
+
+    t0 = time.time()
+    if processes == 1:
+        results = [process_epochs_star(item) for item in items]
+    else:
+        with WorkerPool(processes, initializer=init_worker, initargs=(False, None, False)) as pool:
+            results = list(pool.imap_unordered(process_epochs_star, items))
+    wall = time.time() - t0
+
+    # gather the tables of all epochs
+    tables = {"thresholds": [], "region_output": [], "timings": []}
+    statuses = {}
+    for writes, rows in results:
+        for table, table_rows in writes:
+            tables[table].extend(table_rows)
+        for row in rows:
+            statuses[row[0]] = row[1]
+
+    # aggregate the stage timings
+    timings = TimingSummary()
+    timings.write("timings", tables["timings"])
+
+    # science output in a fixed order so runs can be compared (the rows
+    # of an epoch always come back together and in order)
+    thresholds = sorted(([float(v) for v in row] for row in tables["thresholds"]), key=lambda r: r[0])
+    region_output = sorted(([float(v) for v in row] for row in tables["region_output"]), key=lambda r: r[0])
+    run = {"processes": processes, "binning": binning, "wall": wall, "statuses": statuses,
+           "stages": timings.summary(), "thresholds": thresholds,
+           "region_output": region_output}
+    return run, timings
+
+def check_truth(run):
+    # recovered minus injected limb darkening of both instruments
+    if len(run["thresholds"]) == 0:
+        return None
+    arr = np.array(run["thresholds"])
+    cols = threshold_columns
+    return {"b_hmi": float(np.max(np.abs(arr[:, cols.index("b_hmi")] - synth_params["ld_con"][0]))),
+            "c_hmi": float(np.max(np.abs(arr[:, cols.index("c_hmi")] - synth_params["ld_con"][1]))),
+            "b_aia": float(np.max(np.abs(arr[:, cols.index("b_aia")] - synth_params["ld_aia"][0]))),
+            "c_aia": float(np.max(np.abs(arr[:, cols.index("c_aia")] - synth_params["ld_aia"][1])))}
+
+def max_rel_diff(new, old):
+    # largest relative difference of two tables, nans must match
+    new = np.array(new, dtype=float)
+    old = np.array(old, dtype=float)
+    if new.shape != old.shape:
+        return np.inf
+    if np.any(np.isnan(new) != np.isnan(old)):
+        return np.inf
+    good = ~np.isnan(old)
+    if not np.any(good):
+        return 0.0
+    scale = np.maximum(np.abs(old[good]), 1e-12)
+    return float(np.max(np.abs(new[good] - old[good]) / scale))
+
+def compare_runs(runs, fname, rtol):
+    # compare science output and stage timings to an earlier benchmark
+    with open(fname, "r") as f:
+        old_runs = {(r["size"], r["processes"], r.get("binning", 1)): r for r in json.load(f)["runs"]}
+
+    ok = True
+    for run in runs:
+        old = old_runs.get((run["size"], run["processes"], run["binning"]))
+        if old is None:
+            continue
+
+        print(">>> %d x %d binned %dx on %d processes:" % (run["size"], run["size"], run["binning"], run["processes"]), flush=True)
+        for table in ("thresholds", "region_output"):
+            diff = max_rel_diff(run[table], old[table])
+            ok &= diff <= rtol
+            print("\t >>> %s max rel. diff %.3e (%s)" % (table, diff, "ok" if diff <= rtol else "MISMATCH"), flush=True)
+
+        for stage, s in run["stages"].items():
+            if stage in old["stages"]:
+                t_new = s["wall"] / s["count"]
+                t_old = old["stages"][stage]["wall"] / old["stages"][stage]["count"]
+                print("\t >>> %-16s %8.3f s -> %8.3f s (x %.2f)" % (stage, t_old, t_new, t_old / max(t_new, 1e-9)), flush=True)
+    return ok
+
+def main():
+    args = get_parser_args()
+
+    # synthetic data goes in a scratch directory unless told otherwise
+    workdir = args.workdir
+    cleanup = workdir is None
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="sdo_bench_")
+    workdir = os.path.join(workdir, "")
+
+    runs = []
+    try:
+        for n in args.sizes:
+            # make the frames once per size, reusing any already there
+            fitsdir = workdir + "fits_%d/" % n
+            if isdir(fitsdir) and (len(os.listdir(fitsdir)) == 4 * args.nepochs):
+                epochs = list(zip(*find_data(fitsdir)))
+            else:
+                t0 = time.time()
+                epochs = write_synth_data(fitsdir, n=n, n_epochs=args.nepochs)
+                print(">>> Wrote %d synthetic %d x %d epochs in %.2f s" % (args.nepochs, n, n, time.time() - t0), flush=True)
+
+            for binning in args.binning:
+                for processes in args.processes:
+                    print(">>> Running %d x %d binned %dx on %d processes..." % (n, n, binning, processes), flush=True)
+                    outdir = workdir + "out_%d_%d_%d/" % (n, binning, processes)
+                    run, timings = run_epochs(epochs, processes, binning, outdir, args)
+                    run["size"] = n
+                    run["truth"] = check_truth(run)
+                    runs.append(run)
+
+                    # per-stage summary of the run
+                    print(">>> %d x %d binned %dx on %d processes: %.2f s" % (n, n, binning, processes, run["wall"]), flush=True)
+                    timings.report()
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    # save everything for later comparisons
+    with open(args.output, "w") as f:
+        json.dump({"meta": get_meta(args), "params": synth_params, "runs": runs}, f, indent=1)
+    print(">>> Wrote " + args.output, flush=True)
+
+    if (args.compare is not None) and not compare_runs(runs, args.compare, args.rtol):
+        sys.exit(1)
+    return None
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 import numpy as np
 import pandas as pd
-import os, pdb, glob, time, argparse
+import os, pdb, glob, time, shutil, argparse
 from os.path import exists, split, isdir, getsize
 
 # bring functions into scope
@@ -27,13 +27,8 @@ def main():
     fname2 = datadir + "region_output.csv"
 
     # headers for output files
-    header1 = ["mjd", "aia_thresh", "a_aia", "b_aia", "c_aia",
-               "hmi_thresh1", "hmi_thresh2", "a_hmi", "b_hmi", "c_hmi",
-               "vel_cbs_off",
-               "min_vel_sat", "max_vel_sat", "avg_vel_sat",
-               "min_vel_rot", "max_vel_rot", "avg_vel_rot",
-               "min_vel_mer", "max_vel_mer", "avg_vel_mer"]
-    header2 = ["mjd", "region", "lo_mu", "hi_mu", "pixel_frac", "light_frac", "v_hat", "v_phot", "v_quiet", "v_conv", "mag_unsigned", "avg_int", "avg_int_flat"]
+    header1 = threshold_columns
+    header2 = region_columns
 
     # delete old files if they exists
     fileset = (fname1, fname2)
@@ -56,6 +51,19 @@ def main():
             data = pd.read_csv(f)
             data.to_csv(file, mode="a", index=False, header=False)
 
+    # copy the columnar output of each directory and compact it
+    for table in result_columns.keys():
+        parts = glob.glob(datadir + "*/" + table + ".parquet/part_*.parquet")
+        if len(parts) == 0:
+            continue
+
+        outdir = datadir + table + ".parquet/"
+        os.makedirs(outdir, exist_ok=True)
+        for part in parts:
+            subdir = split(split(split(part)[0])[0])[1]
+            shutil.copy(part, outdir + "part_" + subdir + "_" + split(part)[1][5:])
+        compact_parquet(datadir, table)
+
     return None
 
 
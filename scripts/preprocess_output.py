@@ -7,6 +7,7 @@ import os, sys, pdb, csv, glob
 import pandas as pd
 
 from sdo_clv_pipeline.paths import root
+from sdo_clv_pipeline.sdo_io import read_results, has_parquet_output, filter_frame
 
 def mask_all_zero_rows(df, return_idx=False):
     idx = (df.v_hat == 0.0) & (df.v_phot == 0.0) & (df.v_conv == 0.0) & (df.v_quiet == 0.0)
@@ -63,14 +64,28 @@ if not os.path.isdir(datadir + "processed/"):
 
 outdir = datadir + "processed/"
 
-# read in and sort by mjd
-df_all = pd.read_csv(datadir + "region_output.csv")
-df_all.sort_values(by=["mjd", "region", "lo_mu"], inplace=True)
-df_all.drop_duplicates()
-df_all.reset_index(drop=True, inplace=True)
+# the parquet reader only reads the wanted rows of each region, but the
+# csv has to be parsed in full, so do that once and filter it in memory
+if has_parquet_output(datadir, "region_output"):
+    df_all = None
+else:
+    df_all = read_results(datadir, "region_output")
+
+def read_region(filters):
+    # get only the wanted rows and sort by mjd
+    if df_all is None:
+        df = read_results(datadir, "region_output", filters=filters)
+    else:
+        df = filter_frame(df_all, filters).copy()
+    df.sort_values(by=["mjd", "region", "lo_mu"], inplace=True)
+    df = df.drop_duplicates()
+    df.reset_index(drop=True, inplace=True)
+    return df
 
 # get full disk only
-df_full_disk = df_all[(np.isnan(df_all.lo_mu)) & np.isnan(df_all.region)]
+regions = [1.0, 2.0, 2.5, 3.0, 4.0, 5.0, 6.0]
+df_full_disk = read_region([("region", "not in", regions)])
+df_full_disk = df_full_disk[(np.isnan(df_full_disk.lo_mu)) & np.isnan(df_full_disk.region)]
 df_full_disk.reset_index(drop=True, inplace=True)
 df_full_disk.to_csv(outdir + "full_disk.csv", index=False)
 # full_disk_daily = daily_bin(df_full_disk)
@@ -87,13 +102,13 @@ idx = dist[dist > 2.0 * v_conv_rolling_std].index
 """
 
 # make dfs by mu
-plage = df_all[df_all.region == 6.0]
-network = df_all[df_all.region == 5.0]
-quiet_sun = df_all[df_all.region == 4.0]
-red_penumbrae = df_all[df_all.region == 3.0]
-all_penumbrae = df_all[df_all.region == 2.5]
-blu_penumbrae = df_all[df_all.region == 2.0]
-umbrae = df_all[df_all.region == 1.0]
+plage = read_region([("region", "==", 6.0)])
+network = read_region([("region", "==", 5.0)])
+quiet_sun = read_region([("region", "==", 4.0)])
+red_penumbrae = read_region([("region", "==", 3.0)])
+all_penumbrae = read_region([("region", "==", 2.5)])
+blu_penumbrae = read_region([("region", "==", 2.0)])
+umbrae = read_region([("region", "==", 1.0)])
 
 # mask rows where all vels are 0.0 (i.e., region isn't present in that annulus)
 plage = mask_all_zero_rows(plage)
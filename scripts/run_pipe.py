@@ -7,6 +7,7 @@ from os.path import exists, split, isdir, getsize
 from sdo_clv_pipeline.paths import root
 from sdo_clv_pipeline.sdo_io import *
 from sdo_clv_pipeline.sdo_process import *
+from sdo_clv_pipeline.sdo_pool import WorkerPool
 
 # multiprocessing imports
 from multiprocessing import get_context
@@ -21,13 +22,39 @@ def get_parser_args():
     parser.add_argument("--fitsdir",type=str, default="/storage/home/mlp95/scratch/sdo_data/")
     parser.add_argument("--clobber", action="store_true", default=False)
     parser.add_argument("--globexp", type=str, default="")
+    parser.add_argument("--geomcache", action="store_true", default=False)
+    parser.add_argument("--cachedir", type=str, default=None)
+    parser.add_argument("--reprojcache", action="store_true", default=False)
+    parser.add_argument("--geometry_backend", type=str, default="sunpy", choices=["sunpy", "fast"])
+    parser.add_argument("--dtype", type=str, default="float64", choices=["float64", "float32"])
+    parser.add_argument("--index", action="store_true", default=False)
+    parser.add_argument("--indexfile", type=str, default=None)
+    parser.add_argument("--qualitycheck", action="store_true", default=False)
+    parser.add_argument("--prefetch", type=int, default=1)
+    parser.add_argument("--parquet", action="store_true", default=False)
+    parser.add_argument("--ledger", action="store_true", default=False)
+    parser.add_argument("--retry_failed", action="store_true", default=False)
+    parser.add_argument("--persistent", action="store_true", default=False)
+    parser.add_argument("--max_rss", type=float, default=6.0)
+    parser.add_argument("--ld_method", type=str, default="curve_fit", choices=["linear", "weighted", "curve_fit"])
+    parser.add_argument("--binning", type=int, default=1, choices=[1, 2, 4, 8])
+    parser.add_argument("--batch", action="store_true", default=False)
+    parser.add_argument("--batch_tol", type=float, default=1.0,
+                        help="with --batch, reuse the geometry, reprojection and bulk velocity design of "
+                             "an epoch for headers (incl. B0) within this multiple of the geometry cache "
+                             "tolerances, i.e. accept that approximation")
+    parser.add_argument("--tile_pixels", type=int, default=0)
+    parser.add_argument("--tile_threads", type=int, default=1)
 
     # parse the command line arguments
     args = parser.parse_args()
-    fitsdir = args.fitsdir
-    clobber = args.clobber
-    globexp = args.globexp
-    return fitsdir, clobber, globexp
+    if (args.tile_pixels > 0) and args.batch:
+        parser.error("--batch shares whole-image geometry between epochs and cannot be used with --tile_pixels")
+
+    # options that are off are None
+    args.batch_tol = args.batch_tol if args.batch else None
+    args.tile_pixels = args.tile_pixels if (args.tile_pixels > 0) else None
+    return args
 
 def main():
     # make raw data dir if it does not exist
@@ -35,15 +62,18 @@ def main():
         os.mkdir(str(root / "data") + "/")
 
     # sort out input/output data files
-    fitsdir, clobber, globexp = get_parser_args()
-    globdir = globexp.replace("*","")
-    files = organize_IO(fitsdir, clobber=clobber, globexp=globexp)
-    con_files, mag_files, dop_files, aia_files = files
+    args = get_parser_args()
+    globdir = args.globexp.replace("*","")
 
-    # get output datadir
+    # get output datadir (binned quick looks are kept apart)
     datadir = str(root / "data") + "/" + globdir + "/"
-    if not isdir(datadir):
-        os.mkdir(datadir)
+    if args.binning > 1:
+        datadir = str(root / "data") + "/" + globdir + "_bin%d/" % args.binning
+
+    files = organize_IO(args.fitsdir, datadir=datadir, clobber=args.clobber, globexp=args.globexp,
+                        use_index=args.index, index_file=args.indexfile, quality_check=args.qualitycheck,
+                        use_ledger=args.ledger, retry_failed=args.retry_failed)
+    con_files, mag_files, dop_files, aia_files = files
 
     # set mu threshold, number of mu rings
     n_rings = 10
@@ -61,36 +91,42 @@ def main():
 
     # process the data either in parallel or serially
     if ncpus > 1:
-        # make tmp directory
-        tmpdir = datadir + "tmp/"
-        if not isdir(tmpdir):
-            os.mkdir(tmpdir)
-
-        # prepare arguments for starmap
-        items = []
-        for i in range(len(con_files)):
-            items.append((con_files[i], mag_files[i], dop_files[i], aia_files[i], mu_thresh, n_rings, datadir))
+        # prepare arguments for the pool (chunks of epochs, so each worker
+        # can prefetch the next epoch of its chunk; in batch mode a chunk is
+        # a day of epochs sharing their geometry)
+        epochs = list(zip(con_files, mag_files, dop_files, aia_files))
+        chunks = group_epochs(epochs) if (args.batch_tol is not None) else group_epochs(epochs, group_by=4)
+        options = {"mu_thresh": mu_thresh, "n_rings": n_rings, "datadir": datadir,
+                   "geom_cache": args.geomcache, "cachedir": args.cachedir,
+                   "geometry_backend": args.geometry_backend, "dtype": args.dtype,
+                   "prefetch": args.prefetch, "reproj_cache": args.reprojcache,
+                   "ld_method": args.ld_method, "binning": args.binning, "batch_tol": args.batch_tol,
+                   "tile_pixels": args.tile_pixels, "tile_threads": args.tile_threads}
+        items = [(chunk, options) for chunk in chunks]
+
+        # the main process owns the output files and the ledger
+        timings = TimingSummary()
+        sink = MultiSink(get_result_sink(get_output_files(datadir), datadir, parquet=args.parquet), timings)
+        epoch_ledger = EpochLedger(get_ledger_file(datadir)) if args.ledger else None
 
         # run in parellel
         print(">>> Processing %s epochs with %s processes..." % (len(con_files), ncpus))
         t0 = time.time()
-        pids = []
-        with get_context("spawn").Pool(ncpus, maxtasksperchild=4) as pool:
-            # get PIDs of workers
-            for child in mp.active_children():
-                pids.append(child.pid)
-
-            # run the analysis
-            pool.starmap(process_data_set_parallel, items, chunksize=4)
-
-        # find the output data sets
-        outfiles1 = glob.glob(tmpdir + "thresholds_*")
-        outfiles2 = glob.glob(tmpdir + "region_output_*")
-
-        # stitch them together on the main process
-        delete = False
-        stitch_output_files(datadir + "thresholds.csv", outfiles1, delete=delete)
-        stitch_output_files(datadir + "region_output.csv", outfiles2, delete=delete)
+        initargs = (args.geomcache, args.cachedir, args.reprojcache, args.dtype)
+        if args.persistent:
+            # long-lived workers, recycled above max_rss GB of memory
+            pool = WorkerPool(ncpus, initializer=init_worker, initargs=initargs,
+                              max_rss=args.max_rss * 1e9)
+        else:
+            pool = get_context("spawn").Pool(ncpus, initializer=init_worker,
+                                             initargs=initargs, maxtasksperchild=4)
+
+        with sink, pool:
+            # run the analysis, writing results as each chunk comes back
+            for writes, rows in pool.imap_unordered(process_epochs_star, items):
+                commit_records(sink, writes, ledger=epoch_ledger, rows=rows)
+                for row in rows:
+                    print(">>> %s %s in %.2f s" % (row[0], row[1], row[3]), flush=True)
 
         # print run time
         print("Parallel: --- %s seconds ---" % (time.time() - t0))
@@ -98,12 +134,55 @@ def main():
         # run serially
         print(">>> Processing %s epochs on a single process" % len(con_files))
         t0 = time.time()
-        for i in range(len(con_files)):
-            process_data_set(con_files[i], mag_files[i], dop_files[i], aia_files[i],
-                             mu_thresh=mu_thresh, n_rings=n_rings, datadir=datadir)
+        geom_cache = GeometryCache(cachedir=args.cachedir, dtype=args.dtype) if args.geomcache else None
+        reproj_cache = ReprojectionCache(cachedir=args.cachedir, dtype=args.dtype) if args.reprojcache else None
+        epochs = zip(con_files, mag_files, dop_files, aia_files)
+        timings = TimingSummary()
+        sink = MultiSink(get_result_sink(get_output_files(datadir), datadir, parquet=args.parquet), timings)
+        epoch_ledger = EpochLedger(get_ledger_file(datadir)) if args.ledger else None
+        if args.tile_pixels is not None:
+            # an epoch at a time, worked through in tiles of rows
+            with sink:
+                for con_file, mag_file, dop_file, aia_file in epochs:
+                    process_data_set_tiled(con_file, mag_file, dop_file, aia_file,
+                                           mu_thresh=mu_thresh, n_rings=n_rings, datadir=datadir,
+                                           geometry_backend=args.geometry_backend, dtype=args.dtype,
+                                           sink=sink, ledger=epoch_ledger, ld_method=args.ld_method,
+                                           binning=args.binning, tile_pixels=args.tile_pixels,
+                                           threads=args.tile_threads)
+        elif args.batch_tol is not None:
+            # a day of epochs at a time, sharing their geometry
+            with sink:
+                for chunk in group_epochs(list(epochs)):
+                    process_batch(chunk, mu_thresh, n_rings, datadir, batch_tol=args.batch_tol,
+                                  geometry_backend=args.geometry_backend, dtype=args.dtype,
+                                  prefetch=args.prefetch, sink=sink, ledger=epoch_ledger,
+                                  ld_method=args.ld_method, binning=args.binning)
+        else:
+            with sink, EpochPrefetcher(epochs, dtype=args.dtype, depth=args.prefetch) as prefetcher:
+                for con_file, mag_file, dop_file, aia_file in prefetcher:
+                    process_data_set(con_file, mag_file, dop_file, aia_file,
+                                     mu_thresh=mu_thresh, n_rings=n_rings, datadir=datadir,
+                                     geom_cache=geom_cache, geometry_backend=args.geometry_backend,
+                                     dtype=args.dtype, sink=sink, ledger=epoch_ledger,
+                                     reproj_cache=reproj_cache, ld_method=args.ld_method,
+                                     binning=args.binning)
 
         # print run time
         print("Serial: --- %s seconds ---" % (time.time() - t0))
+
+    # report where the time of this run went
+    timings.report()
+
+    # report the outcome of all epochs run so far
+    if args.ledger:
+        for status, (count, elapsed) in EpochLedger(get_ledger_file(datadir)).summary().items():
+            print(">>> %s: %s epochs, %.1f s" % (status, count, elapsed), flush=True)
+
+    # merge the columnar part files into sorted files with large row groups
+    if args.parquet:
+        compact_parquet(datadir, "thresholds")
+        compact_parquet(datadir, "region_output")
     return None
 
 if __name__ == "__main__":
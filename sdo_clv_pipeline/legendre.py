@@ -4,41 +4,109 @@
 
 import numpy as np
 from math import pi
-from pyshtools import legendre as pleg
+from numpy.polynomial.legendre import legder, leg2poly
 
 def get_pleg_index(l, m):
     return int(l*(l+1)/2 + m)
 
 
-def gen_leg(lmax, theta):
-    cost = np.cos(theta)
-    sint = np.sin(theta).reshape(1, theta.shape[0])
+def gen_chunks(npts, chunk_size=None):
+    # yield slices that cover npts elements in blocks of chunk_size
+    if (chunk_size is None) or (chunk_size >= npts):
+        yield slice(0, npts)
+        return None
 
+    for start in range(0, npts, chunk_size):
+        yield slice(start, min(start + chunk_size, npts))
+    return None
+
+
+def plbar_d1(lmax, z, out=None, out_d1=None):
+    # 4pi-normalized legendre polynomials and first derivatives w.r.t. z,
+    # i.e., the same quantities as pyshtools.legendre.PlBar_d1 but
+    # evaluated over the full array z at once via upward recurrence
+    maxIndex = int(lmax+1)
+    if out is None:
+        out = np.empty((maxIndex, z.size), dtype=z.dtype)
+    if out_d1 is None:
+        out_d1 = np.empty((maxIndex, z.size), dtype=z.dtype)
+
+    # unnormalized P_l(z) and P'_l(z)
+    out[0] = 1.0
+    out_d1[0] = 0.0
+    if lmax > 0:
+        out[1] = z
+        out_d1[1] = 1.0
+    for l in range(2, maxIndex):
+        out[l] = ((2*l - 1) * z * out[l-1] - (l - 1) * out[l-2]) / l
+        out_d1[l] = out_d1[l-2] + (2*l - 1) * out[l-1]
+
+    # apply 4pi normalization
+    for l in range(1, maxIndex):
+        out[l] *= np.sqrt(2*l + 1)
+        out_d1[l] *= np.sqrt(2*l + 1)
+    return out, out_d1
+
+
+def gen_leg(lmax, theta, dtype=np.float64, chunk_size=None):
     maxIndex = int(lmax+1)
     ell = np.arange(maxIndex)
     norm = np.sqrt(ell*(ell+1)).reshape(maxIndex, 1)
     norm[norm == 0] = 1
+    norm = (np.sqrt(2) * norm).astype(dtype)
+
+    leg = np.empty((maxIndex, theta.size), dtype=dtype)
+    leg_d1 = np.empty((maxIndex, theta.size), dtype=dtype)
 
-    leg = np.zeros((maxIndex, theta.size))
-    leg_d1 = np.zeros((maxIndex, theta.size))
+    # evaluate in chunks to bound the size of temporaries
+    for sl in gen_chunks(theta.size, chunk_size=chunk_size):
+        cost = np.asarray(np.cos(theta[sl]), dtype=dtype)
+        sint = np.asarray(np.sin(theta[sl]), dtype=dtype)
+        plbar_d1(lmax, cost, out=leg[:, sl], out_d1=leg_d1[:, sl])
+        leg_d1[:, sl] *= -sint
 
-    for i,z in enumerate(cost):
-        leg[:, i], leg_d1[:, i] = pleg.PlBar_d1(lmax, z)
-    return leg/np.sqrt(2)/norm, leg_d1 * (-sint)/np.sqrt(2)/norm
+    leg /= norm
+    leg_d1 /= norm
+    return leg, leg_d1
 
 
-def gen_leg_x(lmax, x):
+def gen_leg_x(lmax, x, dtype=np.float64, chunk_size=None):
+    x = np.asarray(x, dtype=dtype)
+
     maxIndex = int(lmax+1)
     ell = np.arange(maxIndex)
     norm = np.sqrt(ell*(ell+1)).reshape(maxIndex, 1)
     norm[norm == 0] = 1
+    norm = (np.sqrt(2) * norm).astype(dtype)
+
+    leg = np.empty((maxIndex, x.size), dtype=dtype)
+    leg_d1 = np.empty((maxIndex, x.size), dtype=dtype)
+
+    # evaluate in chunks to bound the size of temporaries
+    for sl in gen_chunks(x.size, chunk_size=chunk_size):
+        plbar_d1(lmax, x[sl], out=leg[:, sl], out_d1=leg_d1[:, sl])
+
+    leg /= norm
+    leg_d1 /= norm
+    return leg, leg_d1
+
+
+def leg_norm(lmax):
+    # factor that takes P_l to the normalization used by gen_leg/gen_leg_x
+    ell = np.arange(lmax+1)
+    norm = np.sqrt(ell*(ell+1))
+    norm[norm == 0] = 1
+    return np.sqrt(2*ell + 1) / (np.sqrt(2) * norm)
 
-    leg = np.zeros((maxIndex, x.size))
-    leg_d1 = np.zeros((maxIndex, x.size))
 
-    for i,z in enumerate(x):
-        leg[:, i], leg_d1[:, i] = pleg.PlBar_d1(lmax, z)
-    return leg/np.sqrt(2)/norm, leg_d1/np.sqrt(2)/norm
+def leg_series(weights, deriv=False):
+    # power series coefficients of sum_l weights[l] * leg[l](z) (or of its
+    # derivative in z), so a fitted combination can be evaluated by Horner
+    # instead of the recurrence over every l
+    c = np.asarray(weights, dtype=np.float64) * leg_norm(len(weights) - 1)
+    if deriv:
+        c = legder(c)
+    return leg2poly(c)
 
 
 def inv_SVD(A, svdlim):
@@ -1,5 +1,132 @@
+import numpy as np
+
+# ways of fitting the limb darkening law to the ring profile
+ld_methods = ("linear", "weighted", "curve_fit")
+
 def quad_darkening(x, a, b, c):
     return a * (1.0 - b * (1.0 - x) - c * (1.0 - x)**2)
 
 def quad_darkening_two(x, b, c):
     return 1.0 - b * (1.0 - x) - c * (1.0 - x)**2
+
+def fit_quad_darkening(mu, ints, weights=None):
+    # quad_darkening is p0 + p1*(1-mu) + p2*(1-mu)**2 with p0 = a,
+    # p1 = -a*b and p2 = -a*c, so it is fit by weighted linear least
+    # squares; ints (and weights) can be (n_epochs, n_rings) to fit many
+    # ring profiles at once
+    ints = np.atleast_2d(ints)
+    if weights is None:
+        weights = np.ones(ints.shape)
+    weights = np.broadcast_to(weights, ints.shape)
+
+    # rings without a value do not count
+    good = np.isfinite(ints) & np.isfinite(weights) & (weights > 0)
+    if np.any(np.sum(good, axis=1) < 3):
+        raise ValueError("need at least three rings to fit the limb darkening")
+    w = np.where(good, weights, 0.0)
+    y = np.where(good, ints, 0.0)
+
+    # solve the (3 x 3) normal equations of every profile together
+    t = 1.0 - np.asarray(mu, dtype=np.float64)
+    V = np.stack([np.ones_like(t), t, t**2], axis=-1)
+    VtWV = np.einsum("ri,er,rj->eij", V, w, V)
+    VtWy = np.einsum("ri,er,er->ei", V, w, y)
+    p = np.linalg.solve(VtWV, VtWy[..., None])[..., 0]
+
+    # back to a, b, c
+    coeffs = np.stack([p[:, 0], -p[:, 1] / p[:, 0], -p[:, 2] / p[:, 0]], axis=-1)
+    if not np.all(np.isfinite(coeffs)):
+        raise ValueError("limb darkening fit is degenerate")
+    return coeffs[0] if coeffs.shape[0] == 1 else coeffs
+
+def mu_ring_index(mu, mu_edge):
+    # ring i holds mu_edge[i+1] < mu <= mu_edge[i], everything else
+    # (off disk, mu <= mu_lim, nan) goes in ring len(mu_edge) - 1
+    n_rings = len(mu_edge) - 1
+    ring = n_rings - np.searchsorted(mu_edge[::-1], mu, side="left")
+    ring[(ring < 0) | (ring > n_rings)] = n_rings
+    return ring.astype(np.int16)
+
+class MuRings(object):
+    # pixels grouped by mu ring, worked out once per mu array so that every
+    # image sharing the geometry (and epochs reusing cached geometry) can
+    # get its ring profile from a single gather of the image
+    def __init__(self, mu, mu_lim=0.1, num_mu=25):
+        self.mu = mu
+        self.mu_lim = mu_lim
+        self.num_mu = num_mu
+        self.mu_edge = np.linspace(1.0, mu_lim, num=num_mu)
+        self.mu_avgs = (self.mu_edge[1:] + self.mu_edge[0:-1]) / 2.0
+        self.n_rings = num_mu - 1
+
+        # ring of every pixel
+        ring = mu_ring_index(mu.ravel(), self.mu_edge)
+
+        # stable sort keeps the pixels of each ring in row-major order, so a
+        # ring's pixels come out exactly as boolean indexing would give them
+        counts = np.bincount(ring, minlength=self.n_rings + 1)
+        self.bounds = np.concatenate([[0], np.cumsum(counts)])
+        order = np.argsort(ring, kind="stable")[:self.bounds[self.n_rings]]
+        if order.size < np.iinfo(np.int32).max:
+            order = order.astype(np.int32)
+        self.order = order
+        return None
+
+    def matches(self, mu, mu_lim, num_mu):
+        return (self.mu is mu) and (self.mu_lim == mu_lim) and (self.num_mu == num_mu)
+
+    def profile(self, image, n_sigma=2.0):
+        # per-ring count, mean, std and mean after sigma clipping
+        prof = {"mu": self.mu_avgs}
+        for k in ("count", "mean", "std", "clipped_mean", "n_clipped"):
+            prof[k] = np.zeros(self.n_rings)
+
+        vals = image.ravel()[self.order]
+        for i in range(self.n_rings):
+            # drop nans from the ring
+            ints = vals[self.bounds[i]:self.bounds[i+1]]
+            ints = ints[~np.isnan(ints)]
+            prof["count"][i] = ints.size
+            prof["mean"][i] = np.mean(ints)
+            prof["std"][i] = np.std(ints)
+
+            # mask section that are big outliers
+            clip = np.abs(ints - prof["mean"][i]) >= (n_sigma * prof["std"][i])
+            ints[clip] = np.nan
+            prof["n_clipped"][i] = np.sum(clip)
+            prof["clipped_mean"][i] = np.nanmean(ints)
+        return prof
+
+class MuRingsCache(object):
+    # the most recently used ring groupings (each one holds on to its mu
+    # array), kept by whoever shares geometry between images: an epoch for
+    # its continuum and filtergram, or a batch of epochs
+    def __init__(self, maxsize=1):
+        self.maxsize = maxsize
+        self.store = []
+        self.hits = 0
+        self.misses = 0
+        return None
+
+    def get(self, mu, mu_lim=0.1, num_mu=25):
+        # reuse the grouping if it was made for this very mu array
+        for rings in self.store:
+            if rings.matches(mu, mu_lim, num_mu):
+                self.hits += 1
+                return rings
+
+        self.misses += 1
+        rings = MuRings(mu, mu_lim=mu_lim, num_mu=num_mu)
+        self.store.insert(0, rings)
+        del self.store[self.maxsize:]
+        return rings
+
+    def clear(self):
+        self.store = []
+        return None
+
+def get_mu_rings(mu, mu_lim=0.1, num_mu=25, cache=None):
+    # ring grouping of mu, from the cache if there is one
+    if cache is None:
+        return MuRings(mu, mu_lim=mu_lim, num_mu=num_mu)
+    return cache.get(mu, mu_lim=mu_lim, num_mu=num_mu)
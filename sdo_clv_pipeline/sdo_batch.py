@@ -0,0 +1,78 @@
+import numpy as np
+import itertools
+
+from .sdo_io import *
+from .limbdark import MuRingsCache
+from .sdo_vels import RingIndexCache
+from .sdo_image import BulkVelDesignCache
+from .sdo_geometry import *
+from .sdo_reproject import *
+
+def batch_tolerances(tol=1.0):
+    # tolerances of the header geometry, either a multiple of the cache
+    # defaults or a dict of keywords to override
+    if isinstance(tol, dict):
+        tolerances = dict(default_tolerances)
+        tolerances.update(tol)
+        return tolerances
+    return {k: v * tol for k, v in default_tolerances.items()}
+
+def group_epochs(epochs, group_by="day"):
+    # split a date-sorted list of epochs (con, mag, dop, aia files) into
+    # runs of consecutive epochs from the same day (or of group_by epochs)
+    if group_by == "day":
+        return [list(g) for k, g in itertools.groupby(epochs, key=lambda e: get_date(e[0]).date())]
+    return [list(epochs[i:i+group_by]) for i in range(0, len(epochs), group_by)]
+
+class EpochBatch(object):
+    # work shared by a group of consecutive epochs: geometry and
+    # reprojection maps are reused for any header within tolerance of the
+    # epoch they were made for, and the limb darkening rings and the mu
+    # annulus indices follow the geometry. the normal matrix of the bulk
+    # velocity fit (and, with keep_design, its design matrix) follows the
+    # geometry as long as B0 is within the HGLT_OBS tolerance, so the fit
+    # (like the geometry) can be that of a B0 up to one tolerance away; the
+    # largest such offset is reported
+    def __init__(self, name, tolerances=None, dtype=np.float64, keep_design=False):
+        self.name = name
+        if tolerances is None:
+            tolerances = default_tolerances
+
+        # keep the shared arrays in the working precision, so the images
+        # use them as they are (the stores below follow them by identity)
+        self.geom_cache = GeometryCache(maxsize=1, dtype=dtype, tolerances=tolerances, nearest=True)
+        self.reproj_cache = ReprojectionCache(maxsize=1, dtype=dtype, tolerances=tolerances, nearest=True)
+        self.design_cache = BulkVelDesignCache(tolerance=tolerances["HGLT_OBS"], keep_design=keep_design)
+        self.rings_cache = MuRingsCache()
+        self.index_cache = RingIndexCache()
+        self.n_epochs = 0
+        return None
+
+    def caches(self):
+        # keyword arguments for process_data_set
+        return {"geom_cache": self.geom_cache, "reproj_cache": self.reproj_cache,
+                "design_cache": self.design_cache, "rings_cache": self.rings_cache,
+                "index_cache": self.index_cache}
+
+    def counts(self):
+        # (reused, computed) for every shared artifact
+        return {"geometry": (self.geom_cache.hits, self.geom_cache.misses),
+                "reprojection": (self.reproj_cache.hits, self.reproj_cache.misses),
+                "design": (self.design_cache.hits, self.design_cache.misses),
+                "mu_rings": (self.rings_cache.hits, self.rings_cache.misses),
+                "ring_index": (self.index_cache.hits, self.index_cache.misses)}
+
+    def report(self):
+        counts = ", ".join("%s %d/%d" % (k, hits, hits + misses) for k, (hits, misses) in self.counts().items())
+        print(">>> Batch %s: %d epochs, reused %s (design B0 off by up to %.2e deg)" %
+              (self.name, self.n_epochs, counts, self.design_cache.max_offset), flush=True)
+        return None
+
+    def close(self):
+        # let go of the shared arrays
+        self.geom_cache.clear()
+        self.reproj_cache.clear()
+        self.design_cache.clear()
+        self.rings_cache.clear()
+        self.index_cache.clear()
+        return None
@@ -0,0 +1,298 @@
+import numpy as np
+import astropy.units as u
+import os, hashlib
+from collections import OrderedDict
+from os.path import exists, isdir
+
+from sunpy.map import Map as sun_map
+from sunpy.coordinates import frames
+from astropy.wcs import WCS
+from astropy.coordinates import SkyCoord
+
+# names of the per-pixel geometry arrays
+geometry_names = ("mu", "rr", "xx", "yy", "lat", "lon")
+
+# quantization steps for header keywords that set the pixel geometry
+# (CRPIX in pixels, CDELT/CRVAL/RSUN_OBS in arcsec, angles in deg, lengths in m)
+default_tolerances = {"CRPIX1": 1e-2, "CRPIX2": 1e-2,
+                      "CDELT1": 1e-6, "CDELT2": 1e-6,
+                      "CRVAL1": 1e-3, "CRVAL2": 1e-3,
+                      "CROTA2": 1e-3, "HGLN_OBS": 1e-3, "HGLT_OBS": 1e-3,
+                      "DSUN_OBS": 1e5, "RSUN_OBS": 1e-3, "RSUN_REF": 1e3}
+
+def observer_stonyhurst(head):
+    # use the stonyhurst observer location if it is in the header
+    if ("HGLN_OBS" in head) and ("HGLT_OBS" in head):
+        return head["HGLN_OBS"], head["HGLT_OBS"], head["DSUN_OBS"]
+
+    # otherwise transform the carrington observer location
+    obs = SkyCoord(head["CRLN_OBS"] * u.deg, head["CRLT_OBS"] * u.deg,
+                   head["DSUN_OBS"] * u.m, obstime=head["DATE-OBS"],
+                   observer="self", frame=frames.HeliographicCarrington)
+    obs = obs.transform_to(frames.HeliographicStonyhurst(obstime=head["DATE-OBS"]))
+    return obs.lon.to_value(u.deg), obs.lat.to_value(u.deg), obs.radius.to_value(u.m)
+
+def calc_geometry_sunpy(image, head, rows=None):
+    # methods adapted from https://arxiv.org/abs/2105.12055
+    # original implementation at https://github.com/samarth-kashyap/hmi-clean-ls
+    # get sun map
+    smap = sun_map(image, head)
+
+    # do coordinate transforms / calculations (for a slice of rows if given)
+    paxis1 = np.arange(head["NAXIS1"])
+    paxis2 = np.arange(head["NAXIS2"])
+    if rows is not None:
+        paxis2 = paxis2[rows]
+    xx, yy = np.meshgrid(paxis1, paxis2)
+    hpc = smap.pixel_to_world(xx * u.pix, yy * u.pix)   # helioprojective cartesian
+
+    # transform to other coordinate systems
+    hgs = hpc.transform_to(frames.HeliographicStonyhurst)
+    hcc = hpc.transform_to(frames.Heliocentric)
+
+    # get cartesian and radial coordinates
+    geom = {}
+    geom["xx"] = hcc.x.to_value(u.m)
+    geom["yy"] = hcc.y.to_value(u.m)
+    rr = np.sqrt(hpc.Tx**2 + hpc.Ty**2) / (head["RSUN_OBS"] * u.arcsec)
+    geom["rr"] = rr.to_value(u.dimensionless_unscaled)
+
+    # heliocgraphic latitude and longitude
+    geom["lat"] = (hgs.lat + 90 * u.deg).to_value(u.deg)
+    geom["lon"] = hgs.lon.to_value(u.deg)
+
+    # get mu
+    geom["mu"] = calc_mu(geom["rr"])
+    return geom
+
+def calc_geometry_fast(head, rows=None):
+    # analytic equivalent of calc_geometry_sunpy using plain numpy trig,
+    # following the transformations in Thompson (2006), A&A, 449, 791
+    wcs = WCS(head)
+    wcs.wcs.set()
+    pc = wcs.wcs.get_pc()
+    cdelt = np.deg2rad(wcs.wcs.get_cdelt())
+    crpix = wcs.wcs.crpix
+    crval = np.deg2rad(wcs.wcs.crval)
+
+    # intermediate world coordinates (radians) of each pixel (0-based),
+    # or only of the pixels in a slice of rows
+    paxis2 = np.arange(head["NAXIS2"])
+    if rows is not None:
+        paxis2 = paxis2[rows]
+    dx = (np.arange(head["NAXIS1"]) + 1.0 - crpix[0])[np.newaxis, :]
+    dy = (paxis2 + 1.0 - crpix[1])[:, np.newaxis]
+    x = cdelt[0] * (pc[0, 0] * dx + pc[0, 1] * dy)
+    y = cdelt[1] * (pc[1, 0] * dx + pc[1, 1] * dy)
+
+    # invert the gnomonic (TAN) projection to helioprojective Tx, Ty
+    cos_d0 = np.cos(crval[1])
+    sin_d0 = np.sin(crval[1])
+    den = cos_d0 - y * sin_d0
+    Tx = np.arctan2(x, den)
+    Ty = np.arctan2((y * cos_d0 + sin_d0) * np.cos(Tx), den)
+    Tx += crval[0]
+    del x, y, den
+
+    # radial coordinate in units of the apparent solar radius
+    geom = {}
+    geom["rr"] = np.rad2deg(np.sqrt(Tx**2 + Ty**2)) * 3600.0 / head["RSUN_OBS"]
+
+    # distance along the line of sight to the solar surface
+    hgln, hglt, dsun = observer_stonyhurst(head)
+    rsun = head["RSUN_REF"]
+    cos_Ty = np.cos(Ty)
+    cos_alpha = cos_Ty * np.cos(Tx)
+    with np.errstate(invalid="ignore"):
+        dd = dsun * cos_alpha - np.sqrt(dsun**2 * cos_alpha**2 - dsun**2 + rsun**2)
+
+    # heliocentric cartesian coordinates (m)
+    xx = dd * cos_Ty * np.sin(Tx)
+    yy = dd * np.sin(Ty)
+    zz = dsun - dd * cos_alpha
+    del Tx, Ty, cos_Ty, cos_alpha, dd
+
+    # heliographic stonyhurst latitude and longitude (deg)
+    cos_B0 = np.cos(np.deg2rad(hglt))
+    sin_B0 = np.sin(np.deg2rad(hglt))
+    rad = np.sqrt(xx**2 + yy**2 + zz**2)
+    geom["lat"] = np.rad2deg(np.arcsin((yy * cos_B0 + zz * sin_B0) / rad)) + 90.0
+    lon = hgln + np.rad2deg(np.arctan2(xx, zz * cos_B0 - yy * sin_B0))
+    geom["lon"] = np.mod(lon + 180.0, 360.0) - 180.0
+    del rad, zz, lon
+
+    geom["xx"] = xx
+    geom["yy"] = yy
+
+    # get mu
+    geom["mu"] = calc_mu(geom["rr"])
+    return geom
+
+def calc_geometry_backend(image, head, backend="sunpy", rows=None):
+    if backend == "sunpy":
+        return calc_geometry_sunpy(image, head, rows=rows)
+    elif backend == "fast":
+        return calc_geometry_fast(head, rows=rows)
+    else:
+        raise ValueError("unknown geometry backend: " + str(backend))
+    return None
+
+def compare_geometry(image, head):
+    # maximum absolute difference between the fast and sunpy backends
+    geom1 = calc_geometry_sunpy(image, head)
+    geom2 = calc_geometry_fast(head)
+    diffs = {}
+    for n in geometry_names:
+        diffs[n] = np.nanmax(np.abs(geom1[n] - geom2[n]))
+        assert np.array_equal(np.isnan(geom1[n]), np.isnan(geom2[n]))
+    return diffs
+
+def calc_mu(rr):
+    mask = rr <= 1.0
+    mu = np.zeros(np.shape(rr))
+    mu[mask] = np.sqrt(1.0 - rr[mask]**2.0)
+    mu[~mask] = np.nan
+    return mu
+
+class GeometryCache(object):
+    # names of the stored arrays and prefix of their files on disk
+    names = geometry_names
+    prefix = "geom_"
+
+    def __init__(self, maxsize=2, cachedir=None, dtype=np.float64, tolerances=None, nearest=False):
+        # in-memory LRU store of geometry arrays
+        self.maxsize = maxsize
+        self.store = OrderedDict()
+        self.dtype = np.dtype(dtype)
+
+        # optional on-disk store of .npy files
+        self.cachedir = cachedir
+        if (cachedir is not None) and (not isdir(cachedir)):
+            os.makedirs(cachedir, exist_ok=True)
+
+        # set quantization of header keywords
+        self.tolerances = dict(default_tolerances)
+        if tolerances is not None:
+            self.tolerances.update(tolerances)
+
+        # reuse an entry for any header within tolerance of the one it was
+        # made for, rather than only for headers in the same quantization bin
+        # (only kept in memory)
+        self.nearest = nearest
+        if nearest:
+            self.cachedir = None
+
+        # count hits and misses
+        self.hits = 0
+        self.misses = 0
+        return None
+
+    def head_key(self, head):
+        hgln, hglt, dsun = observer_stonyhurst(head)
+        vals = {"CRPIX1": head["CRPIX1"], "CRPIX2": head["CRPIX2"],
+                "CDELT1": head["CDELT1"], "CDELT2": head["CDELT2"],
+                "CRVAL1": head.get("CRVAL1", 0.0), "CRVAL2": head.get("CRVAL2", 0.0),
+                "CROTA2": head.get("CROTA2", 0.0),
+                "HGLN_OBS": hgln, "HGLT_OBS": hglt, "DSUN_OBS": dsun,
+                "RSUN_OBS": head["RSUN_OBS"], "RSUN_REF": head["RSUN_REF"]}
+
+        # round each value to the nearest multiple of its tolerance (or
+        # keep it in units of the tolerance to find the nearest entry)
+        key = [head["NAXIS1"], head["NAXIS2"]]
+        for k in sorted(vals.keys()):
+            if self.nearest:
+                key.append(float(vals[k] / self.tolerances[k]))
+            else:
+                key.append(int(np.round(vals[k] / self.tolerances[k])))
+        return tuple(key)
+
+    def lookup(self, key):
+        # stored key that matches key, i.e. equal or (for nearest matching)
+        # with every value within tolerance
+        if key in self.store:
+            return key
+        if not self.nearest:
+            return None
+        for k in reversed(self.store.keys()):
+            if (len(k) == len(key)) and all((abs(a - b) <= 1.0) if isinstance(a, float) else (a == b)
+                                            for a, b in zip(k, key)):
+                return k
+        return None
+
+    def key(self, head, backend="sunpy"):
+        return (backend,) + self.head_key(head)
+
+    def fname(self, key, name):
+        digest = hashlib.sha1(repr((key, self.dtype.str)).encode()).hexdigest()[:16]
+        return os.path.join(self.cachedir, self.prefix + digest + "_" + name + ".npy")
+
+    def get(self, key):
+        # look in memory first
+        k = self.lookup(key)
+        if k is not None:
+            self.store.move_to_end(k)
+            self.hits += 1
+            return self.store[k]
+
+        # then look on disk
+        if (self.cachedir is not None) and all(exists(self.fname(key, n)) for n in self.names):
+            geom = {n: np.load(self.fname(key, n), mmap_mode="r") for n in self.names}
+            self.insert(key, geom)
+            self.hits += 1
+            return geom
+
+        self.misses += 1
+        return None
+
+    def put(self, key, geom):
+        # cast to storage precision and make read-only
+        geom = {n: np.asarray(geom[n], dtype=self.dtype) for n in self.names}
+        for arr in geom.values():
+            arr.flags.writeable = False
+
+        # write atomically so concurrent workers never see partial files
+        if self.cachedir is not None:
+            for n in self.names:
+                fname = self.fname(key, n)
+                tmp = fname + ".%s.tmp" % os.getpid()
+                with open(tmp, "wb") as f:
+                    np.save(f, geom[n])
+                os.replace(tmp, fname)
+
+        self.insert(key, geom)
+        return geom
+
+    def insert(self, key, geom):
+        self.store[key] = geom
+        self.store.move_to_end(key)
+        while len(self.store) > self.maxsize:
+            self.store.popitem(last=False)
+        return None
+
+    def clear(self):
+        self.store.clear()
+        return None
+
+def cache_args(kwargs):
+    # comparable form of the keyword arguments of a cache
+    args = []
+    for k in sorted(kwargs.keys()):
+        v = kwargs[k]
+        if k == "dtype":
+            v = np.dtype(v).str
+        elif isinstance(v, dict):
+            v = tuple(sorted(v.items()))
+        args.append((k, v))
+    return tuple(args)
+
+# process-wide cache so a worker reuses geometry across the epochs it
+# handles (made again if it is asked for with other arguments)
+_geometry_cache = None
+_geometry_cache_args = None
+
+def get_geometry_cache(**kwargs):
+    global _geometry_cache, _geometry_cache_args
+    if (_geometry_cache is None) or (cache_args(kwargs) != _geometry_cache_args):
+        _geometry_cache = GeometryCache(**kwargs)
+        _geometry_cache_args = cache_args(kwargs)
+    return _geometry_cache
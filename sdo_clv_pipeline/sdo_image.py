@@ -1,43 +1,221 @@
 import numpy as np
-import pdb, warnings
+import pdb, warnings, weakref
 import astropy.units as u
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 
-from sunpy.map import Map as sun_map
-from sunpy.coordinates import frames
-
 from scipy import ndimage
 from astropy.wcs import WCS
 from scipy.optimize import curve_fit
+from numpy.polynomial.polynomial import polyval
 from reproject import reproject_interp
-from skimage.measure import regionprops
 from astropy.wcs import FITSFixedWarning
 from astropy.io.fits.verify import VerifyWarning
 
 from .sdo_io import *
 from .limbdark import *
 from .legendre import *
+from .sdo_geometry import *
+from .sdo_reproject import *
 
 warnings.simplefilter("ignore", category=VerifyWarning)
 warnings.simplefilter("ignore", category=FITSFixedWarning)
 
-class SDOImage(object):
-    def __init__(self, file):
-        # set the filename
-        self.filename = file
+# components of the bulk velocity fit that are kept as full images
+bulk_vel_components = ("rot", "mer", "cbs")
+
+class BulkVelDesignCache(object):
+    # normal matrix of the bulk velocity fit (and its inverse), kept for the
+    # next dopplergram that shares the same geometry arrays and whose B0
+    # (deg) is within tolerance of the one it was made for. the design
+    # matrix itself (n_poly x n_pixels) is only kept if asked for, and the
+    # geometry is only referenced weakly, so neither outlives its epoch
+    def __init__(self, tolerance=0.0, keep_design=False):
+        self.tolerance = tolerance
+        self.keep_design = keep_design
+        self.entry = None
+        self.hits = 0
+        self.misses = 0
+        self.max_offset = 0.0
+        return None
 
-        # get the image and the header
-        self.image = read_data(self.filename)
-        self.parse_header()
+    def get(self, lat, B0, fit_cbs):
+        if ((self.entry is not None) and (self.entry[0]() is lat) and (self.entry[2] == fit_cbs) and
+            (abs(B0 - self.entry[1]) <= self.tolerance)):
+            self.hits += 1
+            self.max_offset = max(self.max_offset, abs(B0 - self.entry[1]))
+            return self.entry[3]
+        self.misses += 1
+        return None
+
+    def put(self, lat, B0, fit_cbs, A, Ainv, im_fit=None):
+        if not self.keep_design:
+            im_fit = None
+        self.entry = (weakref.ref(lat), B0, fit_cbs, (A, Ainv, im_fit))
+        return None
+
+    def clear(self):
+        self.entry = None
+        return None
+
+def take_pixels(arr, inds=None):
+    # values of arr at flat indices inds, or all of them
+    if inds is None:
+        return arr.ravel()
+    return arr.ravel()[inds]
+
+def spacecraft_vel(rr, xx, yy, rsun_solrad, obs_vr, obs_vw, obs_vn):
+    # line-of-sight component of the satellite velocity at the given pixels
+    # pre-compute trigonometric quantities
+    sig = np.arctan(rr/rsun_solrad)
+    chi = np.arctan2(xx, yy)
+    sin_sig = np.sin(sig)
+    cos_sig = np.cos(sig)
+    sin_chi = np.sin(chi)
+    cos_chi = np.cos(chi)
+
+    # project satellite velocity into coordinate frame
+    vr1 = obs_vr * cos_sig
+    vr2 = -obs_vw * sin_sig * sin_chi
+    vr3 = -obs_vn * sin_sig * cos_chi
+    return -(vr1 + vr2 + vr3)
+
+def bulk_vel_design(lat, lon, rr, B0, inds=None, fit_cbs=False, dtype=np.float64):
+    # rows of the design matrix of the bulk velocity fit for the pixels at
+    # flat indices inds, freeing temporaries as soon as possible to keep
+    # the peak down
+    cos_B0 = np.cos(B0)
+    sin_B0 = np.sin(B0)
+
+    lat_rad = np.deg2rad(take_pixels(lat, inds))
+    lon_rad = np.deg2rad(take_pixels(lon, inds))
+
+    cos_phi = np.cos(lon_rad)
+    lp = cos_B0 * np.sin(lon_rad)
+    del lon_rad
+    lt = sin_B0 * np.sin(lat_rad) - cos_B0 * np.cos(lat_rad) * cos_phi
+    del cos_phi
+
+    # figure out how many polynomials we need
+    if fit_cbs:
+        n_poly = 11
+    else:
+        n_poly = 6
+
+    # calculate legendre poylnomials
+    pl_theta, dt_pl_theta = gen_leg(5, lat_rad, dtype=dtype)
+    del pl_theta, lat_rad
+
+    # allocate memory
+    im_arr = np.zeros((n_poly, lt.shape[0]), dtype=dtype)
+
+    # differential rotation (axisymmetric feature; s = 1, 3, 5)
+    im_arr[0, :] = dt_pl_theta[1, :] * lp
+    im_arr[1, :] = dt_pl_theta[3, :] * lp
+    im_arr[2, :] = dt_pl_theta[5, :] * lp
+
+    # meridional circulation (axisymmetric feature; s = 2, 4)
+    # s = 0 is 0
+    im_arr[3, :] = dt_pl_theta[2, :] * lt
+    im_arr[4, :] = dt_pl_theta[4, :] * lt
+    del dt_pl_theta, lt, lp
+
+    # axisymmetric feature (frame=pole at disk-center)
+    # s = 0-5
+    if fit_cbs:
+        pl_rho, dt_pl_rho = gen_leg_x(5, take_pixels(rr, inds), dtype=dtype)
+    else:
+        pl_rho, dt_pl_rho = gen_leg_x(0, take_pixels(rr, inds), dtype=dtype)
+    del dt_pl_rho
+    im_arr[5:, :] = pl_rho
+    return im_arr
+
+def bulk_vel_model(lat, lon, rr, B0, fit_params, inds=None):
+    # fitted rotation, meridional circulation, and convective blueshift
+    # at the pixels at flat indices inds; the sums of legendre terms are
+    # polynomials in cos(lat) (or rho), so this is much cheaper than
+    # building the design matrix
+    cos_B0 = np.cos(B0)
+    sin_B0 = np.sin(B0)
+
+    lat_rad = np.deg2rad(take_pixels(lat, inds))
+    lon_rad = np.deg2rad(take_pixels(lon, inds))
+    cos_theta = np.cos(lat_rad)
+    sin_theta = np.sin(lat_rad)
+    del lat_rad
+
+    # legendre weights of the rotation (s = 1, 3, 5), meridional
+    # circulation (s = 2, 4), and axisymmetric (s = 0-5) terms
+    w_rot = np.zeros(6)
+    w_rot[[1, 3, 5]] = fit_params[0:3]
+    w_mer = np.zeros(6)
+    w_mer[[2, 4]] = fit_params[3:5]
+    w_cbs = fit_params[5:]
+
+    # d/dtheta of leg(cos theta) is -sin(theta) * leg'(cos theta)
+    model = {}
+    lp = cos_B0 * np.sin(lon_rad)
+    model["rot"] = -sin_theta * polyval(cos_theta, leg_series(w_rot, deriv=True)) * lp
+    del lp
+
+    lt = sin_B0 * sin_theta - cos_B0 * cos_theta * np.cos(lon_rad)
+    model["mer"] = -sin_theta * polyval(cos_theta, leg_series(w_mer, deriv=True)) * lt
+    npix = lt.size
+    del lt, lon_rad, cos_theta, sin_theta
+
+    if w_cbs.size > 1:
+        model["cbs"] = polyval(take_pixels(rr, inds), leg_series(w_cbs))
+    else:
+        model["cbs"] = np.full(npix, leg_series(w_cbs)[0])
+    return model
+
+# initial guesses of the limb darkening law for curve_fit (anything else
+# gets curve_fit's own default guess)
+ld_guess = {"CONTINUUM INTENSITY": [59000.0, 0.38, 0.23], "FILTERGRAM": [1000, 0.9, -0.25]}
+
+def fit_ld_profile(ld_profile, method="curve_fit", p0=None):
+    # take averages in mu annuli to fit to
+    avg_int = ld_profile["clipped_mean"]
+    mu_avgs = ld_profile["mu"]
+
+    # solve for the coefficients directly, weighting rings by the
+    # inverse variance of their mean if asked to
+    if method == "linear":
+        popt = fit_quad_darkening(mu_avgs, avg_int)
+    elif method == "weighted":
+        weights = ld_profile["count"] / ld_profile["std"]**2
+        popt = fit_quad_darkening(mu_avgs, avg_int, weights=weights)
+    else:
+        popt, pcov = curve_fit(quad_darkening, mu_avgs, avg_int, p0=p0)
+    return popt
+
+class SDOImage(object):
+    def __init__(self, file, dtype=np.float64, binning=1):
+        # set the file handle, filename, and working precision
+        self.file = as_sdo_file(file)
+        self.filename = self.file.filename
+        self.dtype = np.dtype(dtype)
+        self.binning = binning
+
+        # get the image and the header from a single open of the file
+        with self.file:
+            self.image = self.file.read_data(dtype=self.dtype)
+            head = self.file.header
+
+        # bin the image (and its header) for quick looks
+        if binning > 1:
+            self.image = bin_image(self.image, binning)
+            head = bin_header(head, binning)
+        self.parse_header(head)
 
         # initialize mu_thresh
         self.mu_thresh = 0.0
         return None
 
-    def parse_header(self):
+    def parse_header(self, head=None):
         # read the header
-        head = read_header(self.filename)
+        if head is None:
+            head = self.file.header
         self.wcs = WCS(head)
 
         # parse it
@@ -76,44 +254,39 @@ class SDOImage(object):
         self.head = head
         return None
 
-    def calc_geometry(self):
-        # methods adapted from https://arxiv.org/abs/2105.12055
-        # original implementation at https://github.com/samarth-kashyap/hmi-clean-ls
-        # get sun map
-        smap = sun_map(self.image, self.head)
-
-        # do coordinate transforms / calculations
-        paxis1 = np.arange(self.naxis1)
-        paxis2 = np.arange(self.naxis2)
-        xx, yy = np.meshgrid(paxis1, paxis2)
-        self.hpc = smap.pixel_to_world(xx * u.pix, yy * u.pix)   # helioprojective cartesian
+    def calc_geometry(self, cache=None, backend="sunpy"):
         self.rsun_solrad = self.dsun_obs/self.rsun_ref
 
-        # transform to other coordinate systems
-        hgs = self.hpc.transform_to(frames.HeliographicStonyhurst)
-        hcc = self.hpc.transform_to(frames.Heliocentric)
-
-        # get cartesian and radial coordinates
-        self.xx = hcc.x
-        self.yy = hcc.y
-        self.rr = np.sqrt(self.hpc.Tx**2 + self.hpc.Ty**2) / (self.rsun_obs * u.arcsec)
-
-        # heliocgraphic latitude and longitude
-        self.lat = hgs.lat + 90 * u.deg
-        self.lon = hgs.lon
-
-        # get mu
-        mask = self.rr <= 1.0
-        self.mu = np.zeros((4096, 4096))
-        self.mu[mask] = np.sqrt(1.0 - self.rr.value[mask]**2.0)
-        self.mu[~mask] = np.nan
+        # reuse geometry from the cache if the header geometry matches
+        if cache is None:
+            geom = calc_geometry_backend(self.image, self.head, backend=backend)
+        else:
+            key = cache.key(self.head, backend=backend)
+            geom = cache.get(key)
+            if geom is None:
+                geom = calc_geometry_backend(self.image, self.head, backend=backend)
+                geom = cache.put(key, geom)
+
+        # cast geometry to the working precision (cached geometry is kept
+        # in the precision of the cache, normally the same)
+        if geom["mu"].dtype != self.dtype:
+            geom = {n: geom[n].astype(self.dtype) for n in geometry_names}
+
+        # cartesian (m) and radial coordinates, latitude and longitude (deg)
+        self.xx = geom["xx"]
+        self.yy = geom["yy"]
+        self.rr = geom["rr"]
+        self.lat = geom["lat"]
+        self.lon = geom["lon"]
+        self.mu = geom["mu"]
         return None
 
     def inherit_geometry(self, other_image):
+        # share (rather than copy) mu, it is never modified in place
         # self.xx = np.copy(other_image.xx)
         # self.yy = np.copy(other_image.yy)
         # self.rr = np.copy(other_image.rr)
-        self.mu = np.copy(other_image.mu)
+        self.mu = other_image.mu
         # self.lat = np.copy(other_image.lat)
         # self.lon = np.copy(other_image.lon)
         return None
@@ -145,7 +318,8 @@ class SDOImage(object):
         self.image /= self.mu
         return None
 
-    def correct_dopplergram(self, fit_cbs=False):
+    def correct_dopplergram(self, fit_cbs=False, chunk_size=None, components=bulk_vel_components,
+                            fit_fraction=1.0, n_clip=0, clip_sigma=3.0, design_cache=None):
         assert self.is_dopplergram()
 
         # get mask excluding nans / sqrts of negatives
@@ -155,7 +329,9 @@ class SDOImage(object):
         # velocity components
         self.v_grav = 633 # m/s, constant
         self.calc_spacecraft_vel() # spacecraft velocity
-        self.calc_bulk_vel(fit_cbs=fit_cbs) # differential rotation + meridional flows + cbs
+        self.calc_bulk_vel(fit_cbs=fit_cbs, chunk_size=chunk_size, components=components,
+                           fit_fraction=fit_fraction, n_clip=n_clip, clip_sigma=clip_sigma,
+                           design_cache=design_cache) # differential rotation + meridional flows + cbs
         return None
 
     def calc_spacecraft_vel(self):
@@ -163,159 +339,191 @@ class SDOImage(object):
         # original implementation at https://github.com/samarth-kashyap/hmi-clean-ls
         assert self.is_dopplergram()
 
-        # pre-compute trigonometric quantities
-        sig = np.arctan(self.rr/self.rsun_solrad)
-        chi = np.arctan2(self.xx, self.yy)
-        sin_sig = np.sin(sig)
-        cos_sig = np.cos(sig)
-        sin_chi = np.sin(chi)
-        cos_chi = np.cos(chi)
-
-        # project satellite velocity into coordinate frame
-        vr1 = self.obs_vr * cos_sig
-        vr2 = -self.obs_vw * sin_sig * sin_chi
-        vr3 = -self.obs_vn * sin_sig * cos_chi
-
-        # reshape into 4096 x 4096 array
-        self.v_obs = np.zeros((4096, 4096))
-        self.v_obs[self.mask_nan] = -(vr1 + vr2 + vr3)[self.mask_nan]
+        # project the satellite velocity (only for unmasked pixels) and
+        # reshape into an image
+        self.v_obs = np.zeros((self.naxis2, self.naxis1), dtype=self.dtype)
+        self.v_obs[self.mask_nan] = spacecraft_vel(self.rr[self.mask_nan], self.xx[self.mask_nan],
+                                                   self.yy[self.mask_nan], self.rsun_solrad,
+                                                   self.obs_vr, self.obs_vw, self.obs_vn)
         self.v_obs[~self.mask_nan] = np.nan
         return None
 
-    def calc_bulk_vel(self, fit_cbs=False):
+    def bulk_vel_design(self, inds, fit_cbs=False):
+        # rows of the design matrix for the pixels at flat indices inds
+        return bulk_vel_design(self.lat, self.lon, self.rr, self.B0, inds=inds,
+                               fit_cbs=fit_cbs, dtype=self.dtype)
+
+    def bulk_vel_model(self, inds):
+        # fitted components at the pixels at flat indices inds
+        return bulk_vel_model(self.lat, self.lon, self.rr, self.B0, self.fit_params, inds=inds)
+
+    def bulk_vel_subsample(self, inds, fraction, n_strata=20):
+        # deterministic subsample of the pixels at flat indices inds that
+        # takes the same fraction of pixels (evenly spaced in row-major
+        # order) from each of n_strata bins in mu
+        mu = self.mu.ravel()[inds]
+        lo, hi = np.min(mu), np.max(mu)
+        strata = np.minimum((mu - lo) * (n_strata / (hi - lo)), n_strata - 1).astype(np.int16)
+        del mu
+
+        # rank of every pixel within its stratum
+        order = np.argsort(strata, kind="stable")
+        counts = np.bincount(strata, minlength=n_strata)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        rank = np.arange(inds.size) - np.repeat(starts, counts)
+
+        # take a pixel whenever the running count of fraction * rank ticks over
+        take = np.floor((rank + 1) * fraction) > np.floor(rank * fraction)
+        return np.sort(inds[order[take]])
+
+    def calc_bulk_vel(self, fit_cbs=False, chunk_size=None, components=bulk_vel_components,
+                      fit_fraction=1.0, n_clip=0, clip_sigma=3.0, design_cache=None):
         # methods adapted from https://arxiv.org/abs/2105.12055
         # original implementation at https://github.com/samarth-kashyap/hmi-clean-ls
         assert self.is_dopplergram()
 
-        # pre-compute trigonometric quantities
-        cos_B0 = np.cos(self.B0)
-        sin_B0 = np.sin(self.B0)
-
-        self.lat_mask = self.lat[self.mask_nan]#.copy()
-        self.lon_mask = self.lon[self.mask_nan]#.copy()
-        self.rho_mask = self.rr[self.mask_nan]#.copy()
-
-        cos_theta = np.cos(self.lat_mask)
-        sin_theta = np.sin(self.lat_mask)
-        cos_phi = np.cos(self.lon_mask)
-        sin_phi = np.sin(self.lon_mask)
+        # flat indices of the unmasked pixels; the fit arrays are only made
+        # for a chunk of them at a time and are freed once the fit is done
+        inds = np.flatnonzero(self.mask_nan)
+        n_poly = 11 if fit_cbs else 6
+        chunks = list(gen_chunks(inds.size, chunk_size=chunk_size))
 
-        self.lt = sin_B0 * sin_theta - cos_B0 * cos_theta * cos_phi
-        self.lp = cos_B0 * sin_phi
-
-        # calculate legendre poylnomials
-        # print(">>> Generating ~Legendre~ Polynomials", flush=True)
-        pl_theta, dt_pl_theta = gen_leg(5, self.lat_mask)
-        if fit_cbs:
-            pl_rho, dt_pl_rho = gen_leg_x(5, self.rho_mask)
-        else:
-            pl_rho, dt_pl_rho = gen_leg_x(0, self.rho_mask)
-        # print(">>> Done generating ~Legendre~ Polynomials", flush=True)
+        def data(idx):
+            # get the data to fit
+            return self.image.ravel()[idx] - self.v_obs.ravel()[idx] - self.v_grav
 
-        # figure out how many polynomials we need
-        if fit_cbs:
-            n_poly = 11
+        # fit on all pixels or on a subsample stratified in mu
+        if fit_fraction < 1.0:
+            fit_inds = self.bulk_vel_subsample(inds, fit_fraction)
+            fit_chunks = list(gen_chunks(fit_inds.size, chunk_size=chunk_size))
         else:
-            n_poly = 6
-
-        # allocate memory
-        self.im_arr = np.zeros((n_poly, self.lt.shape[0]))
-
-        # differential rotation (axisymmetric feature; s = 1, 3, 5)
-        self.im_arr[0, :] = dt_pl_theta[1, :] * self.lp
-        self.im_arr[1, :] = dt_pl_theta[3, :] * self.lp
-        self.im_arr[2, :] = dt_pl_theta[5, :] * self.lp
-
-        # meridional circulation (axisymmetric feature; s = 2, 4)
-        # s = 0 is 0
-        self.im_arr[3, :] = dt_pl_theta[2, :] * self.lt
-        self.im_arr[4, :] = dt_pl_theta[4, :] * self.lt
-
-        # axisymmetric feature (frame=pole at disk-center)
-        # s = 0-5
-        self.im_arr[5, :] = pl_rho[0, :]
-        if fit_cbs:
-            self.im_arr[6, :] = pl_rho[1, :]
-            self.im_arr[7, :] = pl_rho[2, :]
-            self.im_arr[8, :] = pl_rho[3, :]
-            self.im_arr[9, :] = pl_rho[4, :]
-            self.im_arr[10, :] = pl_rho[5, :]
-
-        # get the data to fit and compute RHS
-        self.dat = (self.image - self.v_obs - self.v_grav)[self.mask_nan].copy()
-        self.RHS = self.im_arr.dot(self.dat)
-
-        # fill the matrix
-        A = np.zeros((n_poly, n_poly))
-        for i in range(n_poly):
-            for j in range(n_poly):
-                A[i, j] = self.im_arr[i, :].dot(self.im_arr[j, :])
-
-        # invert and compute fit params
-        Ainv = inv_SVD(A, 1e5)
-        self.fit_params = Ainv.dot(self.RHS)
-
-        # get rotation component
-        self.v_rot = np.zeros((4096, 4096))
-        self.v_rot[self.mask_nan] = self.fit_params[:3].dot(self.im_arr[:3, :])
-        self.v_rot[~self.mask_nan] = np.nan
-
-        # get meridional circulation component
-        self.v_mer = np.zeros((4096, 4096))
-        self.v_mer[self.mask_nan] = self.fit_params[3:5].dot(self.im_arr[3:5, :])
-        self.v_mer[~self.mask_nan] = np.nan
-
-        # get convective blueshift w/ limb component
-        self.v_cbs = np.zeros((4096, 4096))
-        self.v_cbs[self.mask_nan] = self.fit_params[5:].dot(self.im_arr[5:, :])
-        self.v_cbs[~self.mask_nan] = np.nan
-
-        # get corrected velocity
-        self.dat -= self.fit_params.dot(self.im_arr)
-        self.v_corr = np.zeros((4096, 4096))
-        self.v_corr[self.mask_nan] = self.dat
-        self.v_corr[~self.mask_nan] = np.nan
+            fit_inds = inds
+            fit_chunks = chunks
+
+        # reuse the normal matrix of an earlier dopplergram with the same
+        # geometry if the fit covers every pixel
+        cached = None
+        use_cache = (design_cache is not None) and (fit_inds is inds)
+        if use_cache:
+            cached = design_cache.get(self.lat, self.B0, fit_cbs)
+
+        # accumulate the normal equations, A = X X^T in one matrix product
+        # per chunk of pixels (a single chunk keeps the design matrix around
+        # to evaluate the model, more chunks bound memory)
+        keep = None
+        for it in range(n_clip + 1):
+            A = np.zeros((n_poly, n_poly))
+            RHS = np.zeros(n_poly)
+            for sl in fit_chunks:
+                if (it == 0) and (cached is not None) and (cached[2] is not None):
+                    im_fit = cached[2]
+                elif (it == 0) or (len(fit_chunks) > 1):
+                    im_fit = self.bulk_vel_design(fit_inds[sl], fit_cbs=fit_cbs)
+                dat = data(fit_inds[sl])
+                if (keep is None) and (cached is not None):
+                    RHS += im_fit.dot(dat)
+                elif keep is None:
+                    A += im_fit.dot(im_fit.T)
+                    RHS += im_fit.dot(dat)
+                else:
+                    A += (im_fit * keep[sl]).dot(im_fit.T)
+                    RHS += im_fit.dot(dat * keep[sl])
+
+            # invert (or reuse the inverse of the same normal matrix) and
+            # compute fit params
+            if (keep is None) and (cached is not None):
+                A, Ainv = cached[0], cached[1]
+            else:
+                Ainv = inv_SVD(A, 1e5)
+            self.fit_params = Ainv.dot(RHS)
+
+            # keep the normal matrix for the next dopplergram
+            if use_cache and (cached is None) and (it == 0):
+                design_cache.put(self.lat, self.B0, fit_cbs, A.copy(), Ainv,
+                                 im_fit=im_fit if (len(fit_chunks) == 1) else None)
+            if it == n_clip:
+                break
+
+            # mask pixels with big residuals and fit again
+            resid = np.empty(fit_inds.size)
+            for sl in fit_chunks:
+                if len(fit_chunks) > 1:
+                    resid[sl] = data(fit_inds[sl]) - sum(self.bulk_vel_model(fit_inds[sl]).values())
+                else:
+                    resid[sl] = data(fit_inds[sl]) - self.fit_params.dot(im_fit)
+            if keep is None:
+                keep = np.ones(fit_inds.size, dtype=bool)
+            keep = np.abs(resid) < (clip_sigma * np.std(resid[keep]))
+        self.n_fit = fit_inds.size if keep is None else np.sum(keep)
+
+        # reuse the design matrix if it already covers every pixel
+        im_arr = im_fit if ((fit_inds is inds) and (len(chunks) == 1)) else None
+        del im_fit, fit_inds, keep
+
+        # evaluate the fitted components (rotation, meridional circulation,
+        # and convective blueshift w/ limb component) chunk by chunk,
+        # keeping summary statistics of every component but only making
+        # full images of the ones asked for
+        comp_rows = {"rot": slice(0, 3), "mer": slice(3, 5), "cbs": slice(5, n_poly)}
+        stats = {k: [np.inf, -np.inf, 0.0] for k in comp_rows.keys()}
+        for k in components:
+            setattr(self, "v_" + k, np.full(self.mask_nan.shape, np.nan, dtype=self.dtype))
+        self.v_corr = np.full(self.mask_nan.shape, np.nan, dtype=self.dtype)
+
+        for sl in chunks:
+            # use the design matrix if we have it, otherwise the (cheaper)
+            # direct evaluation of the model
+            if im_arr is None:
+                model = self.bulk_vel_model(inds[sl])
+                total = model["rot"] + model["mer"] + model["cbs"]
+            else:
+                model = {k: self.fit_params[rows].dot(im_arr[rows, :]) for k, rows in comp_rows.items()}
+                total = self.fit_params.dot(im_arr)
+
+            for k, v in model.items():
+                stats[k] = [min(stats[k][0], np.min(v)), max(stats[k][1], np.max(v)), stats[k][2] + np.sum(v)]
+                if k in components:
+                    getattr(self, "v_" + k).ravel()[inds[sl]] = v
+
+            # get corrected velocity
+            self.v_corr.ravel()[inds[sl]] = data(inds[sl]) - total
+            del model, total
+        del im_arr
+
+        # min, max, and mean of each component
+        self.v_stats = {k: (lo, hi, tot / inds.size) for k, (lo, hi, tot) in stats.items()}
         return None
 
-    def calc_limb_darkening(self, mu_lim=0.1, num_mu=25, n_sigma=2.0):
+    def calc_limb_darkening(self, mu_lim=0.1, num_mu=25, n_sigma=2.0, method="curve_fit", rings_cache=None):
         assert (self.is_continuum() | self.is_filtergram())
+        assert method in ld_methods
 
-        # get average intensity in evenly spaced rings
-        mu_edge = np.linspace(1.0, mu_lim, num=num_mu)
-        avg_int = np.zeros(len(mu_edge)-1)
-        for i in range(len(avg_int)):
-            # find indices in ring that aren't nan
-            inds = (self.mu > mu_edge[i+1]) & (self.mu <= mu_edge[i]) & (~np.isnan(self.image))
-
-            # mask section that are big outliers
-            ints = self.image[inds]
-            ints[np.abs(ints - np.mean(ints)) >= (n_sigma * np.std(ints))] = np.nan
-            avg_int[i] = np.nanmean(ints)
-
-        # take averages in mu annuli to fit to
-        mu_avgs = (mu_edge[1:] + mu_edge[0:-1]) / 2.0
-
-        # set the initial guess parameters for optimization
-        if self.is_continuum():
-            p0 = [59000.0, 0.38, 0.23]
-        elif self.is_filtergram():
-            p0 = [1000, 0.9, -0.25]
-        else:
-            return None
+        # get sigma-clipped average intensity in evenly spaced rings
+        rings = get_mu_rings(self.mu, mu_lim=mu_lim, num_mu=num_mu, cache=rings_cache)
+        self.ld_profile = rings.profile(self.image, n_sigma=n_sigma)
 
-        # do the fit and divide out the LD profile
-        popt, pcov = curve_fit(quad_darkening, mu_avgs, avg_int, p0=p0)
+        # fit the limb darkening law to the profile
+        popt = fit_ld_profile(self.ld_profile, method=method, p0=ld_guess.get(self.content))
+
+        # divide out the LD profile
         self.ld_coeffs = popt
         self.ldark = quad_darkening_two(self.mu, *popt[1:])
         self.iflat = self.image/self.ldark
         return None
 
-    def rescale_to_hmi(self, hmi_image):
+    def rescale_to_hmi(self, hmi_image, cache=None):
         assert self.is_filtergram()
 
-        # rescale the image
-        self.image = reproject_interp((self.image, self.head), hmi_image.head,
-                                      return_footprint=False)
+        # rescale the image, reusing the pixel mapping if the geometry matches
+        if cache is None:
+            self.image = reproject_interp((self.image, self.head), hmi_image.head,
+                                          return_footprint=False).astype(self.dtype, copy=False)
+        else:
+            key = cache.key(self.head, hmi_image.head)
+            rmap = cache.get(key)
+            if rmap is None:
+                rmap = cache.put(key, calc_reprojection_map(self.head, hmi_image.head))
+            self.image = apply_reprojection_map(self.image, rmap, dtype=self.dtype)
 
         # borrow the geometry now that the images are aligned
         self.inherit_geometry(hmi_image)
@@ -323,22 +531,54 @@ class SDOImage(object):
 
 # for creating pixel mask with thresholded regions
 def calculate_weights(mag):
+    return calc_weights(mag.image, mag.mu, mag.mu_thresh)
+
+def calc_weights(image, mu, mu_thresh):
     # set magnetic threshold
-    mag_thresh = 24.0/mag.mu
+    mag_thresh = 24.0/mu
 
     # make flag array for magnetically active areas
-    w_active = (np.abs(mag.image) > mag_thresh).astype(float)
+    w_active = (np.abs(image) > mag_thresh).astype(np.uint8)
 
     # convolve with boxcar filter to remove isolated pixels
-    w_conv = ndimage.convolve(w_active, np.ones([3,3]), mode="constant")
+    w_conv = ndimage.convolve(w_active, np.ones([3,3], dtype=np.uint8), mode="constant")
     w_active = np.logical_and(w_conv >= 2., w_active == 1.)
-    w_active[np.logical_or(mag.mu < mag.mu_thresh, np.isnan(mag.mu))] = False
+    w_active[np.logical_or(mu < mu_thresh, np.isnan(mu))] = False
 
     # make weights array for magnetically quiet areas
     w_quiet = ~w_active
-    w_quiet[np.logical_or(mag.mu < mag.mu_thresh, np.isnan(mag.mu))] = False
+    w_quiet[np.logical_or(mu < mu_thresh, np.isnan(mu))] = False
     return w_active, w_quiet
 
+def spot_indices(iflat, v_corr, con_thresh1, con_thresh2):
+    # get indices for umbrae
+    ind1 = iflat <= con_thresh2
+
+    # get indices for penumbrae, split by the sign of the velocity
+    indp = (iflat <= con_thresh1) & (iflat > con_thresh2)
+    if v_corr is not None:
+        ind2 = indp & (v_corr <= 0)
+        ind3 = indp & (v_corr > 0)
+    else:
+        ind2 = indp
+        ind3 = np.zeros(np.shape(indp), dtype=bool)
+    return ind1, ind2, ind3
+
+def bright_region_types(areas, pix_hem):
+    # new type of every labeled bright region from its pixel count
+    areas = areas.astype(float)
+    areas *= (1e6/pix_hem) # convert to microhemispheres
+
+    # area thresh is 20ppm of pixels on hemisphere
+    area_thresh = 20e-6 * pix_hem
+
+    # plage for areas above the area thresh, and quiet sun for isolated
+    # bright pixels (0 is left as is)
+    new_type = np.zeros(areas.size + 1, dtype=np.uint8)
+    new_type[1:][areas > area_thresh] = 6 # plage
+    new_type[1:][areas == 1] = 4 # quiet sun
+    return new_type
+
 class SunMask(object):
     def __init__(self, con, mag, dop, aia):
         # check argument order/names are correct
@@ -351,58 +591,55 @@ class SunMask(object):
         self.date_obs = con.date_obs
 
         # inherit the geometry and the WCS
-        self.wcs = WCS(read_header(con.filename))
+        self.wcs = con.wcs
         self.inherit_geometry(con)
 
         # calculate weights
         self.w_active, self.w_quiet = calculate_weights(mag)
 
         # calculate magnetic filling factor
-        npix = np.nansum(con.mu >= con.mu_thresh)
-        self.ff = np.nansum(self.w_active[con.mu >= con.mu_thresh]) / npix
+        on_disk = con.mu >= con.mu_thresh
+        npix = np.sum(on_disk)
+        self.ff = np.sum(self.w_active[on_disk]) / npix
+        del on_disk
 
         # identify regions
         self.identify_regions(con, mag, dop, aia)
 
-        # get region fracs
-        self.umb_frac = np.nansum(self.is_umbra()) / npix
-        self.pen_frac = np.nansum(self.is_penumbra()) / npix
-        self.blu_pen_frac = np.nansum(self.is_blue_penumbra()) / npix
-        self.red_pen_frac = np.nansum(self.is_red_penumbra()) / npix
-        self.quiet_frac = np.nansum(self.is_quiet_sun()) / npix
-        self.network_frac = np.nansum(self.is_network()) / npix
-        self.plage_frac = np.nansum(self.is_plage()) / npix
+        # get region fracs from the number of pixels of every region type
+        counts = np.bincount(self.regions.ravel(), minlength=7)
+        self.umb_frac = counts[1] / npix
+        self.pen_frac = (counts[2] + counts[3]) / npix
+        self.blu_pen_frac = counts[2] / npix
+        self.red_pen_frac = counts[3] / npix
+        self.quiet_frac = counts[4] / npix
+        self.network_frac = counts[5] / npix
+        self.plage_frac = counts[6] / npix
 
         return None
 
     def inherit_geometry(self, other_image):
+        # share (rather than copy) mu, it is never modified in place
         # self.xx = np.copy(other_image.xx)
         # self.yy = np.copy(other_image.yy)
         # self.rr = np.copy(other_image.rr)
-        self.mu = np.copy(other_image.mu)
+        self.mu = other_image.mu
         # self.lat = np.copy(other_image.lat)
         # self.lon = np.copy(other_image.lon)
         return None
 
     def identify_regions(self, con, mag, dop, aia):
-        # allocate memory for mask array
-        self.regions = np.zeros(np.shape(con.image))
+        # allocate memory for mask array (0 = no region / off disk)
+        self.regions = np.zeros(np.shape(con.image), dtype=np.uint8)
 
         # calculate intensity thresholds for HMI
-        self.con_thresh1 = 0.89 * np.nansum(con.iflat * self.w_quiet)/np.nansum(self.w_quiet)
-        self.con_thresh2 = 0.45 * np.nansum(con.iflat * self.w_quiet)/np.nansum(self.w_quiet)
+        quiet_int = np.nansum(con.iflat * self.w_quiet)/np.nansum(self.w_quiet)
+        self.con_thresh1 = 0.89 * quiet_int
+        self.con_thresh2 = 0.45 * quiet_int
 
-        # get indices for umbrae
-        ind1 = con.iflat <= self.con_thresh2
-
-        # get indices for penumbrae
-        indp = (con.iflat <= self.con_thresh1) & (con.iflat > self.con_thresh2)
-        if hasattr(dop, "v_corr"):
-            ind2 = indp & (dop.v_corr <= 0)
-            ind3 = indp & (dop.v_corr > 0)
-        else:
-            ind2 = indp
-            ind3 = np.zeros(np.shape(indp), dtype=bool)
+        # get indices for umbrae and penumbrae
+        ind1, ind2, ind3 = spot_indices(con.iflat, getattr(dop, "v_corr", None),
+                                        self.con_thresh1, self.con_thresh2)
 
         """
         # find contiguous penumbra regions
@@ -425,12 +662,14 @@ class SunMask(object):
         ind4 = (con.iflat > self.con_thresh1) & self.w_quiet
 
         # calculate intensity thresholds for AIA
-        weights = self.w_active * (~ind1) * (~ind2) * (~ind3)
+        not_spot = ~(ind1 | ind2 | ind3)
+        weights = self.w_active & not_spot
         self.aia_thresh = np.nansum(aia.iflat * weights)/np.nansum(weights)
+        del weights
 
         # get indices for bright regions (plage/faculae + network)
         ind5a = (con.iflat > self.con_thresh1) & self.w_active
-        ind5b = (aia.iflat > self.aia_thresh) & (~ind1) & (~ind2) & (~ind3)
+        ind5b = (aia.iflat > self.aia_thresh) & not_spot
         ind5 = ind5a | ind5b
 
         # set mask indices
@@ -444,36 +683,30 @@ class SunMask(object):
         binary_img = self.regions == 5
         structure = ndimage.generate_binary_structure(2,2)
         labels, nlabels = ndimage.label(binary_img, structure=structure)
-
-        # get labeled region areas and perimeters
-        rprops = regionprops(labels)
-        areas = np.array([rprop.area for rprop in rprops]).astype(float)
-        areas *= (1e6/np.sum(self.mu > 0.0)) # convert to microhemispheres
-
-        # area thresh is 20ppm of pixels on hemisphere
-        pix_hem = np.nansum(con.mu > 0.0)
-        area_thresh = 20e-6 * pix_hem
-
-        # assign region type to plage for ratios less than ratio thresh
-        ind6 = np.concatenate(([False], areas > area_thresh))[labels]
-        self.regions[ind6] = 6 # plage
-
-        # set isolated bright pixels to quiet sun
-        ind_iso = np.concatenate(([False], areas == 1))[labels]
-        self.regions[ind_iso] = 4 # quiet sun
+        del binary_img
+
+        # get labeled region areas (pixel counts of every label) and the
+        # new type of every labeled region
+        pix_hem = np.sum(con.mu > 0.0)
+        areas = np.bincount(labels.ravel(), minlength=nlabels+1)[1:]
+        new_type = bright_region_types(areas, pix_hem)
+        new_regions = new_type[labels]
+        del labels
+        np.copyto(self.regions, new_regions, where=(new_regions > 0))
+        del new_regions
 
         # make any remaining unclassified pixels quiet sun
         ind_rem = ((con.mu >= con.mu_thresh) & (self.regions == 0))
         self.regions[ind_rem] = 4 # quiet sun
 
-        # set values beyond mu_thresh to nan
-        self.regions[np.logical_or(con.mu <= con.mu_thresh, np.isnan(con.mu))] = np.nan
+        # set values beyond mu_thresh to no region
+        self.regions[~(con.mu > con.mu_thresh)] = 0
 
         return None
 
     def mask_low_mu(self, mu_thresh):
         self.mu_thresh = mu_thresh
-        self.regions[np.logical_or(self.mu < mu_thresh, np.isnan(self.mu))] = np.nan
+        self.regions[np.logical_or(self.mu < mu_thresh, np.isnan(self.mu))] = 0
         return None
 
     def is_umbra(self):
@@ -0,0 +1,131 @@
+import os, sqlite3, fnmatch
+from os.path import join, basename
+from concurrent.futures import ThreadPoolExecutor
+
+from .paths import root
+from .sdo_io import *
+
+# glob patterns used by find_data, keyed by product
+product_globs = {"con": "*hmi*{}*con*.fits",
+                 "mag": "*hmi*{}*mag*.fits",
+                 "dop": "*hmi*{}*op*.fits",
+                 "aia": "*aia*{}.fits"}
+
+# table layout of the index
+index_schema = """CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    product TEXT,
+    epoch TEXT,
+    size INTEGER,
+    mtime REAL,
+    valid INTEGER,
+    instrument TEXT,
+    content TEXT,
+    date_obs TEXT,
+    quallev0 INTEGER,
+    quallev1 INTEGER,
+    quality INTEGER
+)"""
+
+def default_index_file():
+    return str(root / "data") + "/fits_index.sqlite"
+
+def open_index(fname=None):
+    # connect to (and create if needed) the sqlite index
+    if fname is None:
+        fname = default_index_file()
+    conn = sqlite3.connect(fname, timeout=600)
+    conn.execute(index_schema)
+    conn.execute("CREATE INDEX IF NOT EXISTS files_epoch ON files (product, epoch)")
+    conn.commit()
+    return conn
+
+def get_product(f, globexp=""):
+    # figure out which data product a file is, using the find_data globs
+    name = basename(f)
+    for product, pattern in product_globs.items():
+        if fnmatch.fnmatchcase(name, pattern.format(globexp)):
+            return product
+    return None
+
+def index_entry(path, size, mtime):
+    # read only the header of the file
+    product = get_product(path)
+    epoch = get_date(path).isoformat()
+    try:
+        head = read_header(path)
+    except (OSError, IndexError):
+        return (path, product, epoch, size, mtime, 0, None, None, None, None, None, None)
+
+    return (path, product, epoch, size, mtime, 1,
+            head.get("TELESCOP"), head.get("CONTENT", "FILTERGRAM"),
+            head.get("DATE-OBS"), head.get("QUALLEV0"), head.get("QUALLEV1"),
+            get_header_quality(head))
+
+def scan_directory(indir):
+    # get size and mtime of every candidate FITS file in indir
+    entries = {}
+    with os.scandir(indir) as it:
+        for entry in it:
+            if not entry.name.endswith(".fits") or not entry.is_file():
+                continue
+            if get_product(entry.name) is None:
+                continue
+            st = entry.stat()
+            entries[join(indir, entry.name)] = (st.st_size, st.st_mtime)
+    return entries
+
+def update_index(conn, indir, globexp="", nthreads=8, batch_size=500):
+    # find files on disk and what the index already knows about
+    entries = scan_directory(indir)
+    known = {}
+    for path, size, mtime in conn.execute("SELECT path, size, mtime FROM files"):
+        if os.path.dirname(path) == os.path.dirname(join(indir, "")):
+            known[path] = (size, mtime)
+
+    # forget files that no longer exist
+    removed = [(path,) for path in known.keys() if path not in entries]
+    conn.executemany("DELETE FROM files WHERE path = ?", removed)
+    conn.commit()
+
+    # read headers only for new or modified files matching the glob, on a
+    # thread pool (this is i/o bound), committing every batch_size files so
+    # an interrupted build keeps what it has read
+    todo = [path for path, stat in entries.items()
+            if (known.get(path) != stat) and (get_product(path, globexp=globexp) is not None)]
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        for start in range(0, len(todo), batch_size):
+            batch = todo[start:start + batch_size]
+            rows = list(pool.map(lambda path: index_entry(path, *entries[path]), batch))
+            conn.executemany("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+            conn.commit()
+    return len(todo), len(removed)
+
+def find_data_indexed(indir, globexp="", index_file=None, quality_only=True, nthreads=8):
+    # bring the index up to date
+    conn = open_index(index_file)
+    update_index(conn, indir, globexp=globexp, nthreads=nthreads)
+
+    # query each product, only keeping the first good file per epoch
+    files = {}
+    for product in product_globs.keys():
+        query = "SELECT path, epoch, valid, quality FROM files WHERE product = ? ORDER BY epoch, path"
+        files[product] = {}
+        for path, epoch, valid, quality in conn.execute(query, (product,)):
+            if os.path.dirname(path) != os.path.dirname(join(indir, "")):
+                continue
+            if get_product(path, globexp=globexp) != product:
+                continue
+            if quality_only and ((valid == 0) or (quality not in (None, 0))):
+                continue
+            if epoch not in files[product]:
+                files[product][epoch] = path
+    conn.close()
+
+    # find epochs that are in *all* products
+    common_dates = sorted(set.intersection(*map(set, [f.keys() for f in files.values()])))
+    con_files = [files["con"][date] for date in common_dates]
+    mag_files = [files["mag"][date] for date in common_dates]
+    dop_files = [files["dop"][date] for date in common_dates]
+    aia_files = [files["aia"][date] for date in common_dates]
+    return con_files, mag_files, dop_files, aia_files
@@ -2,27 +2,287 @@
 import numpy as np
 import sunpy as sp
 import datetime as dt
-import os, re, pdb, csv, glob
+import os, re, pdb, csv, glob, time, shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from astropy.io import fits
 from astropy.time import Time
 from os.path import exists, split, isdir, getsize, splitext
 
 from .paths import root
+from .sdo_ledger import *
+
+# columns of the output tables
+threshold_columns = ["mjd", "aia_thresh", "a_aia", "b_aia", "c_aia",
+                     "hmi_thresh1", "hmi_thresh2", "a_hmi", "b_hmi", "c_hmi",
+                     "vel_cbs_off",
+                     "min_vel_sat", "max_vel_sat", "avg_vel_sat",
+                     "min_vel_rot", "max_vel_rot", "avg_vel_rot",
+                     "min_vel_mer", "max_vel_mer", "avg_vel_mer"]
+region_columns = ["mjd", "region", "lo_mu", "hi_mu", "pixel_frac", "light_frac", "v_hat", "v_phot", "v_quiet", "v_conv", "mag_unsigned", "avg_int", "avg_int_flat"]
+result_columns = {"thresholds": threshold_columns, "region_output": region_columns}
+
+# columns of the per-stage timing table (csv only)
+timing_columns = ["date", "stage", "wall", "cpu", "rss", "peak_rss"]
+
+# sort order of compacted columnar output (region first so that row
+# group statistics let readers skip everything but the wanted regions)
+result_sort_keys = {"thresholds": ["mjd"], "region_output": ["region", "lo_mu", "mjd"]}
+
+class SDOFile(object):
+    # handle that opens and verifies a FITS file once, caches the fixed
+    # header, and only reads/decompresses the image data when asked
+    def __init__(self, file, hdu=1):
+        self.filename = file
+        self.hdu = hdu
+        self.hdu_list = None
+        self._header = None
+        self._image = None
+        return None
+
+    def open(self):
+        if self.hdu_list is None:
+            # uncompressed data are memory mapped, compressed data are
+            # decompressed on first access of .data
+            self.hdu_list = fits.open(self.filename, memmap=True)
+            self.hdu_list.verify("silentfix")
+        return self.hdu_list
+
+    def close(self):
+        if self.hdu_list is not None:
+            self.hdu_list.close()
+            self.hdu_list = None
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return None
+
+    @property
+    def header(self):
+        if self._header is None:
+            self._header = self.open()[self.hdu].header
+        return self._header
+
+    @property
+    def data(self):
+        # raw (possibly memory-mapped) data, valid while the file is open
+        return self.open()[self.hdu].data
+
+    def read_data(self, dtype=float):
+        # hand over the preloaded image if there is one
+        if (self._image is not None) and (self._image.dtype == np.dtype(dtype)):
+            image, self._image = self._image, None
+            return image
+
+        # copy of the data in the requested precision
+        return self.data.astype(dtype)
+
+    def read_rows(self, rows, dtype=float, binning=1):
+        # copy of a slice of rows of the (binned) image, only decompressing
+        # the tiles of a compressed image that hold those rows
+        raw = slice(rows.start * binning, rows.stop * binning)
+        data = self.open()[self.hdu].section[raw].astype(dtype)
+        return bin_image(data, binning)
+
+    def load(self, dtype=float):
+        # read the header and decompress the data into memory, then close
+        # the file so the handle can be passed to SDOImage later
+        try:
+            self.header
+            self._image = self.data.astype(dtype)
+        finally:
+            self.close()
+        return self
+
+def as_sdo_file(file):
+    if isinstance(file, SDOFile):
+        return file
+    return SDOFile(file)
+
+def get_filename(file):
+    if isinstance(file, SDOFile):
+        return file.filename
+    return file
+
+def preload_file(file, dtype=float):
+    # errors are raised again when SDOImage reads the file itself
+    try:
+        file.load(dtype=dtype)
+    except Exception:
+        pass
+    return file
+
+class EpochPrefetcher(object):
+    # iterate over epochs, reading the four files of the next `depth`
+    # epochs on a thread pool while the current epoch is being processed
+    def __init__(self, epochs, dtype=float, depth=1, nthreads=4):
+        self.epochs = deque(epochs)
+        self.dtype = dtype
+        self.depth = depth
+        self.pending = deque()
+        self.pool = None
+        if depth > 0:
+            self.pool = ThreadPoolExecutor(max_workers=nthreads)
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return None
+
+    def __iter__(self):
+        return self
+
+    def submit(self):
+        # start reading the files of the next epoch
+        files = [SDOFile(f) for f in self.epochs.popleft()]
+        futures = [self.pool.submit(preload_file, f, dtype=self.dtype) for f in files]
+        self.pending.append((files, futures))
+        return None
+
+    def __next__(self):
+        # without prefetching, files are read by SDOImage as usual
+        if self.pool is None:
+            if not self.epochs:
+                raise StopIteration
+            return [SDOFile(f) for f in self.epochs.popleft()]
+
+        # keep the current epoch plus `depth` epochs in flight
+        while self.epochs and (len(self.pending) < self.depth + 1):
+            self.submit()
+        if not self.pending:
+            raise StopIteration
+
+        # wait for the current epoch
+        files, futures = self.pending.popleft()
+        for future in futures:
+            future.result()
+        return files
+
+    def close(self):
+        if self.pool is not None:
+            for files, futures in self.pending:
+                for future in futures:
+                    future.cancel()
+            self.pending.clear()
+            self.pool.shutdown(wait=True)
+            self.pool = None
+        return None
 
 # read headers and data
 def read_header(file):
-    # return fits.getheader(file, 1, output_verify="silentfix")
-    with fits.open(file) as hdu_list:
-        hdu_list.verify("silentfix")
-        header = hdu_list[1].header
+    if isinstance(file, SDOFile):
+        return file.header
+    with SDOFile(file) as f:
+        header = f.header
     return header
 
-def read_data(file):
-    with fits.open(file) as hdu_list:
-        hdu_list.verify("silentfix")
-        data = hdu_list[1].data.astype(float)
+def read_data(file, dtype=float):
+    if isinstance(file, SDOFile):
+        return file.read_data(dtype=dtype)
+    with SDOFile(file) as f:
+        data = f.read_data(dtype=dtype)
     return data
 
+# factors an image can be binned by for quick looks
+preview_binnings = (1, 2, 4, 8)
+
+def bin_image(image, factor):
+    # mean of every factor x factor block, dropping rows and columns at the
+    # end that do not fill a block (so the header only needs rescaling)
+    if factor == 1:
+        return image
+    ny, nx = image.shape[0] // factor, image.shape[1] // factor
+    blocks = image[:ny * factor, :nx * factor].reshape(ny, factor, nx, factor)
+    return blocks.mean(axis=(1, 3), dtype=image.dtype)
+
+def bin_header(head, factor):
+    # header (and so WCS) of an image binned with bin_image
+    head = head.copy()
+    if factor == 1:
+        return head
+    for i in (1, 2):
+        head["NAXIS%d" % i] = head["NAXIS%d" % i] // factor
+        head["CDELT%d" % i] = head["CDELT%d" % i] * factor
+        head["CRPIX%d" % i] = (head["CRPIX%d" % i] - 0.5) / factor + 0.5
+
+    # other pixel-based keywords, if present
+    for key in ("CD1_1", "CD1_2", "CD2_1", "CD2_2", "IMSCL_MP"):
+        if key in head:
+            head[key] = head[key] * factor
+    if "R_SUN" in head:
+        head["R_SUN"] = head["R_SUN"] / factor
+    for key in ("X0_MP", "Y0_MP"):
+        if key in head:
+            head[key] = (head[key] + 0.5) / factor - 0.5
+    return head
+
+# header keywords needed to decide whether an epoch is worth processing
+quality_keywords = ("QUALLEV0", "QUALLEV1", "CONTENT", "TELESCOP", "DATE-OBS")
+
+def get_header_quality(head):
+    # same quality flag selection as SDOImage.parse_header
+    instrument = head.get("TELESCOP")
+    if instrument == "SDO/AIA":
+        return head.get("QUALLEV0")
+    elif instrument == "SDO/HMI":
+        return head.get("QUALLEV1")
+    return None
+
+def read_quality_keywords(file):
+    # read only the header and keep only the keywords we need
+    try:
+        head = read_header(file)
+    except (OSError, IndexError):
+        return None
+    return {k: head.get(k) for k in quality_keywords}
+
+def check_epoch_quality(files):
+    # return the reason to skip an epoch, or None if it is good
+    reasons = []
+    for file in files:
+        keys = read_quality_keywords(file)
+        if keys is None:
+            reasons.append("invalid file " + split(file)[1])
+        elif get_header_quality(keys) != 0:
+            reasons.append("quality flag " + str(get_header_quality(keys)) + " in " + split(file)[1])
+    if reasons:
+        return "; ".join(reasons)
+    return None
+
+def filter_quality(con_files, mag_files, dop_files, aia_files, nthreads=8, skip_log=None, ledger=None):
+    # check headers of all epochs on a thread pool (this is i/o bound)
+    epochs = list(zip(con_files, mag_files, dop_files, aia_files))
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        reasons = list(pool.map(check_epoch_quality, epochs))
+
+    # record the rejected epochs
+    skipped = [(get_date(e[0]).isoformat(), r) + e for e, r in zip(epochs, reasons) if r is not None]
+    if (skip_log is not None) and skipped:
+        if not exists(skip_log):
+            create_file(skip_log, ["date", "reason", "con_file", "mag_file", "dop_file", "aia_file"])
+        write_results_to_file(skip_log, [list(row) for row in skipped])
+
+    # so resumed runs do not check them again
+    if ledger is not None:
+        for row in skipped:
+            status = "skipped-invalid" if "invalid" in row[1] else "skipped-quality"
+            ledger.finish(row[0], status, message=row[1])
+
+    # only keep the good epochs
+    keep = [idx for idx, r in enumerate(reasons) if r is None]
+    con_files = [con_files[idx] for idx in keep]
+    mag_files = [mag_files[idx] for idx in keep]
+    dop_files = [dop_files[idx] for idx in keep]
+    aia_files = [aia_files[idx] for idx in keep]
+    return con_files, mag_files, dop_files, aia_files
+
 # function to glob the input data
 def find_data(indir, globexp=""):
     # find the data
@@ -32,7 +292,7 @@ def find_data(indir, globexp=""):
     aia_files, aia_dates = sort_data(glob.glob(indir + "*aia*" + globexp + ".fits"))
 
     # find datetimes that are in *all* lists
-    common_dates = list(set.intersection(*map(set, [con_dates, mag_dates, dop_dates, aia_dates])))
+    common_dates = set.intersection(*map(set, [con_dates, mag_dates, dop_dates, aia_dates]))
 
     # remove epochs that are missing in any data set from all data sets
     con_files = [con_files[idx] for idx, date in enumerate(con_dates) if date in common_dates]
@@ -47,6 +307,7 @@ def sort_data(f_list):
     return [f_list[i] for i in inds], dates
 
 def get_date(f):
+    f = get_filename(f)
     if "aia" in f:
         s = re.search(r'\d{4}_\d{2}_\d{2}t\d{2}_\d{2}_\d{2}', f)
     elif "720s" in f:
@@ -78,10 +339,17 @@ def round_time(date=None, round_to=3600):
    rounding = (seconds+round_to/2) // round_to * round_to
    return date + dt.timedelta(0,rounding-seconds,-date.microsecond)
 
-def organize_IO(indir, datadir=None, clobber=False, globexp=""):
+def organize_IO(indir, datadir=None, clobber=False, globexp="", use_index=False, index_file=None,
+                quality_check=False, nthreads=8, use_ledger=False, retry_failed=False):
     # find the input data and check the lengths
     assert isdir(indir)
-    con_files, mag_files, dop_files, aia_files = find_data(indir, globexp=globexp)
+    if use_index:
+        # query the header index, which also drops bad-quality epochs
+        from .sdo_index import find_data_indexed
+        con_files, mag_files, dop_files, aia_files = find_data_indexed(indir, globexp=globexp, index_file=index_file,
+                                                                        nthreads=nthreads)
+    else:
+        con_files, mag_files, dop_files, aia_files = find_data(indir, globexp=globexp)
     assert (len(con_files) == len(mag_files) == len(dop_files) == len(aia_files))
 
     # figure out data directories
@@ -100,13 +368,12 @@ def organize_IO(indir, datadir=None, clobber=False, globexp=""):
     fname2 = datadir + "region_output.csv"
 
     # headers for output files
-    header1 = ["mjd", "aia_thresh", "a_aia", "b_aia", "c_aia",
-               "hmi_thresh1", "hmi_thresh2", "a_hmi", "b_hmi", "c_hmi",
-               "vel_cbs_off",
-               "min_vel_sat", "max_vel_sat", "avg_vel_sat",
-               "min_vel_rot", "max_vel_rot", "avg_vel_rot",
-               "min_vel_mer", "max_vel_mer", "avg_vel_mer"]
-    header2 = ["mjd", "region", "lo_mu", "hi_mu", "pixel_frac", "light_frac", "v_hat", "v_phot", "v_quiet", "v_conv", "mag_unsigned", "avg_int", "avg_int_flat"]
+    header1 = threshold_columns
+    header2 = region_columns
+
+    # ledger of finished epochs
+    new_ledger = use_ledger and not exists(get_ledger_file(datadir))
+    ledger = EpochLedger(get_ledger_file(datadir)) if use_ledger else None
 
     # replace/create/modify output files
     fileset = (fname1, fname2)
@@ -117,25 +384,74 @@ def organize_IO(indir, datadir=None, clobber=False, globexp=""):
         # create the files with headers
         create_file(fname1, header1)
         create_file(fname2, header2)
+        if ledger is not None:
+            ledger.clear()
+    elif all(map(exists, fileset)) and all(map(lambda x: getsize(x) > 0, fileset)) and (ledger is not None):
+        repair_output_file(*fileset)
+        drop_unfinished_rows(fname1, fname2)
+
+        # epochs with rows in the output were written without the ledger
+        # (or just before a crash), so record them as done rather than
+        # running them, and appending their rows, a second time. the whole
+        # output is only read when the ledger is new; after that only its
+        # last rows can be missing from the ledger
+        file_dates = get_dates(con_files)
+        if new_ledger:
+            written = find_written_dates(fname1, file_dates) & find_written_dates(fname2, file_dates)
+        else:
+            written = find_written_dates(fname1, file_dates, tail=65536)
+        written = set(date.isoformat() for date in written)
+        ledger.seed(written - ledger.finished_dates(statuses=("done",)), "done",
+                    message="found in " + split(fname1)[1])
+
+        # skip epochs the ledger says are finished (or known bad)
+        if retry_failed:
+            finished = ledger.finished_dates(statuses=("done", "skipped-quality", "skipped-invalid"))
+        else:
+            finished = ledger.finished_dates()
+        keep = [idx for idx, date in enumerate(file_dates) if date.isoformat() not in finished]
+
+        # remove finished epochs from all data sets
+        con_files = [con_files[idx] for idx in keep]
+        mag_files = [mag_files[idx] for idx in keep]
+        dop_files = [dop_files[idx] for idx in keep]
+        aia_files = [aia_files[idx] for idx in keep]
     elif all(map(exists, fileset)) and all(map(lambda x: getsize(x) > 0, fileset)):
-        # get list of dates from file
-        mjd_list = find_all_dates(fname1)
-
-        # convert to Time objects and round to nearest hour
-        mjd_list = list(map(lambda x: Time(x, format="mjd"), mjd_list))
-        mjd_list = list(map(lambda x: round_time(date=x.datetime), mjd_list))
+        repair_output_file(*fileset)
+        drop_unfinished_rows(fname1, fname2)
 
         # subset the input data to list to only include dates not seen here
-        common_dates = list(set.intersection(*map(set, [get_dates(con_files), mjd_list])))
+        # (the file lists are matched up by date, so only parse them once)
+        file_dates = get_dates(con_files)
+        common_dates = find_written_dates(fname1, file_dates)
+        keep = [idx for idx, date in enumerate(file_dates) if date not in common_dates]
 
         # remove epochs that are missing in any data set from all data sets
-        con_files = [con_files[idx] for idx, date in enumerate(get_dates(con_files)) if date not in common_dates]
-        mag_files = [mag_files[idx] for idx, date in enumerate(get_dates(mag_files)) if date not in common_dates]
-        dop_files = [dop_files[idx] for idx, date in enumerate(get_dates(dop_files)) if date not in common_dates]
-        aia_files = [aia_files[idx] for idx, date in enumerate(get_dates(aia_files)) if date not in common_dates]
+        con_files = [con_files[idx] for idx in keep]
+        mag_files = [mag_files[idx] for idx in keep]
+        dop_files = [dop_files[idx] for idx in keep]
+        aia_files = [aia_files[idx] for idx in keep]
     else:
         create_file(fname1, header1)
         create_file(fname2, header2)
+        if ledger is not None:
+            ledger.clear()
+
+    # timings of every epoch are appended to across runs
+    fname3 = datadir + "timings.csv"
+    if clobber or not exists(fname3) or (getsize(fname3) == 0):
+        create_file(fname3, timing_columns)
+    else:
+        repair_output_file(fname3)
+
+    # drop bad epochs before any work is distributed
+    # (the index already excludes them)
+    if quality_check and not use_index:
+        con_files, mag_files, dop_files, aia_files = filter_quality(con_files, mag_files, dop_files, aia_files,
+                                                                    nthreads=nthreads, skip_log=datadir + "skipped.csv",
+                                                                    ledger=ledger)
+    if ledger is not None:
+        ledger.close()
 
     return con_files, mag_files, dop_files, aia_files
 
@@ -146,6 +462,48 @@ def clean_output_directory(*fnames):
         if not not fname_mp:
             for f_mp in fname_mp:
                 os.remove(f_mp)
+
+        # remove columnar output too
+        if isdir(splitext(fname)[0] + ".parquet"):
+            shutil.rmtree(splitext(fname)[0] + ".parquet")
+    return None
+
+def repair_output_file(*fnames):
+    # drop a torn last row left behind by a crash in the middle of a write
+    for fname in fnames:
+        with open(fname, "rb+") as f:
+            size = f.seek(0, os.SEEK_END)
+            if size == 0:
+                continue
+            f.seek(max(size - 65536, 0))
+            tail = f.read()
+            if tail.endswith(b"\n"):
+                continue
+            f.truncate(size - len(tail) + tail.rfind(b"\n") + 1)
+    return None
+
+def drop_unfinished_rows(fname1, fname2, tail=4194304):
+    # region rows are written before the thresholds row of their epoch, so
+    # trailing region rows of an epoch without a thresholds row (among the
+    # last ones in fname1) were left behind by a crash before it finished
+    finished = set(find_all_dates(fname1, tail=65536))
+    with open(fname2, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(size - tail, 0))
+        lines = f.read().splitlines(keepends=True)
+        if size > tail:
+            lines = lines[1:]
+        drop = 0
+        for line in reversed(lines):
+            if (b"mjd" in line) or (line.split(b",")[0].decode() in finished):
+                break
+            drop += len(line)
+        else:
+            # the last finished epoch is further back than we looked
+            if size > tail:
+                return None
+        if drop > 0:
+            f.truncate(size - drop)
     return None
 
 def truncate_output_file(*fnames):
@@ -156,13 +514,28 @@ def truncate_output_file(*fnames):
                 f.truncate()
     return None
 
-def find_all_dates(fname):
+def find_written_dates(fname, file_dates, tail=None):
+    # get list of dates from file (each only once)
+    mjd_list = set(find_all_dates(fname, tail=tail))
+
+    # convert to Time objects and round to nearest hour
+    mjd_list = list(map(lambda x: Time(x, format="mjd"), mjd_list))
+    mjd_list = list(map(lambda x: round_time(date=x.datetime), mjd_list))
+    return set(file_dates).intersection(mjd_list)
+
+def find_all_dates(fname, tail=None):
+    # mjd of every row, or of the rows in the last tail bytes of the file
     mjd_list = []
-    with open(fname, "r") as f:
+    with open(fname, "rb") as f:
+        if tail is not None:
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(size - tail, 0))
+            if size > tail:
+                f.readline()
         for line in f:
-            if "mjd" in line:
+            if b"mjd" in line:
                 continue
-            mjd_list.append(line.split(",")[0])
+            mjd_list.append(line.split(b",")[0].decode())
     return mjd_list
 
 def create_file(fname, header=None):
@@ -201,3 +574,191 @@ def stitch_output_files(fname, files, delete=False):
         for f in files:
             os.remove(f)
     return None
+
+def get_output_files(datadir, suffix=None):
+    # csv file for each output table, per-process files go in tmp/
+    if suffix is None:
+        return {"thresholds": datadir + "thresholds.csv",
+                "region_output": datadir + "region_output.csv",
+                "timings": datadir + "timings.csv"}
+
+    tmpdir = datadir + "tmp/"
+    fnames = {"thresholds": tmpdir + "thresholds_" + suffix + ".csv",
+              "region_output": tmpdir + "region_output_" + suffix + ".csv",
+              "timings": tmpdir + "timings_" + suffix + ".csv"}
+
+    # check if the files exist, create otherwise
+    for file in fnames.values():
+        if not exists(file):
+            create_file(file)
+    return fnames
+
+class ResultSink(object):
+    # receives all rows of a table for one epoch at a time
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return None
+
+    def write(self, table, rows):
+        raise NotImplementedError
+
+    def close(self):
+        return None
+
+class CSVSink(ResultSink):
+    def __init__(self, fnames):
+        self.fnames = fnames
+        return None
+
+    def write(self, table, rows):
+        # the timing table is optional, so create it when first needed
+        if (table == "timings") and not exists(self.fnames[table]):
+            create_file(self.fnames[table], timing_columns)
+
+        # append all rows of the epoch with a single open
+        assert exists(self.fnames[table])
+        with open(self.fnames[table], "a") as f:
+            writer = csv.writer(f)
+            writer.writerows(rows)
+        return None
+
+class ParquetSink(ResultSink):
+    def __init__(self, datadir):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("parquet output requires pyarrow")
+
+        # every sink writes its own part file of the dataset directory
+        self.datadir = datadir
+        self.tag = "%d_%d" % (os.getpid(), time.time_ns())
+        self.writers = {}
+        return None
+
+    def fname(self, table):
+        return self.datadir + table + ".parquet/part_" + self.tag + ".parquet"
+
+    def write(self, table, rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # timings only go to the csv
+        if table not in result_columns:
+            return None
+
+        # all columns are float64
+        arr = np.array(rows, dtype=np.float64).reshape(-1, len(result_columns[table]))
+        tab = pa.table({c: arr[:, i] for i, c in enumerate(result_columns[table])})
+
+        # each epoch becomes one row group
+        if table not in self.writers:
+            os.makedirs(split(self.fname(table))[0], exist_ok=True)
+            self.writers[table] = pq.ParquetWriter(self.fname(table), tab.schema)
+        self.writers[table].write_table(tab)
+        return None
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        return None
+
+class RecordSink(ResultSink):
+    # keeps the rows in memory so a worker can return them to the parent
+    def __init__(self):
+        self.writes = []
+        return None
+
+    def write(self, table, rows):
+        self.writes.append((table, rows))
+        return None
+
+class MultiSink(ResultSink):
+    def __init__(self, *sinks):
+        self.sinks = sinks
+        return None
+
+    def write(self, table, rows):
+        for sink in self.sinks:
+            sink.write(table, rows)
+        return None
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+        return None
+
+def get_result_sink(fnames, datadir, parquet=False):
+    if parquet:
+        return MultiSink(CSVSink(fnames), ParquetSink(datadir))
+    return CSVSink(fnames)
+
+def compact_parquet(datadir, table, row_group_size=65536):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # find the part files
+    path = datadir + table + ".parquet/"
+    parts = sorted(glob.glob(path + "part_*.parquet"))
+    if len(parts) == 0:
+        return None
+
+    # read everything, skipping parts that were never closed
+    tables = []
+    for part in list(parts):
+        try:
+            tables.append(pq.read_table(part))
+        except (OSError, pa.ArrowInvalid):
+            print("\t >>> Skipping unreadable part " + part, flush=True)
+            parts.remove(part)
+
+    # sort and write one file with large row groups
+    tab = pa.concat_tables(tables).sort_by([(k, "ascending") for k in result_sort_keys[table]])
+    fname = path + "part_%d_%d.parquet" % (os.getpid(), time.time_ns())
+    pq.write_table(tab, fname + ".tmp", row_group_size=row_group_size)
+    os.replace(fname + ".tmp", fname)
+
+    # remove the old parts
+    for part in parts:
+        os.remove(part)
+    return None
+
+def filter_frame(df, filters):
+    # apply pyarrow-style (DNF) filters to a data frame
+    ops = {"=": lambda c, v: c == v, "==": lambda c, v: c == v,
+           "!=": lambda c, v: c != v, "<": lambda c, v: c < v,
+           "<=": lambda c, v: c <= v, ">": lambda c, v: c > v,
+           ">=": lambda c, v: c >= v, "in": lambda c, v: c.isin(v),
+           "not in": lambda c, v: ~c.isin(v)}
+    if isinstance(filters[0], tuple):
+        filters = [filters]
+
+    idx = np.zeros(len(df), dtype=bool)
+    for conj in filters:
+        idx_conj = np.ones(len(df), dtype=bool)
+        for col, op, val in conj:
+            idx_conj &= ops[op](df[col], val).values
+        idx |= idx_conj
+    return df[idx]
+
+def has_parquet_output(datadir, table="region_output"):
+    path = datadir + table + ".parquet"
+    return isdir(path) and len(glob.glob(path + "/part_*.parquet")) > 0
+
+def read_results(datadir, table="region_output", filters=None, columns=None):
+    import pandas as pd
+
+    # read the columnar output if there is any, pushing down the filters
+    if has_parquet_output(datadir, table):
+        return pd.read_parquet(datadir + table + ".parquet", engine="pyarrow", filters=filters, columns=columns)
+
+    # otherwise fall back to the csv
+    df = pd.read_csv(datadir + table + ".csv")
+    if filters is not None:
+        df = filter_frame(df, filters)
+    if columns is not None:
+        df = df[columns]
+    return df.reset_index(drop=True)
@@ -0,0 +1,111 @@
+import os, time, sqlite3
+import datetime as dt
+
+# possible outcomes of processing an epoch
+ledger_statuses = ("done", "skipped-quality", "skipped-invalid",
+                   "failed-ld-fit", "failed-doppler", "failed-mask", "failed")
+
+# outcomes that will not change if the epoch is run again
+final_statuses = ("done", "skipped-quality", "skipped-invalid",
+                  "failed-ld-fit", "failed-doppler", "failed-mask")
+
+# table layout of the ledger
+ledger_schema = """CREATE TABLE IF NOT EXISTS epochs (
+    date TEXT PRIMARY KEY,
+    status TEXT,
+    message TEXT,
+    elapsed REAL,
+    finished TEXT,
+    pid INTEGER
+)"""
+
+class EpochLedger(object):
+    # durable record of the outcome of every epoch; each update is a
+    # single sqlite transaction so a crash never leaves a partial entry
+    def __init__(self, fname):
+        self.fname = fname
+        self.conn = None
+        self.t0 = {}
+        return None
+
+    def connect(self):
+        # connect lazily so the ledger can be handed to other processes
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.fname, timeout=600)
+            self.conn.execute(ledger_schema)
+            self.conn.commit()
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        return None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["conn"] = None
+        return state
+
+    def start(self, date):
+        self.t0[date] = time.time()
+        return None
+
+    def pending(self, date):
+        return date in self.t0
+
+    def finish(self, date, status, message=None):
+        assert status in ledger_statuses
+        now = time.time()
+        elapsed = now - self.t0.pop(date, now)
+        self.insert([(date, status, message, elapsed,
+                      dt.datetime.now().isoformat(), os.getpid())])
+        return None
+
+    def insert(self, rows):
+        # all rows are added in one transaction
+        with self.connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO epochs VALUES (?,?,?,?,?,?)", rows)
+        return None
+
+    def seed(self, dates, status, message=None):
+        # record epochs finished outside the ledger, in one transaction
+        now = dt.datetime.now().isoformat()
+        self.insert([(date, status, message, 0.0, now, os.getpid()) for date in sorted(dates)])
+        return None
+
+    def status(self, date):
+        row = self.connect().execute("SELECT status FROM epochs WHERE date = ?", (date,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def finished_dates(self, statuses=final_statuses):
+        # set of dates that do not need to be run again
+        query = "SELECT date FROM epochs WHERE status IN (%s)" % ",".join("?" * len(statuses))
+        return set(row[0] for row in self.connect().execute(query, tuple(statuses)))
+
+    def summary(self):
+        query = "SELECT status, COUNT(*), SUM(elapsed) FROM epochs GROUP BY status"
+        return {row[0]: (row[1], row[2]) for row in self.connect().execute(query)}
+
+    def clear(self):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM epochs")
+        self.t0 = {}
+        return None
+
+class MemoryLedger(EpochLedger):
+    # collects ledger rows in memory so a worker can hand them to the
+    # process that owns the ledger file
+    def __init__(self):
+        EpochLedger.__init__(self, None)
+        self.rows = []
+        return None
+
+    def insert(self, rows):
+        self.rows.extend(rows)
+        return None
+
+def get_ledger_file(datadir):
+    return datadir + "ledger.sqlite"
@@ -0,0 +1,110 @@
+import os, time, weakref, resource, threading
+
+def get_rss():
+    # current resident memory of this process in bytes
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # peak resident memory is the best we can do elsewhere
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def get_peak_rss():
+    # high-water mark of resident memory of this process in bytes
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class RSSSampler(object):
+    # keeps the highest resident memory seen during each open span, from
+    # the samples of the sampling thread, so peaks are measured without
+    # resetting the process-wide high-water mark (which, when a span raises
+    # it, gives that span's exact peak)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.peaks = []
+        self.marks = []
+        return None
+
+    def sample(self, rss):
+        with self.lock:
+            self.peaks = [max(peak, rss) for peak in self.peaks]
+        return None
+
+    def push(self):
+        # open a span, sampling for as long as any span is open
+        rss = get_rss()
+        with self.lock:
+            self.peaks.append(rss)
+            self.marks.append(get_peak_rss())
+        sampling.add(self)
+        return rss
+
+    def pop(self):
+        # close the innermost span and return its peak, which also counts
+        # towards the peak of the span around it
+        rss = get_rss()
+        mark = get_peak_rss()
+        with self.lock:
+            peak = max(self.peaks.pop(), rss)
+            if mark > self.marks.pop():
+                peak = max(peak, mark)
+            if self.peaks:
+                self.peaks[-1] = max(self.peaks[-1], peak)
+            done = len(self.peaks) == 0
+        if done:
+            sampling.discard(self)
+        return peak
+
+class SamplingThread(object):
+    # one background thread for all the samplers of a process, started with
+    # the first span and idle while no span is open (samplers left with
+    # open spans, e.g. by an exception, drop out once they are collected)
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.pid = None
+        return None
+
+    def start(self):
+        # (again in a forked child, which has none of the parent's threads)
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.active = threading.Event()
+        self.samplers = weakref.WeakSet()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return None
+
+    def add(self, sampler):
+        if self.pid != os.getpid():
+            self.start()
+        with self.lock:
+            self.samplers.add(sampler)
+        self.active.set()
+        return None
+
+    def discard(self, sampler):
+        with self.lock:
+            self.samplers.discard(sampler)
+            if len(self.samplers) == 0:
+                self.active.clear()
+        return None
+
+    def run(self):
+        while True:
+            self.active.wait()
+            time.sleep(self.interval)
+            rss = get_rss()
+            with self.lock:
+                samplers = list(self.samplers)
+                if len(samplers) == 0:
+                    self.active.clear()
+            for sampler in samplers:
+                sampler.sample(rss)
+
+sampling = SamplingThread()
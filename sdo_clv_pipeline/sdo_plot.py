@@ -142,8 +142,10 @@ def plot_image(sdo_image, outdir=None, fname=None):
 def plot_mask(mask, outdir=None, fname=None):
     assert outdir is not None
 
-    # merge the penumbra
-    mask.regions[mask.regions >= 3] -= 1
+    # merge the penumbra, show pixels without a region as bad
+    regions = mask.regions.astype(float)
+    regions[regions >= 3] -= 1
+    regions[mask.regions == 0] = np.nan
 
     # get cmap
     cmap = colors.ListedColormap(["black", "saddlebrown", "orange", "yellow", "white"])
@@ -156,7 +158,7 @@ def plot_mask(mask, outdir=None, fname=None):
     # plot the sun
     fig = plt.figure(figsize=(6.4, 4.8))
     ax1 = fig.add_subplot(111, projection=wcs)
-    img = ax1.imshow(mask.regions - 0.5, cmap=cmap, norm=norm, origin="lower", interpolation=None)
+    img = ax1.imshow(regions - 0.5, cmap=cmap, norm=norm, origin="lower", interpolation=None)
     sp.visualization.wcsaxes_compat.wcsaxes_heliographic_overlay(ax1, grid_spacing=15*u.deg, annotate=True,
                                                                  color="k", alpha=0.5, ls="--", lw=0.5)
     limb = ax1.contour(sdo_image.mu >= 0.0, colors="k", linestyles="--", linewidths=0.5, alpha=0.5)
@@ -0,0 +1,175 @@
+import os, time, traceback
+import multiprocessing as mp
+from collections import deque
+from multiprocessing.connection import wait
+
+from .sdo_memory import get_rss
+
+def worker_loop(conn, initializer, initargs, max_rss):
+    # run the initializer once so imports and caches stay warm
+    t_start = time.time()
+    if initializer is not None:
+        initializer(*initargs)
+    conn.send(("started", t_start, time.time()))
+
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+
+        # run the task and send back the result (or the error)
+        idx, func, args = task
+        t0 = time.time()
+        try:
+            res = (True, func(args))
+        except Exception:
+            res = (False, traceback.format_exc())
+
+        # leave (and get replaced) once memory use is above the watermark
+        rss = get_rss()
+        recycle = (max_rss is not None) and (rss > max_rss)
+        conn.send(("result", idx, res, time.time() - t0, rss, recycle))
+        if recycle:
+            break
+
+    conn.close()
+    return None
+
+class WorkerPool(object):
+    # long-lived worker processes that are recycled when their resident
+    # memory goes above max_rss (bytes) rather than after a fixed task count
+    def __init__(self, processes, initializer=None, initargs=(), max_rss=None, context="spawn"):
+        self.ctx = mp.get_context(context)
+        self.processes = processes
+        self.initializer = initializer
+        self.initargs = initargs
+        self.max_rss = max_rss
+        self.workers = {}
+        self.spawned = {}
+        self.ready = set()
+        self.idle = set()
+        self.running = {}
+        self.n_recycled = 0
+        for i in range(processes):
+            self.start_worker()
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return None
+
+    def start_worker(self):
+        # each worker gets its own pipe, so the parent always knows which
+        # task a worker holds and messages are never lost if it is killed
+        conn, child_conn = self.ctx.Pipe()
+        proc = self.ctx.Process(target=worker_loop,
+                                args=(child_conn, self.initializer, self.initargs, self.max_rss))
+        t0 = time.time()
+        proc.start()
+        child_conn.close()
+        self.workers[proc.pid] = (proc, conn)
+        self.spawned[proc.pid] = t0
+        return None
+
+    def remove_worker(self, pid):
+        proc, conn = self.workers.pop(pid)
+        proc.join()
+        conn.close()
+        self.idle.discard(pid)
+        return proc
+
+    def handle_message(self, pid, msg):
+        # returns (idx, ok, result) for finished tasks
+        if msg[0] == "started":
+            t_start, t_ready = msg[1:]
+            self.ready.add(pid)
+            self.idle.add(pid)
+            print(">>> Worker %s ready in %.2f s (startup %.2f s, init %.2f s)" %
+                  (pid, t_ready - self.spawned[pid], t_start - self.spawned[pid], t_ready - t_start), flush=True)
+            return None
+
+        idx, (ok, res), elapsed, rss, recycle = msg[1:]
+        self.running.pop(pid, None)
+        print(">>> Task %s on worker %s took %.2f s, rss %.2f GB" % (idx, pid, elapsed, rss / 1e9), flush=True)
+        if recycle:
+            print(">>> Recycling worker %s at rss %.2f GB" % (pid, rss / 1e9), flush=True)
+            self.n_recycled += 1
+            self.remove_worker(pid)
+            self.start_worker()
+        else:
+            self.idle.add(pid)
+        return idx, ok, res
+
+    def imap_unordered(self, func, items):
+        todo = deque(enumerate(items))
+        n_left = len(todo)
+        while n_left > 0:
+            # hand out tasks to idle workers
+            while todo and self.idle:
+                pid = self.idle.pop()
+                idx, args = todo.popleft()
+                self.workers[pid][1].send((idx, func, args))
+                self.running[pid] = idx
+
+            # wait for a message or for a worker to exit
+            conns = {conn: pid for pid, (proc, conn) in self.workers.items()}
+            sentinels = {proc.sentinel: pid for pid, (proc, conn) in self.workers.items()}
+            finished = []
+            for obj in wait(list(conns.keys()) + list(sentinels.keys())):
+                if obj in conns:
+                    # the worker may have been removed (and its conn closed)
+                    # by its sentinel earlier in this batch
+                    pid = conns[obj]
+                    if (pid not in self.workers) or (self.workers[pid][1] is not obj):
+                        continue
+                    try:
+                        msg = obj.recv()
+                    except (EOFError, OSError):
+                        continue
+                    out = self.handle_message(pid, msg)
+                    if out is not None:
+                        finished.append(out)
+                elif (obj in sentinels) and (sentinels[obj] in self.workers):
+                    # drain anything it sent before exiting
+                    pid = sentinels[obj]
+                    conn = self.workers[pid][1]
+                    while (pid in self.workers) and conn.poll():
+                        try:
+                            out = self.handle_message(pid, conn.recv())
+                        except (EOFError, OSError):
+                            break
+                        if out is not None:
+                            finished.append(out)
+                    if pid not in self.workers:
+                        continue
+
+                    # the worker died
+                    proc = self.remove_worker(pid)
+                    if pid not in self.ready:
+                        raise RuntimeError("worker %s failed to start (exit code %s)" % (pid, proc.exitcode))
+                    print(">>> Worker %s died (exit code %s)" % (pid, proc.exitcode), flush=True)
+                    if pid in self.running:
+                        finished.append((self.running.pop(pid), False, "lost with its worker"))
+                    self.start_worker()
+
+            # yield the results
+            for idx, ok, res in finished:
+                n_left -= 1
+                if ok:
+                    yield res
+                else:
+                    print(">>> Task %s failed:\n%s" % (idx, res), flush=True)
+        return None
+
+    def close(self):
+        # ask the workers to stop and wait for them
+        for pid, (proc, conn) in list(self.workers.items()):
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            self.remove_worker(pid)
+        return None
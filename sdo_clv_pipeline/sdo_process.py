@@ -9,6 +9,11 @@ from .paths import root
 from .sdo_io import *
 from .sdo_vels import *
 from .sdo_image import *
+from .sdo_geometry import *
+from .sdo_reproject import *
+from .sdo_timing import *
+from .sdo_batch import *
+from .sdo_tiles import *
 
 # multiprocessing imports
 from multiprocessing import get_context
@@ -17,245 +22,500 @@ import multiprocessing as mp
 def is_quality_data(sdo_image):
     return sdo_image.quality == 0
 
-def reduce_sdo_images(con_file, mag_file, dop_file, aia_file, mu_thresh=0.1, fit_cbs=False):
-    assert exists(con_file)
-    assert exists(mag_file)
-    assert exists(dop_file)
-    assert exists(aia_file)
+def skip_epoch(iso, message, status, ledger=None):
+    print("\t >>> " + message + ", skipping " + iso, flush=True)
+    if ledger is not None:
+        ledger.finish(iso, status, message=message)
+    return None
+
+def reduce_sdo_images(con_file, mag_file, dop_file, aia_file, mu_thresh=0.1, fit_cbs=False,
+                      geom_cache=None, geometry_backend="sunpy", dtype=np.float64, ledger=None,
+                      reproj_cache=None, ld_method="curve_fit", components=bulk_vel_components,
+                      fit_fraction=1.0, n_clip=0, timer=None, binning=1, design_cache=None,
+                      rings_cache=None):
+    assert exists(get_filename(con_file))
+    assert exists(get_filename(mag_file))
+    assert exists(get_filename(dop_file))
+    assert exists(get_filename(aia_file))
 
     # get the datetime
     iso = get_date(con_file).isoformat()
+    if timer is None:
+        timer = StageTimer(iso)
 
     # make SDOImage instances
     try:
-        con = SDOImage(con_file)
-        mag = SDOImage(mag_file)
-        dop = SDOImage(dop_file)
-        aia = SDOImage(aia_file)
+        with timer.span("read"):
+            con = SDOImage(con_file, dtype=dtype, binning=binning)
+            mag = SDOImage(mag_file, dtype=dtype, binning=binning)
+            dop = SDOImage(dop_file, dtype=dtype, binning=binning)
+            aia = SDOImage(aia_file, dtype=dtype, binning=binning)
     except OSError:
-        print("\t >>> Invalid file, skipping " + iso, flush=True)
+        skip_epoch(iso, "Invalid file", "skipped-invalid", ledger=ledger)
         return None
 
     # check for data quality issue
     if not all(list(map(is_quality_data, [con, mag, dop, aia]))):
-        print("\t >>> Data quality issue, skipping " + iso, flush=True)
+        skip_epoch(iso, "Data quality issue", "skipped-quality", ledger=ledger)
         return None
 
     # calculate geometries
-    dop.calc_geometry()
-    con.inherit_geometry(dop)
-    mag.inherit_geometry(dop)
+    with timer.span("geometry"):
+        dop.calc_geometry(cache=geom_cache, backend=geometry_backend)
+        con.inherit_geometry(dop)
+        mag.inherit_geometry(dop)
 
     # interpolate aia image onto hmi image scale and inherit geometry
-    aia.rescale_to_hmi(con)
+    with timer.span("reproject"):
+        aia.rescale_to_hmi(con, cache=reproj_cache)
+        gc.collect()
 
     # calculate limb darkening/brightening in continuum map and filtergram
+    # (which share their mu rings, at least for this epoch)
+    if rings_cache is None:
+        rings_cache = MuRingsCache()
     try:
-        con.calc_limb_darkening()
-        aia.calc_limb_darkening()
+        with timer.span("limb_darkening"):
+            con.calc_limb_darkening(method=ld_method, rings_cache=rings_cache)
+            aia.calc_limb_darkening(method=ld_method, rings_cache=rings_cache)
     except:
-        print("\t >>> Limb darkening fit failed, skipping " + iso, flush=True)
+        skip_epoch(iso, "Limb darkening fit failed", "failed-ld-fit", ledger=ledger)
         return None
 
     # correct magnetogram for foreshortening
-    mag.correct_magnetogram()
+    with timer.span("magnetogram"):
+        mag.correct_magnetogram()
 
     # calculate differential rot., meridional circ., obs. vel, grav. redshift, cbs
-    dop.correct_dopplergram(fit_cbs=fit_cbs)
+    with timer.span("dopplergram"):
+        dop.correct_dopplergram(fit_cbs=fit_cbs, components=components,
+                                fit_fraction=fit_fraction, n_clip=n_clip,
+                                design_cache=design_cache)
 
     # check that the dopplergram correction went well
-    if np.nanmax(np.abs(dop.v_rot)) < 1000.0:
-        print("\t >>> Dopplergram correction failed, skipping " + iso, flush=True)
+    if np.max(np.abs(dop.v_stats["rot"][:2])) < 1000.0:
+        skip_epoch(iso, "Dopplergram correction failed", "failed-doppler", ledger=ledger)
         return None
 
     # set values to nan for mu less than mu_thresh
-    con.mask_low_mu(mu_thresh)
-    dop.mask_low_mu(mu_thresh)
-    mag.mask_low_mu(mu_thresh)
-    aia.mask_low_mu(mu_thresh)
+    with timer.span("mask_low_mu"):
+        con.mask_low_mu(mu_thresh)
+        dop.mask_low_mu(mu_thresh)
+        mag.mask_low_mu(mu_thresh)
+        aia.mask_low_mu(mu_thresh)
 
     # identify regions for thresholding
     try:
-        mask = SunMask(con, mag, dop, aia)
-        mask.mask_low_mu(mu_thresh)
+        with timer.span("sun_mask"):
+            mask = SunMask(con, mag, dop, aia)
+            mask.mask_low_mu(mu_thresh)
     except:
-        print("\t >>> Region identification failed, skipping " + iso, flush=True)
+        skip_epoch(iso, "Region identification failed", "failed-mask", ledger=ledger)
         return None
 
     return con, mag, dop, aia, mask
 
-def reduce_sdo_images_fast(con_file, mag_file, dop_file, aia_file, mu_thresh=0.1, fit_cbs=False):
-    assert exists(con_file)
-    assert exists(mag_file)
-    assert exists(aia_file)
+def reduce_sdo_images_fast(con_file, mag_file, dop_file, aia_file, mu_thresh=0.1, fit_cbs=False,
+                           geom_cache=None, geometry_backend="sunpy", dtype=np.float64, ledger=None,
+                           reproj_cache=None, ld_method="curve_fit", timer=None, binning=1,
+                           rings_cache=None):
+    assert exists(get_filename(con_file))
+    assert exists(get_filename(mag_file))
+    assert exists(get_filename(aia_file))
 
     # get the datetime
     iso = get_date(con_file).isoformat()
+    if timer is None:
+        timer = StageTimer(iso)
 
     # make SDOImage instances
     try:
-        con = SDOImage(con_file)
-        mag = SDOImage(mag_file)
-        dop = SDOImage(dop_file)
-        aia = SDOImage(aia_file)
+        with timer.span("read"):
+            con = SDOImage(con_file, dtype=dtype, binning=binning)
+            mag = SDOImage(mag_file, dtype=dtype, binning=binning)
+            dop = SDOImage(dop_file, dtype=dtype, binning=binning)
+            aia = SDOImage(aia_file, dtype=dtype, binning=binning)
     except OSError:
-        print("\t >>> Invalid file, skipping " + iso, flush=True)
+        skip_epoch(iso, "Invalid file", "skipped-invalid", ledger=ledger)
         return None
 
     # check for data quality issue
     if not all(list(map(is_quality_data, [con, mag, dop, aia]))):
-        print("\t >>> Data quality issue, skipping " + iso, flush=True)
+        skip_epoch(iso, "Data quality issue", "skipped-quality", ledger=ledger)
         return None
 
     # calculate geometries
-    con.calc_geometry()
-    mag.inherit_geometry(con)
-    dop.inherit_geometry(con)
+    with timer.span("geometry"):
+        con.calc_geometry(cache=geom_cache, backend=geometry_backend)
+        mag.inherit_geometry(con)
+        dop.inherit_geometry(con)
 
     # interpolate aia image onto hmi image scale and inherit geometry
-    aia.rescale_to_hmi(con)
+    with timer.span("reproject"):
+        aia.rescale_to_hmi(con, cache=reproj_cache)
+        gc.collect()
 
     # calculate limb darkening/brightening in continuum map and filtergram
+    # (which share their mu rings, at least for this epoch)
+    if rings_cache is None:
+        rings_cache = MuRingsCache()
     try:
-        con.calc_limb_darkening()
-        aia.calc_limb_darkening()
+        with timer.span("limb_darkening"):
+            con.calc_limb_darkening(method=ld_method, rings_cache=rings_cache)
+            aia.calc_limb_darkening(method=ld_method, rings_cache=rings_cache)
     except:
-        print("\t >>> Limb darkening fit failed, skipping " + iso, flush=True)
+        skip_epoch(iso, "Limb darkening fit failed", "failed-ld-fit", ledger=ledger)
         return None
 
     # correct magnetogram for foreshortening
-    mag.correct_magnetogram()
+    with timer.span("magnetogram"):
+        mag.correct_magnetogram()
 
     # set values to nan for mu less than mu_thresh
-    con.mask_low_mu(mu_thresh)
-    mag.mask_low_mu(mu_thresh)
-    dop.mask_low_mu(mu_thresh)
-    aia.mask_low_mu(mu_thresh)
+    with timer.span("mask_low_mu"):
+        con.mask_low_mu(mu_thresh)
+        mag.mask_low_mu(mu_thresh)
+        dop.mask_low_mu(mu_thresh)
+        aia.mask_low_mu(mu_thresh)
 
     # identify regions for thresholding
     try:
-        mask = SunMask(con, mag, dop, aia)
-        mask.mask_low_mu(mu_thresh)
+        with timer.span("sun_mask"):
+            mask = SunMask(con, mag, dop, aia)
+            mask.mask_low_mu(mu_thresh)
     except:
-        print("\t >>> Region identification failed, skipping " + iso, flush=True)
+        skip_epoch(iso, "Region identification failed", "failed-mask", ledger=ledger)
         return None
 
     return con, mag, aia, mask   
 
 
-def process_data_set_parallel(con_file, mag_file, dop_file, aia_file, mu_thresh, n_rings, datadir):
+def reduce_sdo_images_tiled(epoch, mu_thresh=0.1, fit_cbs=False, geometry_backend="sunpy",
+                            ledger=None, ld_method="curve_fit", timer=None):
+    # the same stages as reduce_sdo_images, worked through in tiles of rows
+    # by epoch (a TiledEpoch); the magnetogram correction and masking of low
+    # mu are done on the fly whenever a tile is loaded
+    iso = get_date(get_filename(epoch.files["con"])).isoformat()
+    if timer is None:
+        timer = StageTimer(iso)
+
+    # check for data quality issue before reading any of the data
+    try:
+        with timer.span("read"):
+            epoch.read_headers()
+            if epoch.is_quality_data():
+                epoch.read()
+    except OSError:
+        skip_epoch(iso, "Invalid file", "skipped-invalid", ledger=ledger)
+        return None
+
+    if not epoch.is_quality_data():
+        skip_epoch(iso, "Data quality issue", "skipped-quality", ledger=ledger)
+        return None
+
+    # calculate geometries
+    with timer.span("geometry"):
+        epoch.calc_geometry(backend=geometry_backend)
+
+    # interpolate aia image onto hmi image scale
+    with timer.span("reproject"):
+        epoch.rescale_aia()
+
+    # calculate limb darkening/brightening in continuum map and filtergram
+    try:
+        with timer.span("limb_darkening"):
+            epoch.calc_limb_darkening(method=ld_method)
+    except:
+        skip_epoch(iso, "Limb darkening fit failed", "failed-ld-fit", ledger=ledger)
+        return None
+
+    # calculate differential rot., meridional circ., obs. vel, grav. redshift, cbs
+    with timer.span("dopplergram"):
+        epoch.correct_dopplergram(fit_cbs=fit_cbs)
+
+    # check that the dopplergram correction went well
+    if np.max(np.abs(epoch.v_stats["rot"][:2])) < 1000.0:
+        skip_epoch(iso, "Dopplergram correction failed", "failed-doppler", ledger=ledger)
+        return None
+
+    # identify regions for thresholding
+    try:
+        with timer.span("sun_mask"):
+            epoch.calc_sun_mask()
+    except:
+        skip_epoch(iso, "Region identification failed", "failed-mask", ledger=ledger)
+        return None
+
+    return epoch
+
+
+def process_data_set_tiled(con_file, mag_file, dop_file, aia_file,
+                           mu_thresh=0.1, n_rings=10, suffix=None, datadir=None,
+                           geometry_backend="sunpy", dtype=np.float64, sink=None,
+                           ledger=None, ld_method="curve_fit", binning=1,
+                           tile_pixels=default_tile_pixels, threads=1, scratchdir=None):
+    # process_data_set with the per-pixel work done in tiles of at most
+    # tile_pixels pixels on threads threads, keeping the images and
+    # products in scratchdir rather than in memory
+
+    # figure out data directories
+    if not isdir(datadir):
+        os.mkdir(datadir)
+
+    # write to the csv output files unless given somewhere else to write
+    if sink is None:
+        sink = CSVSink(get_output_files(datadir, suffix=suffix))
+
+    # start timing the epoch
+    iso = get_date(con_file).isoformat()
+    if ledger is not None:
+        ledger.start(iso)
+    timer = StageTimer(iso)
+    timer.begin("epoch")
+
+    with TiledEpoch((con_file, mag_file, dop_file, aia_file), mu_thresh=mu_thresh, dtype=dtype,
+                    binning=binning, tile_pixels=tile_pixels, threads=threads,
+                    scratchdir=scratchdir) as epoch:
+        # reduce the data set
+        try:
+            reduced = reduce_sdo_images_tiled(epoch, mu_thresh=mu_thresh,
+                                              geometry_backend=geometry_backend,
+                                              ledger=ledger, ld_method=ld_method, timer=timer)
+        except:
+            # record failures that reduce_sdo_images_tiled did not catch itself
+            reduced = None
+            if (ledger is not None) and ledger.pending(iso):
+                ledger.finish(iso, "failed")
+
+        # skipped or failed epochs only have their timings written
+        if reduced is None:
+            sink.write("timings", timer.finish())
+            return None
+
+        # get the MJD of the obs and the results
+        timer.begin("stats")
+        mjd = Time(epoch.date_obs).mjd
+        thresholds = epoch.thresholds(mjd)
+        results = epoch.calc_stats(mjd, n_rings=n_rings)
+        timer.end()
+
+    # write to disk, then mark the epoch as done (the thresholds row goes
+    # last, so an epoch with one has all of its region rows written)
+    with timer.span("write"):
+        sink.write("region_output", results)
+        sink.write("thresholds", [thresholds])
+    sink.write("timings", timer.finish())
+    if ledger is not None:
+        ledger.finish(iso, "done")
+
+    # report success and return
+    print("\t >>> Epoch %s run successfully" % iso, flush=True)
+    return None
+
+
+def process_data_set_parallel(con_file, mag_file, dop_file, aia_file, mu_thresh, n_rings, datadir,
+                              geom_cache=False, cachedir=None, geometry_backend="sunpy",
+                              dtype=np.float64, sink=None, ledger=None, reproj_cache=False,
+                              ld_method="curve_fit", binning=1):
+    # each worker keeps its own geometry and reprojection caches across epochs
+    if geom_cache:
+        geom_cache = get_geometry_cache(cachedir=cachedir, dtype=dtype)
+    else:
+        geom_cache = None
+
+    if reproj_cache:
+        reproj_cache = get_reprojection_cache(cachedir=cachedir, dtype=dtype)
+    else:
+        reproj_cache = None
+
     process_data_set(con_file, mag_file, dop_file, aia_file,
                      mu_thresh=mu_thresh, n_rings=n_rings,
-                     suffix=str(mp.current_process().pid), datadir=datadir)
+                     suffix=str(mp.current_process().pid), datadir=datadir,
+                     geom_cache=geom_cache, geometry_backend=geometry_backend,
+                     dtype=dtype, sink=sink, ledger=ledger, reproj_cache=reproj_cache,
+                     ld_method=ld_method, binning=binning)
+    return None
+
+
+def process_batch(epochs, mu_thresh, n_rings, datadir, batch_tol=1.0, suffix=None,
+                  geometry_backend="sunpy", dtype=np.float64, prefetch=1, sink=None,
+                  ledger=None, ld_method="curve_fit", binning=1):
+    # process a group of consecutive epochs, sharing the work that only
+    # depends on the geometry between epochs whose headers agree to within
+    # batch_tol (times the cache tolerances, or a dict of tolerances)
+    batch = EpochBatch(get_date(epochs[0][0]).isoformat(), tolerances=batch_tolerances(batch_tol), dtype=dtype)
+    with EpochPrefetcher(epochs, dtype=dtype, depth=prefetch) as prefetcher:
+        for con_file, mag_file, dop_file, aia_file in prefetcher:
+            process_data_set(con_file, mag_file, dop_file, aia_file,
+                             mu_thresh=mu_thresh, n_rings=n_rings, suffix=suffix,
+                             datadir=datadir, geometry_backend=geometry_backend,
+                             dtype=dtype, sink=sink, ledger=ledger, ld_method=ld_method,
+                             binning=binning, **batch.caches())
+            batch.n_epochs += 1
+
+    # report what was reused and let go of the shared arrays
+    batch.report()
+    counts = batch.counts()
+    batch.close()
+    return counts
+
+
+def process_epochs_parallel(epochs, mu_thresh, n_rings, datadir,
+                            geom_cache=False, cachedir=None, geometry_backend="sunpy",
+                            dtype=np.float64, prefetch=1, reproj_cache=False, ld_method="curve_fit",
+                            binning=1, batch_tol=None, tile_pixels=None, tile_threads=1):
+    # keep results and epoch statuses in memory and hand them back to the
+    # parent, which is the only process that writes output
+    sink = RecordSink()
+    ledger = MemoryLedger()
+
+    # work through each epoch in tiles (prefetching whole images, or
+    # caching whole-image geometry, would defeat the point)
+    if tile_pixels is not None:
+        for con_file, mag_file, dop_file, aia_file in epochs:
+            process_data_set_tiled(con_file, mag_file, dop_file, aia_file,
+                                   mu_thresh=mu_thresh, n_rings=n_rings,
+                                   suffix=str(mp.current_process().pid), datadir=datadir,
+                                   geometry_backend=geometry_backend, dtype=dtype, sink=sink,
+                                   ledger=ledger, ld_method=ld_method, binning=binning,
+                                   tile_pixels=tile_pixels, threads=tile_threads)
+        return sink.writes, ledger.rows
+
+    # the chunk is a batch of epochs that share their geometry
+    if batch_tol is not None:
+        process_batch(epochs, mu_thresh, n_rings, datadir, batch_tol=batch_tol,
+                      suffix=str(mp.current_process().pid), geometry_backend=geometry_backend,
+                      dtype=dtype, prefetch=prefetch, sink=sink, ledger=ledger,
+                      ld_method=ld_method, binning=binning)
+        return sink.writes, ledger.rows
+
+    # process a chunk of epochs on one worker, reading the next epoch's
+    # files in the background while the current one is processed
+    with EpochPrefetcher(epochs, dtype=dtype, depth=prefetch) as prefetcher:
+        for con_file, mag_file, dop_file, aia_file in prefetcher:
+            process_data_set_parallel(con_file, mag_file, dop_file, aia_file,
+                                      mu_thresh, n_rings, datadir,
+                                      geom_cache=geom_cache, cachedir=cachedir,
+                                      geometry_backend=geometry_backend, dtype=dtype,
+                                      sink=sink, ledger=ledger, reproj_cache=reproj_cache,
+                                      ld_method=ld_method, binning=binning)
+    return sink.writes, ledger.rows
+
+
+def init_worker(geom_cache=False, cachedir=None, reproj_cache=False, dtype=np.float64):
+    # the heavy modules are imported along with this one; set up the state
+    # each worker keeps across epochs (empty geometry and reprojection
+    # caches in the working precision, which fill up with the first epoch
+    # or, with a cachedir, from disk as entries are asked for)
+    if geom_cache:
+        get_geometry_cache(cachedir=cachedir, dtype=dtype)
+    if reproj_cache:
+        get_reprojection_cache(cachedir=cachedir, dtype=dtype)
+    return None
+
+
+def process_epochs_star(args):
+    # a chunk of epochs and the keyword arguments to process it with
+    epochs, kwargs = args
+    return process_epochs_parallel(epochs, **kwargs)
+
+
+def commit_records(sink, writes, ledger=None, rows=None):
+    # write the results first so an epoch is never marked done without them,
+    # and the thresholds row after the region rows it vouches for
+    for table, table_rows in sorted(writes, key=lambda write: write[0] == "thresholds"):
+        sink.write(table, table_rows)
+    if (ledger is not None) and rows:
+        ledger.insert(rows)
     return None
 
 
 def process_data_set(con_file, mag_file, dop_file, aia_file,
-                     mu_thresh=0.1, n_rings=10, suffix=None, datadir=None):
+                     mu_thresh=0.1, n_rings=10, suffix=None, datadir=None,
+                     geom_cache=None, geometry_backend="sunpy", dtype=np.float64,
+                     sink=None, ledger=None, reproj_cache=None, ld_method="curve_fit",
+                     binning=1, design_cache=None, rings_cache=None, index_cache=None):
 
     # figure out data directories
     if not isdir(datadir):
         os.mkdir(datadir)
 
-    # name output files
-    if suffix is None:
-        fname1 = datadir + "thresholds.csv"
-        fname2 = datadir + "region_output.csv"
-    else:
-        # make tmp directory
-        tmpdir = datadir + "tmp/"
+    # write to the csv output files unless given somewhere else to write
+    if sink is None:
+        sink = CSVSink(get_output_files(datadir, suffix=suffix))
 
-        # filenames
-        fname1 = tmpdir + "thresholds_" + suffix + ".csv"
-        fname2 = tmpdir + "region_output_" + suffix + ".csv"
-
-        # check if the files exist, create otherwise
-        for file in (fname1, fname2):
-            if not exists(file):
-                create_file(file)
+    # start timing the epoch
+    iso = get_date(con_file).isoformat()
+    if ledger is not None:
+        ledger.start(iso)
+    timer = StageTimer(iso)
+    timer.begin("epoch")
 
     # reduce the data set
     try:
         con, mag, dop, aia, mask = reduce_sdo_images(con_file, mag_file,
                                                      dop_file, aia_file,
-                                                      mu_thresh=mu_thresh)
+                                                     mu_thresh=mu_thresh,
+                                                     geom_cache=geom_cache,
+                                                     geometry_backend=geometry_backend,
+                                                     dtype=dtype, ledger=ledger,
+                                                     reproj_cache=reproj_cache,
+                                                     ld_method=ld_method,
+                                                     components=("rot",),
+                                                     timer=timer, binning=binning,
+                                                     design_cache=design_cache,
+                                                     rings_cache=rings_cache)
     except:
+        # record failures that reduce_sdo_images did not catch itself
+        if (ledger is not None) and ledger.pending(iso):
+            ledger.finish(iso, "failed")
+        sink.write("timings", timer.finish())
         return None
 
     # get the MJD of the obs
+    timer.begin("stats")
     mjd = Time(con.date_obs).mjd
 
-    # write the limb darkening parameters, velocities, etc. to disk
-    write_results_to_file(fname1, mjd, mask.aia_thresh, *aia.ld_coeffs,
-                          mask.con_thresh1, mask.con_thresh2, *con.ld_coeffs,
-                          np.nanmax(dop.v_cbs),
-                          np.nanmin(dop.v_obs), np.nanmax(dop.v_obs), np.nanmean(dop.v_obs),
-                          np.nanmin(dop.v_rot), np.nanmax(dop.v_rot), np.nanmean(dop.v_rot),
-                          np.nanmin(dop.v_mer), np.nanmax(dop.v_mer), np.nanmean(dop.v_mer))
+    # the limb darkening parameters, velocities, etc.
+    thresholds = [mjd, mask.aia_thresh, *aia.ld_coeffs,
+                  mask.con_thresh1, mask.con_thresh2, *con.ld_coeffs,
+                  dop.v_stats["cbs"][1],
+                  np.nanmin(dop.v_obs), np.nanmax(dop.v_obs), np.nanmean(dop.v_obs),
+                  *dop.v_stats["rot"], *dop.v_stats["mer"]]
 
     # create arrays to hold velocity magnetic fiel, and pixel fraction results
     results = []
 
+    # work out the masks, labels, and sums shared by all regions once
+    mu_grid = np.linspace(mu_thresh, 1.0, n_rings)
+    pre = EpochPrecompute(con, mask, mu_grid=mu_grid, index_cache=index_cache)
+
     # calculate number of pixels and total light
-    all_pixels = np.nansum(con.mu >= mu_thresh)
-    all_light = np.nansum(con.image * (con.mu >= mu_thresh))
+    all_pixels = pre.npix
+    all_light = pre.light
 
     # calculate disk-integrated velocities, mag field, and intensity
-    vels = calc_velocities(con, mag, dop, aia, mask)
-    mags = calc_mag_stats(con, mag)
-    ints = calc_int_stats(con)
+    vels = calc_velocities(con, mag, dop, aia, mask, pre=pre)
+    mags = calc_mag_stats(con, mag, pre=pre)
+    ints = calc_int_stats(con, pre=pre)
 
     # append full-disk results
     results.append([mjd, np.nan, np.nan, np.nan, all_pixels, all_light, *vels, mags, *ints])
 
-    # loop over the mu annuli
-    mu_grid = np.linspace(mu_thresh, 1.0, n_rings)
-    regions = [1, 2, 2.5, 3, 4, 5, 6]
-    for j in range(n_rings-1):
-        # mu values for annuli
-        lo_mu=mu_grid[j]
-        hi_mu=mu_grid[j+1]
-
-        # compute the region mask
-        region_mask = calc_region_mask(mask, region=None, hi_mu=hi_mu, lo_mu=lo_mu)
-
-        # compute quiet-sun velocity in mu annulus
-        v_quiet = np.nansum(dop.v_corr * con.image * mask.is_quiet_sun() * region_mask)
-        v_quiet /= np.nansum(con.image * mask.is_quiet_sun() * region_mask)
-
-        # loop over unique region identifiers
-        for k in regions:
-            # compute the region mask
-            region_mask = calc_region_mask(mask, region=k, hi_mu=hi_mu, lo_mu=lo_mu)
-
-            # get total pix and light
-            pixels = np.nansum(region_mask)/all_pixels
-            light = np.nansum(region_mask * con.image)/all_light
-
-            if ((pixels == 0.0) | (light == 0.0)):
-                vels = [0.0, 0.0, 0.0, 0.0]
-                mags = 0.0
-                ints = [0.0, 0.0]
-                results.append([mjd, k, lo_mu, hi_mu, pixels, light, *vels, mags, *ints])
-                continue
-
-            # compute velocity components in each mu annulus by region
-            if k != 4:
-                # case where region is quiet sun, return zero for v_quiet
-                vels = calc_velocities(con, mag, dop, aia, mask, region_mask=region_mask, v_quiet=v_quiet)
-            else:
-                # case where region is quiet sun, return nonzero v_quiet
-                vels = calc_velocities(con, mag, dop, aia, mask, region_mask=region_mask, v_quiet=None)
-
-            # calculate mag and intensity stats
-            mags = calc_mag_stats(con, mag, region_mask=region_mask)
-            ints = calc_int_stats(con, region_mask=region_mask)
-
-            # append the velocity results
-            results.append([mjd, k, lo_mu, hi_mu, pixels, light, *vels, mags, *ints])
-
-    # write to disk
-    write_results_to_file(fname2, results)
+    # get weighted sums for every mu annulus and region in one pass
+    stats = calc_region_stats(con, mag, dop, mask, mu_grid, pre=pre)
+    results += calc_region_results(mjd, stats, mu_grid, all_pixels, all_light)
+
+    timer.end()
+
+    # write to disk, then mark the epoch as done (the thresholds row goes
+    # last, so an epoch with one has all of its region rows written)
+    with timer.span("write"):
+        sink.write("region_output", results)
+        sink.write("thresholds", [thresholds])
+    sink.write("timings", timer.finish())
+    if ledger is not None:
+        ledger.finish(iso, "done")
 
     # do some memory cleanup
     del con
@@ -267,12 +527,11 @@ def process_data_set(con_file, mag_file, dop_file, aia_file,
     del mags
     del ints
     del results
-    del regions
     del mu_grid
-    del v_quiet
-    del region_mask
+    del stats
+    del pre
     gc.collect()
 
     # report success and return
-    print("\t >>> Epoch %s run successfully" % get_date(con_file).isoformat(), flush=True)
+    print("\t >>> Epoch %s run successfully" % iso, flush=True)
     return None
@@ -0,0 +1,91 @@
+import numpy as np
+from astropy.wcs import WCS
+from astropy.wcs.utils import pixel_to_pixel
+from scipy.ndimage import map_coordinates
+from reproject import reproject_interp
+
+from .sdo_geometry import *
+
+# names of the arrays of a reprojection map (input pixel coordinates)
+reprojection_names = ("y", "x")
+
+def gen_row_blocks(nrows, block_size=512):
+    for start in range(0, nrows, block_size):
+        yield slice(start, min(start + block_size, nrows))
+
+def calc_reprojection_map(head_in, head_out, block_size=512, rows=None):
+    # input pixel coordinates of every output pixel (or of those in a slice
+    # of rows), computed the same way as reproject_interp does (including
+    # its round-trip check)
+    wcs_in = WCS(head_in)
+    wcs_out = WCS(head_out)
+    if rows is None:
+        rows = slice(0, head_out["NAXIS2"])
+    ny, nx = rows.stop - rows.start, head_out["NAXIS1"]
+    rmap = {"y": np.empty((ny, nx)), "x": np.empty((ny, nx))}
+
+    # work in blocks of rows to bound the size of temporaries
+    xx = np.arange(nx, dtype=float)
+    for sl in gen_row_blocks(ny, block_size=block_size):
+        x_out, y_out = np.meshgrid(xx, np.arange(rows.start + sl.start, rows.start + sl.stop, dtype=float))
+        x_in, y_in = [np.array(c, dtype=float) for c in pixel_to_pixel(wcs_out, wcs_in, x_out, y_out)]
+
+        # coordinates that do not map back to where they came from are nan
+        x_chk, y_chk = pixel_to_pixel(wcs_in, wcs_out, x_in, y_in)
+        reset = (np.abs(x_chk - x_out) > 1) | (np.abs(y_chk - y_out) > 1)
+        x_in[reset] = np.nan
+        y_in[reset] = np.nan
+        rmap["y"][sl] = y_in
+        rmap["x"][sl] = x_in
+
+    # move coordinates in the outer half of border pixels onto the border
+    for n, size in zip(reprojection_names, (head_in["NAXIS2"], head_in["NAXIS1"])):
+        coords = rmap[n]
+        coords[(coords < 0) & (coords >= -0.5)] = 0
+        coords[(coords < size - 0.5) & (coords >= size - 1)] = size - 1
+    return rmap
+
+def apply_reprojection_map(image, rmap, dtype=np.float64, block_size=512):
+    # bilinear interpolation at the mapped coordinates, nan outside the image
+    if (image.dtype.kind != "f") or (image.dtype.itemsize < 4):
+        image = image.astype(np.float32)
+
+    out = np.empty(rmap["y"].shape, dtype=dtype)
+    for sl in gen_row_blocks(out.shape[0], block_size=block_size):
+        coords = np.array([rmap["y"][sl], rmap["x"][sl]], dtype=np.float64)
+        map_coordinates(image, coords, output=out[sl], order=1, mode="constant", cval=np.nan)
+    return out
+
+def compare_reprojection(image, head_in, head_out, rmap=None):
+    # differences between the map-based and reproject_interp reprojections
+    if rmap is None:
+        rmap = calc_reprojection_map(head_in, head_out)
+    image1 = reproject_interp((image, head_in), head_out, return_footprint=False)
+    image2 = apply_reprojection_map(image, rmap)
+
+    diffs = {}
+    diffs["nan_mismatch"] = np.sum(np.isnan(image1) != np.isnan(image2))
+    diffs["max_abs"] = np.nanmax(np.abs(image1 - image2))
+    diffs["max_rel"] = np.nanmax(np.abs(image1 - image2) / np.abs(image1))
+    return diffs
+
+class ReprojectionCache(GeometryCache):
+    # LRU (and optional on-disk) store of reprojection maps, keyed by the
+    # quantized geometry of both the input and the output headers
+    names = reprojection_names
+    prefix = "reproj_"
+
+    def key(self, head_in, head_out):
+        return ("reproject",) + self.head_key(head_in) + self.head_key(head_out)
+
+# process-wide cache so a worker reuses maps across the epochs it handles
+# (made again if it is asked for with other arguments)
+_reprojection_cache = None
+_reprojection_cache_args = None
+
+def get_reprojection_cache(**kwargs):
+    global _reprojection_cache, _reprojection_cache_args
+    if (_reprojection_cache is None) or (cache_args(kwargs) != _reprojection_cache_args):
+        _reprojection_cache = ReprojectionCache(**kwargs)
+        _reprojection_cache_args = cache_args(kwargs)
+    return _reprojection_cache
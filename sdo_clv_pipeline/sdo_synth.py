@@ -0,0 +1,187 @@
+import numpy as np
+import datetime as dt
+import os
+from astropy.io import fits
+
+# signals injected into the synthetic frames
+synth_params = {# quadratic limb darkening (b, c) of quad_darkening, and disk-center intensity
+                "ld_con": (0.38, 0.23), "int_con": 60000.0,
+                "ld_aia": (0.9, -0.25), "int_aia": 1000.0,
+                # sidereal differential rotation A + B sin^2 + C sin^4 (deg/day)
+                "rot": (14.713, -2.396, -1.787),
+                # gravitational redshift and convective blueshift at disk center (m/s)
+                "v_grav": 633.0, "v_cbs": -300.0,
+                # spots as (x, y, radius) in solar radii on the disk; the
+                # umbra is the inner 40% and plage reaches out to 3 radii
+                "spots": ((0.2, 0.1, 0.03), (-0.4, -0.25, 0.02), (0.5, -0.3, 0.015)),
+                "B_umbra": 2500.0, "B_penumbra": 1200.0, "B_plage": 300.0,
+                # noise (relative for intensities, G and m/s otherwise)
+                "noise_con": 0.01, "noise_aia": 0.05, "noise_mag": 8.0, "noise_dop": 50.0}
+
+# observer geometry and velocity at the first epoch
+synth_observer = {"CRLN_OBS": 120.0, "CRLT_OBS": -3.2, "DSUN_OBS": 1.4712e11,
+                  "OBS_VR": -800.0, "OBS_VW": 30000.0, "OBS_VN": 50.0}
+
+# products and their header contents
+synth_products = {"con": ("SDO/HMI", "CONTINUUM INTENSITY"),
+                  "mag": ("SDO/HMI", "MAGNETOGRAM"),
+                  "dop": ("SDO/HMI", "DOPPLERGRAM"),
+                  "aia": ("SDO/AIA", None)}
+
+# pixel scales (arcsec) at 4096 x 4096
+hmi_cdelt = 0.504
+aia_cdelt = 0.6
+
+# nominal solar radius (m)
+rsun_ref = 6.96e8
+
+def synth_filename(product, date):
+    # names that find_data and get_date understand
+    if product == "aia":
+        return "aia_lev1_1700a_" + date.strftime("%Y_%m_%dt%H_%M_%S") + "_12z_image_lev1.fits"
+    name = {"con": "hmi.ic_720s.%s_TAI.3.continuum.fits",
+            "mag": "hmi.m_720s.%s_TAI.3.magnetogram.fits",
+            "dop": "hmi.v_720s.%s_TAI.3.Dopplergram.fits"}[product]
+    return name % date.strftime("%Y%m%d_%H%M%S")
+
+def synth_header(product, n, date, observer=synth_observer, quality=0):
+    telescope, content = synth_products[product]
+    cdelt = (aia_cdelt if product == "aia" else hmi_cdelt) * 4096 / n
+    dsun = observer["DSUN_OBS"]
+
+    head = fits.Header()
+    head["NAXIS"] = 2
+    head["NAXIS1"] = n
+    head["NAXIS2"] = n
+    head["CTYPE1"] = "HPLN-TAN"
+    head["CTYPE2"] = "HPLT-TAN"
+    head["CUNIT1"] = "arcsec"
+    head["CUNIT2"] = "arcsec"
+    head["CRPIX1"] = (n + 1) / 2 + 0.3
+    head["CRPIX2"] = (n + 1) / 2 - 0.2
+    head["CRVAL1"] = 0.0
+    head["CRVAL2"] = 0.0
+    head["CDELT1"] = cdelt
+    head["CDELT2"] = cdelt
+    head["CROTA2"] = 0.0
+    head["DATE-OBS"] = date.isoformat()
+    head["T_OBS"] = date.isoformat()
+    head["CRLN_OBS"] = observer["CRLN_OBS"]
+    head["CRLT_OBS"] = observer["CRLT_OBS"]
+    head["HGLN_OBS"] = 0.0
+    head["HGLT_OBS"] = observer["CRLT_OBS"]
+    head["DSUN_OBS"] = dsun
+    head["DSUN_REF"] = 1.495978707e11
+    head["RSUN_OBS"] = np.rad2deg(np.arcsin(rsun_ref / dsun)) * 3600.0
+    head["RSUN_REF"] = rsun_ref
+    head["OBS_VR"] = observer["OBS_VR"]
+    head["OBS_VW"] = observer["OBS_VW"]
+    head["OBS_VN"] = observer["OBS_VN"]
+    head["TELESCOP"] = telescope
+    if content is not None:
+        head["CONTENT"] = content
+    if telescope == "SDO/AIA":
+        head["QUALLEV0"] = quality
+    else:
+        head["QUALLEV1"] = quality
+    return head
+
+def disk_coords(head):
+    # plane-of-sky coordinates in solar radii (x to the west, y to the north)
+    scale = head["CDELT1"] / head["RSUN_OBS"]
+    x = (np.arange(head["NAXIS1"]) + 1.0 - head["CRPIX1"]) * scale
+    y = (np.arange(head["NAXIS2"]) + 1.0 - head["CRPIX2"]) * scale
+    return x[np.newaxis, :], y[:, np.newaxis]
+
+def spot_masks(x, y, params=synth_params):
+    umbra = np.zeros(np.broadcast(x, y).shape, dtype=bool)
+    penumbra = np.zeros_like(umbra)
+    plage = np.zeros_like(umbra)
+    for sx, sy, rad in params["spots"]:
+        d = np.sqrt((x - sx)**2 + (y - sy)**2)
+        umbra |= d < 0.4 * rad
+        penumbra |= (d >= 0.4 * rad) & (d < rad)
+        plage |= (d >= rad) & (d < 3.0 * rad)
+    return umbra, penumbra, plage
+
+def quad_law(mu, coeffs):
+    b, c = coeffs
+    return 1.0 - b * (1.0 - mu) - c * (1.0 - mu)**2
+
+def synth_image(product, head, params=synth_params, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
+
+    # orthographic projection is plenty at the precision we need
+    x, y = disk_coords(head)
+    r2 = x**2 + y**2
+    on_disk = r2 < 1.0
+    mu = np.sqrt(np.clip(1.0 - r2, 0.0, None))
+    umbra, penumbra, plage = spot_masks(x, y, params=params)
+    noise = rng.standard_normal(mu.shape)
+
+    if product == "con":
+        image = params["int_con"] * quad_law(mu, params["ld_con"])
+        image *= np.where(umbra, 0.3, np.where(penumbra, 0.75, 1.0))
+        image *= 1.0 + params["noise_con"] * noise
+    elif product == "aia":
+        image = params["int_aia"] * quad_law(mu, params["ld_aia"])
+        image *= 1.0 + np.where(plage, 0.6, 0.0) + np.where(umbra | penumbra, 0.3, 0.0)
+        image *= 1.0 + params["noise_aia"] * noise
+    elif product == "mag":
+        # radial field seen along the line of sight
+        B_r = np.where(umbra, params["B_umbra"], 0.0) + np.where(penumbra, params["B_penumbra"], 0.0)
+        B_r += np.where(plage, params["B_plage"] * np.sign(x + 0.05), 0.0)
+        image = B_r * mu + params["noise_mag"] * noise
+    else:
+        # heliographic latitude for an observer at latitude B0
+        B0 = np.deg2rad(head["CRLT_OBS"])
+        sin_lat = np.clip(y * np.cos(B0) + mu * np.sin(B0), -1.0, 1.0)
+
+        # line-of-sight differential rotation (positive away from us)
+        A, B, C = params["rot"]
+        omega = np.deg2rad(A + B * sin_lat**2 + C * sin_lat**4) / 86400.0
+        image = omega * head["RSUN_REF"] * x * np.cos(B0)
+
+        # spacecraft motion, projected the same way as calc_spacecraft_vel
+        sig = np.arctan(np.sqrt(r2) * head["RSUN_REF"] / head["DSUN_OBS"])
+        chi = np.arctan2(x, y)
+        image -= (head["OBS_VR"] * np.cos(sig) -
+                  head["OBS_VW"] * np.sin(sig) * np.sin(chi) -
+                  head["OBS_VN"] * np.sin(sig) * np.cos(chi))
+
+        # gravitational redshift, convective blueshift and noise
+        image += params["v_grav"] + params["v_cbs"] * mu + params["noise_dop"] * noise
+
+    image[~on_disk] = np.nan
+    return image.astype(np.float32)
+
+def write_synth_epoch(outdir, n=4096, date=dt.datetime(2014, 1, 1), params=synth_params,
+                      observer=synth_observer, seed=0, quality=0):
+    # writes the four (tile-compressed) files of one epoch and returns
+    # their names in find_data order (con, mag, dop, aia)
+    os.makedirs(outdir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    files = []
+    for product in ("con", "mag", "dop", "aia"):
+        head = synth_header(product, n, date, observer=observer, quality=quality)
+        hdu = fits.CompImageHDU(synth_image(product, head, params=params, rng=rng), header=head)
+        fname = os.path.join(outdir, synth_filename(product, date))
+        fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(fname, overwrite=True)
+        files.append(fname)
+    return files
+
+def write_synth_data(outdir, n=4096, n_epochs=1, start=dt.datetime(2014, 1, 1), cadence=3600.0,
+                     params=synth_params, seed=0, bad_epochs=()):
+    # a run of epochs with the observer moving along in carrington
+    # longitude; epochs in bad_epochs get a nonzero quality flag
+    epochs = []
+    for i in range(n_epochs):
+        date = start + dt.timedelta(seconds=i * cadence)
+        observer = dict(synth_observer)
+        observer["CRLN_OBS"] = (synth_observer["CRLN_OBS"] - 13.2 * i * cadence / 86400.0) % 360.0
+        quality = 1024 if i in bad_epochs else 0
+        epochs.append(write_synth_epoch(outdir, n=n, date=date, params=params, observer=observer,
+                                        seed=seed + i, quality=quality))
+    return epochs
@@ -0,0 +1,588 @@
+import numpy as np
+import os, shutil, tempfile, warnings
+from scipy import ndimage
+from concurrent.futures import ThreadPoolExecutor
+from sunpy.util.exceptions import SunpyUserWarning
+
+from .sdo_io import *
+from .sdo_vels import *
+from .sdo_image import *
+from .limbdark import *
+from .legendre import *
+from .sdo_geometry import *
+from .sdo_reproject import *
+
+# rows of tiles that are all off the disk come out as nan, as they should
+warnings.filterwarnings("ignore", message="The conversion of these 2D helioprojective coordinates to 3D is all NaNs",
+                        category=SunpyUserWarning)
+
+# pixels in a tile (e.g. 256 rows of a 4096 x 4096 image), which sets the
+# memory of a thread whatever the size of the images
+default_tile_pixels = 2**20
+
+# products that are set to nan below mu_thresh (see SDOImage.mask_low_mu)
+masked_products = ("con", "mag", "dop", "aia", "con_ldark", "con_iflat", "aia_ldark", "aia_iflat")
+
+def gen_tiles(shape, tile_pixels=default_tile_pixels):
+    # slices of rows of an image holding at most tile_pixels pixels each
+    # (but always at least one row)
+    return list(gen_row_blocks(shape[0], block_size=max(1, tile_pixels // shape[1])))
+
+def add_sums(parts):
+    # add up the partial sums (scalars or arrays) of the tiles in tile order
+    total = dict(parts[0])
+    for part in parts[1:]:
+        for k, v in part.items():
+            total[k] = total[k] + v
+    return total
+
+def seam_pairs(last, first):
+    # labels that touch across the seam between the last row of a tile and
+    # the first row of the next (8-connectivity, so diagonals count)
+    n = last.size
+    pairs = []
+    for dx in (-1, 0, 1):
+        a = last[max(0, -dx):n - max(0, dx)]
+        b = first[max(0, dx):n - max(0, -dx)]
+        touch = (a > 0) & (b > 0)
+        pairs.append(np.stack([a[touch], b[touch]], axis=1))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+def merge_tile_labels(tiles):
+    # union-find over the labels of all tiles (numbered one after the other
+    # from the offsets of the tiles), joining labels that meet at the seams;
+    # returns the offsets and the root label of every label
+    offsets = np.cumsum([0] + [t["nlabels"] for t in tiles])
+    parent = np.arange(offsets[-1] + 1)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i in range(len(tiles) - 1):
+        for a, b in seam_pairs(tiles[i]["last"], tiles[i+1]["first"]):
+            ra = find(a + offsets[i])
+            rb = find(b + offsets[i+1])
+            if ra != rb:
+                parent[max(ra, rb)] = min(ra, rb)
+
+    # point every label straight at its root
+    while True:
+        roots = parent[parent]
+        if np.array_equal(roots, parent):
+            break
+        parent = roots
+    return offsets, parent
+
+class TileStore(object):
+    # per-pixel arrays of an epoch, kept in flat files in a scratch directory
+    # and read or written a slice of rows at a time, so only the tiles being
+    # worked on are ever in memory
+    def __init__(self, scratchdir=None):
+        self.dir = tempfile.mkdtemp(prefix="sdo_tiles_", dir=scratchdir)
+        self.arrays = {}
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return None
+
+    def path(self, name):
+        return os.path.join(self.dir, name + ".bin")
+
+    def create(self, name, shape, dtype):
+        self.arrays[name] = (tuple(shape), np.dtype(dtype))
+        with open(self.path(name), "wb") as f:
+            f.truncate(shape[0] * shape[1] * np.dtype(dtype).itemsize)
+        return None
+
+    def read(self, name, rows):
+        (ny, nx), dtype = self.arrays[name]
+        with open(self.path(name), "rb") as f:
+            f.seek(rows.start * nx * dtype.itemsize)
+            data = np.fromfile(f, dtype=dtype, count=(rows.stop - rows.start) * nx)
+        return data.reshape(-1, nx)
+
+    def write(self, name, rows, data):
+        (ny, nx), dtype = self.arrays[name]
+        with open(self.path(name), "r+b") as f:
+            f.seek(rows.start * nx * dtype.itemsize)
+            np.ascontiguousarray(data, dtype=dtype).tofile(f)
+        return None
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+        self.arrays = {}
+        return None
+
+class TiledEpoch(object):
+    # one epoch worked through in tiles of rows: the images and every
+    # per-pixel product live in a TileStore, each stage is a pass over the
+    # tiles (on a pool of threads) that writes its products back and hands
+    # back partial sums, and whatever needs the whole disk (fits,
+    # thresholds, region areas) is worked out from those sums
+    def __init__(self, files, mu_thresh=0.1, dtype=np.float64, binning=1,
+                 tile_pixels=default_tile_pixels, threads=1, scratchdir=None):
+        self.files = dict(zip(("con", "mag", "dop", "aia"), [as_sdo_file(f) for f in files]))
+        self.mu_thresh = mu_thresh
+        self.dtype = np.dtype(dtype)
+        self.binning = binning
+        self.tile_pixels = tile_pixels
+        self.store = TileStore(scratchdir=scratchdir)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.ld_coeffs = {}
+        self.ld_profile = {}
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return None
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        self.store.close()
+        return None
+
+    def map(self, func, tiles=None):
+        # run func on every tile, handing back the results in tile order
+        if tiles is None:
+            tiles = self.tiles
+        return list(self.pool.map(func, tiles))
+
+    def read_headers(self):
+        # headers of the (binned) images, the data are only read by read()
+        self.heads = {}
+        for name, f in self.files.items():
+            with f:
+                self.heads[name] = bin_header(f.header, self.binning)
+        head = self.heads["con"]
+        self.shape = (head["NAXIS2"], head["NAXIS1"])
+        self.tiles = gen_tiles(self.shape, tile_pixels=self.tile_pixels)
+        self.date_obs = head["DATE-OBS"]
+        return None
+
+    def is_quality_data(self):
+        return all(get_header_quality(head) == 0 for head in self.heads.values())
+
+    def read(self):
+        # stream every image into the store a tile at a time, one thread
+        # per file (a file handle is not shared between threads)
+        def read_file(name):
+            shape = (self.heads[name]["NAXIS2"], self.heads[name]["NAXIS1"])
+            with self.files[name] as f:
+                for sl in gen_tiles(shape, tile_pixels=self.tile_pixels):
+                    self.store.write(name, sl, f.read_rows(sl, dtype=self.dtype, binning=self.binning))
+            return None
+
+        for name, head in self.heads.items():
+            self.store.create(name, (head["NAXIS2"], head["NAXIS1"]), self.dtype)
+        self.map(read_file, tiles=list(self.heads.keys()))
+        return None
+
+    def load(self, sl, *names):
+        # products of the pixels in a slice of rows as the in-memory pipeline
+        # has them after mask_low_mu; the limb darkening, flattened images
+        # and corrected magnetogram are made on the fly
+        mu = self.store.read("mu", sl)
+        low = np.logical_or(mu < self.mu_thresh, np.isnan(mu))
+        tile = {}
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for n in names:
+                if n == "mu":
+                    tile[n] = mu
+                elif n.endswith("_ldark") or n.endswith("_iflat"):
+                    prod = n.split("_")[0]
+                    ldark = quad_darkening_two(mu, *self.ld_coeffs[prod][1:])
+                    tile[n] = ldark if n.endswith("_ldark") else self.store.read(prod, sl) / ldark
+                elif n == "mag":
+                    tile[n] = self.store.read("mag", sl) / mu
+                elif n == "B_obs":
+                    tile[n] = self.store.read("mag", sl)
+                else:
+                    tile[n] = self.store.read(n, sl)
+
+                if n in masked_products:
+                    tile[n][low] = np.nan
+        return tile
+
+    def calc_geometry(self, backend="sunpy"):
+        # geometry of the dopplergram, shared by every image
+        head = self.heads["dop"]
+        for n in geometry_names:
+            self.store.create(n, self.shape, self.dtype)
+
+        def geometry_tile(sl):
+            geom = calc_geometry_backend(self.store.read("dop", sl), head, backend=backend, rows=sl)
+            for n in geometry_names:
+                self.store.write(n, sl, geom[n])
+            return None
+
+        self.map(geometry_tile)
+        return None
+
+    def rescale_aia(self):
+        # interpolate the aia image onto the hmi pixels, reading only the
+        # rows of the aia image each tile maps onto
+        head_in = self.heads["aia"]
+        head_out = self.heads["con"]
+        self.store.create("aia_hmi", self.shape, self.dtype)
+
+        def reproject_tile(sl):
+            rmap = calc_reprojection_map(head_in, head_out, rows=sl)
+            out = np.full(rmap["y"].shape, np.nan, dtype=self.dtype)
+
+            # bilinear interpolation needs the row after the last one too
+            y = rmap["y"][np.isfinite(rmap["y"])]
+            if y.size > 0:
+                lo = max(int(np.floor(np.min(y))), 0)
+                hi = min(int(np.floor(np.max(y))) + 2, head_in["NAXIS2"])
+                if hi > lo:
+                    rmap["y"] -= lo
+                    out = apply_reprojection_map(self.store.read("aia", slice(lo, hi)), rmap, dtype=self.dtype)
+            self.store.write("aia_hmi", sl, out)
+            return None
+
+        self.map(reproject_tile)
+
+        # from here on the aia image is the one on the hmi pixels
+        os.replace(self.store.path("aia_hmi"), self.store.path("aia"))
+        self.store.arrays["aia"] = self.store.arrays.pop("aia_hmi")
+        return None
+
+    def calc_limb_darkening(self, mu_lim=0.1, num_mu=25, n_sigma=2.0, method="curve_fit"):
+        # sigma-clipped ring profiles of the continuum and the filtergram
+        # in three passes (ring means, standard deviations about the means,
+        # then means of the pixels within n_sigma), as in MuRings.profile
+        assert method in ld_methods
+        mu_edge = np.linspace(1.0, mu_lim, num=num_mu)
+        mu_avgs = (mu_edge[1:] + mu_edge[0:-1]) / 2.0
+        n_rings = num_mu - 1
+        names = ("con", "aia")
+
+        def ring_values(sl):
+            # ring index and value of every pixel in a ring, dropping nans
+            ring = mu_ring_index(self.store.read("mu", sl).ravel(), mu_edge)
+            for n in names:
+                vals = self.store.read(n, sl).ravel()
+                good = (ring < n_rings) & ~np.isnan(vals)
+                yield n, ring[good], vals[good]
+
+        def mean_tile(sl):
+            sums = {}
+            for n, ring, vals in ring_values(sl):
+                sums[n + "_count"] = np.bincount(ring, minlength=n_rings)
+                sums[n + "_sum"] = np.bincount(ring, weights=vals, minlength=n_rings)
+            return sums
+
+        def std_tile(sl):
+            sums = {}
+            for n, ring, vals in ring_values(sl):
+                sums[n] = np.bincount(ring, weights=(vals - prof[n]["mean"][ring])**2, minlength=n_rings)
+            return sums
+
+        def clip_tile(sl):
+            sums = {}
+            for n, ring, vals in ring_values(sl):
+                clip = np.abs(vals - prof[n]["mean"][ring]) >= (n_sigma * prof[n]["std"][ring])
+                sums[n + "_clipped"] = np.bincount(ring[clip], minlength=n_rings)
+                sums[n + "_count"] = np.bincount(ring[~clip], minlength=n_rings)
+                sums[n + "_sum"] = np.bincount(ring[~clip], weights=vals[~clip], minlength=n_rings)
+            return sums
+
+        # empty rings come out as nan, as they do in memory
+        prof = {n: {"mu": mu_avgs} for n in names}
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sums = add_sums(self.map(mean_tile))
+            for n in names:
+                prof[n]["count"] = sums[n + "_count"].astype(float)
+                prof[n]["mean"] = sums[n + "_sum"] / sums[n + "_count"]
+
+            sums = add_sums(self.map(std_tile))
+            for n in names:
+                prof[n]["std"] = np.sqrt(sums[n] / prof[n]["count"])
+
+            sums = add_sums(self.map(clip_tile))
+            for n in names:
+                prof[n]["n_clipped"] = sums[n + "_clipped"].astype(float)
+                prof[n]["clipped_mean"] = sums[n + "_sum"] / sums[n + "_count"]
+
+        # fit the limb darkening law to the profiles
+        for n, content in zip(names, ("CONTINUUM INTENSITY", "FILTERGRAM")):
+            self.ld_profile[n] = prof[n]
+            self.ld_coeffs[n] = fit_ld_profile(prof[n], method=method, p0=ld_guess.get(content))
+        return None
+
+    def correct_dopplergram(self, fit_cbs=False):
+        # spacecraft velocity and the bulk velocity fit, with the normal
+        # equations summed over the tiles (see SDOImage.correct_dopplergram)
+        head = self.heads["dop"]
+        B0 = head["CRLT_OBS"]
+        rsun_solrad = head["DSUN_OBS"]/head["RSUN_REF"]
+        self.v_grav = 633 # m/s, constant
+        for n in ("v_obs", "v_rot", "v_corr"):
+            self.store.create(n, self.shape, self.dtype)
+
+        def fit_tile(sl):
+            geom = {n: self.store.read(n, sl) for n in geometry_names}
+            mask_nan = (geom["mu"] >= 0.1)
+            inds = np.flatnonzero(mask_nan)
+
+            # spacecraft velocity
+            v_obs = np.zeros(mask_nan.shape, dtype=self.dtype)
+            v_obs[mask_nan] = spacecraft_vel(geom["rr"][mask_nan], geom["xx"][mask_nan],
+                                             geom["yy"][mask_nan], rsun_solrad,
+                                             head["OBS_VR"], head["OBS_VW"], head["OBS_VN"])
+            v_obs[~mask_nan] = np.nan
+            self.store.write("v_obs", sl, v_obs)
+            vals = v_obs[mask_nan]
+
+            # this tile's part of the normal equations
+            dat = self.store.read("dop", sl).ravel()[inds] - v_obs.ravel()[inds] - self.v_grav
+            im_fit = bulk_vel_design(geom["lat"], geom["lon"], geom["rr"], B0, inds=inds,
+                                     fit_cbs=fit_cbs, dtype=self.dtype)
+            return {"A": im_fit.dot(im_fit.T), "RHS": im_fit.dot(dat), "n": inds.size,
+                    "v_obs": np.array([np.min(vals) if vals.size else np.inf,
+                                       np.max(vals) if vals.size else -np.inf, np.sum(vals)])}
+
+        def model_tile(sl):
+            geom = {n: self.store.read(n, sl) for n in ("mu", "rr", "lat", "lon")}
+            inds = np.flatnonzero(geom["mu"] >= 0.1)
+            dat = self.store.read("dop", sl).ravel()[inds] - self.store.read("v_obs", sl).ravel()[inds] - self.v_grav
+
+            # fitted components and the corrected velocity
+            model = bulk_vel_model(geom["lat"], geom["lon"], geom["rr"], B0, self.fit_params, inds=inds)
+            v_rot = np.full(geom["mu"].shape, np.nan, dtype=self.dtype)
+            v_rot.ravel()[inds] = model["rot"]
+            v_corr = np.full(geom["mu"].shape, np.nan, dtype=self.dtype)
+            v_corr.ravel()[inds] = dat - (model["rot"] + model["mer"] + model["cbs"])
+            self.store.write("v_rot", sl, v_rot)
+            self.store.write("v_corr", sl, v_corr)
+
+            # min, max, and sum of each component
+            stats = {}
+            for k, v in model.items():
+                stats[k] = np.array([np.min(v) if v.size else np.inf, np.max(v) if v.size else -np.inf, np.sum(v)])
+            return stats
+
+        # solve the normal equations
+        parts = self.map(fit_tile)
+        sums = add_sums([{k: p[k] for k in ("A", "RHS", "n")} for p in parts])
+        self.fit_params = inv_SVD(sums["A"], 1e5).dot(sums["RHS"])
+        self.n_fit = sums["n"]
+
+        # min, max, and mean of the spacecraft velocity (over all of its pixels)
+        v_obs = [p["v_obs"] for p in parts]
+        self.v_obs_stats = (min(v[0] for v in v_obs), max(v[1] for v in v_obs),
+                            sum(v[2] for v in v_obs) / self.n_fit)
+
+        # min, max, and mean of each component
+        parts = self.map(model_tile)
+        self.v_stats = {}
+        for k in ("rot", "mer", "cbs"):
+            self.v_stats[k] = (min(p[k][0] for p in parts), max(p[k][1] for p in parts),
+                               sum(p[k][2] for p in parts) / self.n_fit)
+        return None
+
+    def quiet_weights(self, w_active, mu):
+        # weights for magnetically quiet areas (see calc_weights)
+        w_quiet = ~w_active
+        w_quiet[np.logical_or(mu < self.mu_thresh, np.isnan(mu))] = False
+        return w_quiet
+
+    def calc_sun_mask(self):
+        # region identification as in SunMask, with the thresholds made
+        # from sums over the tiles and the bright regions labeled in every
+        # tile and merged across the seams between tiles
+        self.store.create("w_active", self.shape, bool)
+        self.store.create("regions", self.shape, np.uint8)
+        structure = ndimage.generate_binary_structure(2,2)
+
+        def weights_tile(sl):
+            # the boxcar filter needs a row on either side of the tile
+            halo = slice(max(sl.start - 1, 0), min(sl.stop + 1, self.shape[0]))
+            tile = self.load(halo, "mu", "mag")
+            w_active, w_quiet = calc_weights(tile["mag"], tile["mu"], self.mu_thresh)
+            inner = slice(sl.start - halo.start, sl.stop - halo.start)
+            w_active = w_active[inner]
+            w_quiet = w_quiet[inner]
+            self.store.write("w_active", sl, w_active)
+
+            tile = self.load(sl, "mu", "con_iflat")
+            on_disk = tile["mu"] >= self.mu_thresh
+            return {"npix": np.sum(on_disk), "n_active": np.sum(w_active[on_disk]),
+                    "pix_hem": np.sum(tile["mu"] > 0.0), "n_quiet": np.nansum(w_quiet),
+                    "quiet_int": np.nansum(tile["con_iflat"] * w_quiet)}
+
+        def aia_tile(sl):
+            tile = self.load(sl, "con_iflat", "aia_iflat", "v_corr")
+            ind1, ind2, ind3 = spot_indices(tile["con_iflat"], tile["v_corr"], self.con_thresh1, self.con_thresh2)
+            weights = self.store.read("w_active", sl) & ~(ind1 | ind2 | ind3)
+            return {"aia_int": np.nansum(tile["aia_iflat"] * weights), "n_aia": np.nansum(weights)}
+
+        def classify_tile(sl):
+            tile = self.load(sl, "mu", "con_iflat", "aia_iflat", "v_corr")
+            w_active = self.store.read("w_active", sl)
+            w_quiet = self.quiet_weights(w_active, tile["mu"])
+
+            # get indices for spots, quiet sun and bright regions
+            ind1, ind2, ind3 = spot_indices(tile["con_iflat"], tile["v_corr"], self.con_thresh1, self.con_thresh2)
+            not_spot = ~(ind1 | ind2 | ind3)
+            ind4 = (tile["con_iflat"] > self.con_thresh1) & w_quiet
+            ind5a = (tile["con_iflat"] > self.con_thresh1) & w_active
+            ind5b = (tile["aia_iflat"] > self.aia_thresh) & not_spot
+
+            # set mask indices
+            regions = np.zeros(w_active.shape, dtype=np.uint8)
+            regions[ind1] = 1 # umbrae
+            regions[ind2] = 2 # blueshifted penumbrae
+            regions[ind3] = 3 # redshifted penumbrae
+            regions[ind4] = 4 # quiet sun
+            regions[ind5a | ind5b] = 5 # bright areas (will separate into plage + network)
+            self.store.write("regions", sl, regions)
+
+            # label the bright regions of the tile, keeping the labels on
+            # its first and last rows to merge them with the next tiles
+            labels, nlabels = ndimage.label(regions == 5, structure=structure)
+            return {"nlabels": nlabels, "areas": np.bincount(labels.ravel(), minlength=nlabels+1)[1:],
+                    "first": labels[0], "last": labels[-1]}
+
+        def relabel_tile(args):
+            sl, offset = args
+            regions = self.store.read("regions", sl)
+            mu = self.store.read("mu", sl)
+
+            # the labels of a tile come out the same every time
+            labels, nlabels = ndimage.label(regions == 5, structure=structure)
+            new_regions = new_type[np.where(labels > 0, labels + offset, 0)]
+            np.copyto(regions, new_regions, where=(new_regions > 0))
+
+            # make any remaining unclassified pixels quiet sun, and set
+            # values beyond mu_thresh to no region
+            regions[(mu >= self.mu_thresh) & (regions == 0)] = 4
+            regions[~(mu > self.mu_thresh)] = 0
+            self.store.write("regions", sl, regions)
+            return {"counts": np.bincount(regions.ravel(), minlength=7)}
+
+        # magnetic filling factor and intensity thresholds for HMI
+        sums = add_sums(self.map(weights_tile))
+        npix = sums["npix"]
+        pix_hem = sums["pix_hem"]
+        self.ff = sums["n_active"] / npix
+        quiet_int = sums["quiet_int"] / sums["n_quiet"]
+        self.con_thresh1 = 0.89 * quiet_int
+        self.con_thresh2 = 0.45 * quiet_int
+
+        # intensity threshold for AIA
+        sums = add_sums(self.map(aia_tile))
+        self.aia_thresh = sums["aia_int"] / sums["n_aia"]
+
+        # label the bright regions and merge them across the tiles
+        parts = self.map(classify_tile)
+        offsets, roots = merge_tile_labels(parts)
+        areas = np.concatenate([[0]] + [p["areas"] for p in parts])
+        areas = np.bincount(roots, weights=areas, minlength=roots.size)[roots]
+
+        # new type of every label from the area of the region it is part of
+        new_type = bright_region_types(areas[1:], pix_hem)
+        counts = add_sums(self.map(relabel_tile, tiles=list(zip(self.tiles, offsets[:-1]))))["counts"]
+
+        # get region fracs from the number of pixels of every region type
+        self.umb_frac = counts[1] / npix
+        self.pen_frac = (counts[2] + counts[3]) / npix
+        self.blu_pen_frac = counts[2] / npix
+        self.red_pen_frac = counts[3] / npix
+        self.quiet_frac = counts[4] / npix
+        self.network_frac = counts[5] / npix
+        self.plage_frac = counts[6] / npix
+        return None
+
+    def calc_stats(self, mjd, n_rings=10, n_regions=7):
+        # full-disk and per (annulus, region) rows of the region output in
+        # two passes, as EpochPrecompute, calc_velocities, calc_mag_stats,
+        # calc_int_stats, and calc_region_stats do them in memory (the
+        # photospheric velocity needs the quiet-sun scaling of the first)
+        mu_grid = np.linspace(self.mu_thresh, 1.0, n_rings)
+        nbins = (n_rings - 1) * n_regions
+
+        def ring_labels(tile):
+            # (annulus, region) label of every pixel, see calc_ring_labels
+            rings = calc_ring_index(tile["mu"], mu_grid)
+            valid = (rings >= 0) & (rings < n_rings - 1) & (tile["mu"] >= self.mu_thresh)
+            valid &= (tile["regions"] < n_regions)
+            return rings[valid].astype(np.int64) * n_regions + tile["regions"][valid], valid
+
+        def sums_tile(sl):
+            tile = self.load(sl, "mu", "con", "con_ldark", "con_iflat", "B_obs", "v_corr", "regions")
+            image = tile["con"]
+            on_disk = (tile["mu"] >= self.mu_thresh)
+            w_quiet = (tile["regions"] == 4)
+
+            # full-disk sums
+            sums = {"npix": np.nansum(on_disk), "light": np.nansum(image * on_disk),
+                    "image_sum": np.nansum(image),
+                    "k_num": np.nansum(image * tile["con_ldark"] * w_quiet),
+                    "k_den": np.nansum(tile["con_ldark"]**2 * w_quiet),
+                    "v_hat": np.nansum(tile["v_corr"] * image * on_disk),
+                    "v_quiet": np.nansum(tile["v_corr"] * image * w_quiet * on_disk),
+                    "quiet_light": np.nansum(image * w_quiet * on_disk),
+                    "mag": np.nansum(np.abs(tile["B_obs"]) * image),
+                    "int_flat": np.nansum(tile["con_iflat"])}
+
+            # grouped sums
+            labels, valid = ring_labels(tile)
+            image = image[valid]
+            sums["g_npix"] = np.bincount(labels, minlength=nbins).astype(float)
+            sums["g_light"] = grouped_nansum(labels, image, nbins)
+            sums["g_v_hat"] = grouped_nansum(labels, tile["v_corr"][valid] * image, nbins)
+            sums["g_mag"] = grouped_nansum(labels, np.abs(tile["B_obs"][valid]) * image, nbins)
+            sums["g_int_flat"] = grouped_nansum(labels, tile["con_iflat"][valid], nbins)
+            return sums
+
+        def phot_tile(sl):
+            tile = self.load(sl, "mu", "con", "con_ldark", "v_rot", "regions")
+            on_disk = (tile["mu"] >= self.mu_thresh)
+            w_active = ~(tile["regions"] == 4)
+            v_phot = tile["v_rot"] * (tile["con"] - k_hat_con * tile["con_ldark"])
+
+            labels, valid = ring_labels(tile)
+            return {"v_phot": np.nansum(v_phot * w_active * on_disk),
+                    "g_v_phot": grouped_nansum(labels, v_phot[valid], nbins)}
+
+        # calculate scaling factor for continuum and filtergrams
+        sums = add_sums(self.map(sums_tile))
+        k_hat_con = sums["k_num"] / sums["k_den"]
+        sums.update(add_sums(self.map(phot_tile)))
+
+        # disk-integrated velocities, mag field, and intensity
+        v_hat = sums["v_hat"] / sums["light"]
+        v_phot = sums["v_phot"] / sums["light"]
+        v_quiet = sums["v_quiet"] / sums["quiet_light"]
+        vels = [v_hat, v_phot, v_quiet, v_hat - v_quiet]
+        mags = sums["mag"] / sums["image_sum"]
+        ints = [sums["image_sum"] / 1.0, sums["int_flat"] / 1.0]
+        results = [[mjd, np.nan, np.nan, np.nan, sums["npix"], sums["light"], *vels, mags, *ints]]
+
+        # grouped sums as (annulus, region)
+        stats = {}
+        for key in ("npix", "light", "v_hat", "v_phot", "mag", "int_flat"):
+            stats[key] = sums["g_" + key].reshape(n_rings - 1, n_regions)
+
+        # photospheric velocity is only computed over active pixels
+        stats["v_phot"][:, 4] = 0.0
+        results += calc_region_results(mjd, stats, mu_grid, sums["npix"], sums["light"])
+        return results
+
+    def thresholds(self, mjd):
+        # row of the thresholds table, as process_data_set writes it
+        return [mjd, self.aia_thresh, *self.ld_coeffs["aia"],
+                self.con_thresh1, self.con_thresh2, *self.ld_coeffs["con"],
+                self.v_stats["cbs"][1], *self.v_obs_stats,
+                *self.v_stats["rot"], *self.v_stats["mer"]]
@@ -0,0 +1,82 @@
+import time
+from contextlib import contextmanager
+
+from .sdo_io import ResultSink, timing_columns
+from .sdo_memory import RSSSampler
+
+class StageTimer(object):
+    # wall time, cpu time and peak memory of the stages of one epoch; spans
+    # can be nested, and the peak of a span includes those of its children.
+    # the cpu time is that of the thread running the epoch, so prefetching
+    # and sampling threads do not count (nor do tile threads)
+    def __init__(self, date):
+        self.date = date
+        self.rows = []
+        self.stack = []
+        self.sampler = RSSSampler()
+        return None
+
+    def begin(self, stage):
+        rss = self.sampler.push()
+        self.stack.append({"stage": stage, "wall": time.perf_counter(),
+                           "cpu": time.thread_time(), "rss": rss})
+        return None
+
+    def end(self):
+        span = self.stack.pop()
+        wall = time.perf_counter() - span["wall"]
+        cpu = time.thread_time() - span["cpu"]
+        peak = self.sampler.pop()
+
+        # times in seconds, memory in MB
+        self.rows.append([self.date, span["stage"], round(wall, 4), round(cpu, 4),
+                          round(span["rss"] / 1e6, 1), round((peak - span["rss"]) / 1e6, 1)])
+        return None
+
+    @contextmanager
+    def span(self, stage):
+        self.begin(stage)
+        try:
+            yield self
+        finally:
+            self.end()
+
+    def finish(self):
+        # close any spans left open (e.g. by an early return) and hand
+        # back the rows of the epoch
+        while self.stack:
+            self.end()
+        rows, self.rows = self.rows, []
+        return rows
+
+class TimingSummary(ResultSink):
+    # aggregates the timing rows of a run as they are written
+    def __init__(self):
+        self.stages = {}
+        self.order = []
+        return None
+
+    def write(self, table, rows):
+        if table != "timings":
+            return None
+        for date, stage, wall, cpu, rss, peak in rows:
+            if stage not in self.stages:
+                self.stages[stage] = {"count": 0, "wall": 0.0, "max_wall": 0.0, "cpu": 0.0, "max_peak": 0.0}
+                self.order.append(stage)
+            s = self.stages[stage]
+            s["count"] += 1
+            s["wall"] += wall
+            s["max_wall"] = max(s["max_wall"], wall)
+            s["cpu"] += cpu
+            s["max_peak"] = max(s["max_peak"], peak)
+        return None
+
+    def summary(self):
+        return {stage: self.stages[stage] for stage in self.order}
+
+    def report(self):
+        print(">>> %-16s %6s %10s %10s %10s %12s" % ("stage", "count", "mean [s]", "max [s]", "cpu [s]", "peak [MB]"), flush=True)
+        for stage, s in self.summary().items():
+            print(">>> %-16s %6d %10.3f %10.3f %10.3f %12.1f" %
+                  (stage, s["count"], s["wall"] / s["count"], s["max_wall"], s["cpu"] / s["count"], s["max_peak"]), flush=True)
+        return None
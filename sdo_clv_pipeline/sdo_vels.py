@@ -19,30 +19,62 @@ def calc_region_mask(mask, region=None, hi_mu=None, lo_mu=None):
 
     return region_mask
 
-def calc_velocities(con, mag, dop, aia, mask, region_mask=None, v_quiet=None):
+class EpochPrecompute(object):
+    # quantities that are fixed for an epoch and shared by every region and
+    # mu annulus, so the full-frame work behind them is done only once
+    def __init__(self, con, mask, mu_grid=None, n_regions=7, index_cache=None):
+        # pixels on the disk, and their number and total light
+        self.on_disk = (con.mu >= con.mu_thresh)
+        self.npix = np.nansum(self.on_disk)
+        self.light = np.nansum(con.image * self.on_disk)
+        self.image_sum = np.nansum(con.image)
+
+        # quiet/active weights
+        self.w_quiet = mask.is_quiet_sun()
+        self.w_active = ~self.w_quiet
+
+        # calculate scaling factor for continuum and filtergrams
+        self.k_hat_con = np.nansum(con.image * con.ldark * self.w_quiet) / np.nansum(con.ldark**2 * self.w_quiet)
+
+        # (annulus, region) label of every pixel
+        self.mu_grid = mu_grid
+        self.n_regions = n_regions
+        if mu_grid is not None:
+            self.labels, valid = calc_ring_labels(mask, mu_grid, n_regions=n_regions, index_cache=index_cache)
+            self.valid = np.flatnonzero(valid)
+        return None
+
+    def take(self, arr):
+        # values of arr at the labeled pixels
+        return arr.ravel()[self.valid]
+
+def calc_velocities(con, mag, dop, aia, mask, region_mask=None, v_quiet=None, pre=None):
     # don't bother doing math if there is nothing in the mask
     if (type(region_mask) is np.ndarray) and (~region_mask.any()):
         return 0.0, 0.0, 0.0, 0.0
 
-    # get default region_mask
+    # reuse the per-epoch quantities if we have them
+    if pre is None:
+        pre = EpochPrecompute(con, mask)
+
+    # get default region_mask and its denominator
     if region_mask is None:
-        region_mask = (con.mu >= con.mu_thresh)
+        region_mask = pre.on_disk
+        denom = pre.light
+    else:
+        denom = np.nansum(con.image * region_mask)
 
     # get weights
-    w_quiet = mask.is_quiet_sun()
-    w_active = ~w_quiet
-
-    # calculate scaling factor for continuum and filtergrams
-    k_hat_con = np.nansum(con.image * con.ldark * w_quiet) / np.nansum(con.ldark**2 * w_quiet)
+    w_quiet = pre.w_quiet
+    w_active = pre.w_active
 
     # calculate velocity terms
     v_hat = np.nansum(dop.v_corr * con.image * region_mask)
 
     # TODO add v_mer???
-    v_phot = np.nansum(dop.v_rot * (con.image - k_hat_con * con.ldark) * w_active * region_mask)
+    v_phot = np.nansum(dop.v_rot * (con.image - pre.k_hat_con * con.ldark) * w_active * region_mask)
 
     # divide velocities by the denominator (only calculate it once)
-    denom = np.nansum(con.image * region_mask)
     v_hat /= denom
     v_phot /= denom
 
@@ -60,27 +92,36 @@ def calc_velocities(con, mag, dop, aia, mask, region_mask=None, v_quiet=None):
         return v_hat, v_phot, 0.0, v_conv
     return None
 
-def calc_mag_stats(con, mag, region_mask=True):
+def calc_mag_stats(con, mag, region_mask=True, pre=None):
     # don't bother doing math if there is nothing in the mask
     if (type(region_mask) is np.ndarray) and (~region_mask.any()):
         return 0.0, 0.0, 0.0
 
+    # the whole image can use the per-epoch quantities
+    if (pre is not None) and (region_mask is True):
+        denom = pre.image_sum
+    else:
+        denom = np.nansum(con.image * region_mask)
+
     # get intensity weighted unsigned magnetic field strength
     mag_unsigned = np.nansum(np.abs(mag.B_obs) * con.image * region_mask)
 
     # divide by the denominator
-    mag_unsigned /= np.nansum(con.image * region_mask)
+    mag_unsigned /= denom
 
     return mag_unsigned
 
 
-def calc_int_stats(con, region_mask=True):
+def calc_int_stats(con, region_mask=True, pre=None):
     # don't bother doing math if there is nothing in the mask
     if (type(region_mask) is np.ndarray) and (~region_mask.any()):
         return 0.0, 0.0, 0.0
 
-    # get numerator
-    avg_int = np.nansum(con.image * region_mask)
+    # get numerator, using the per-epoch sum for the whole image
+    if (pre is not None) and (region_mask is True):
+        avg_int = pre.image_sum
+    else:
+        avg_int = np.nansum(con.image * region_mask)
     avg_int_flat = np.nansum(con.iflat * region_mask)
 
     # divide by the denominator
@@ -89,3 +130,139 @@ def calc_int_stats(con, region_mask=True):
     avg_int_flat /= denom
 
     return avg_int, avg_int_flat
+
+def calc_ring_index(mu, mu_grid):
+    # index of the mu annulus of each pixel, i.e., mu_grid[j] < mu <= mu_grid[j+1]
+    return (np.digitize(mu, mu_grid, right=True) - 1).astype(np.int16)
+
+class RingIndexCache(object):
+    # the most recent mu annulus indices (each one holds on to its mu
+    # array), kept by a batch of epochs that share their geometry
+    def __init__(self, maxsize=1):
+        self.maxsize = maxsize
+        self.store = []
+        self.hits = 0
+        self.misses = 0
+        return None
+
+    def get(self, mu, mu_grid):
+        # reused for the very same mu array
+        for ref, grid, rings in self.store:
+            if (ref is mu) and np.array_equal(grid, mu_grid):
+                self.hits += 1
+                return rings
+
+        self.misses += 1
+        rings = calc_ring_index(mu, mu_grid)
+        self.store.insert(0, (mu, np.array(mu_grid), rings))
+        del self.store[self.maxsize:]
+        return rings
+
+    def clear(self):
+        self.store = []
+        return None
+
+def get_ring_index(mu, mu_grid, cache=None):
+    # index of the mu annulus of each pixel, from the cache if there is one
+    if cache is None:
+        return calc_ring_index(mu, mu_grid)
+    return cache.get(mu, mu_grid)
+
+def calc_ring_labels(mask, mu_grid, n_regions=7, index_cache=None):
+    # get index of mu annulus for each pixel
+    n_rings = len(mu_grid) - 1
+    rings = get_ring_index(mask.mu, mu_grid, cache=index_cache)
+    valid = (rings >= 0) & (rings < n_rings) & (mask.mu >= mask.mu_thresh)
+
+    # combine ring index and region code (a uint8 label) into a single label
+    valid &= (mask.regions < n_regions)
+    labels = rings[valid].astype(np.int64) * n_regions + mask.regions[valid]
+    return labels, valid
+
+def grouped_nansum(labels, values, nbins):
+    # equivalent of np.nansum over each label, done in one pass
+    values = np.where(np.isnan(values), 0.0, values)
+    return np.bincount(labels, weights=values, minlength=nbins)
+
+def calc_region_stats(con, mag, dop, mask, mu_grid, n_regions=7, pre=None):
+    # reuse the per-epoch quantities if we have them
+    if (pre is None) or (pre.mu_grid is None) or (not np.array_equal(pre.mu_grid, mu_grid)) or (pre.n_regions != n_regions):
+        pre = EpochPrecompute(con, mask, mu_grid=mu_grid, n_regions=n_regions)
+
+    # get pixel labels for every (annulus, region) combination
+    n_rings = len(mu_grid) - 1
+    nbins = n_rings * n_regions
+    labels = pre.labels
+    k_hat_con = pre.k_hat_con
+
+    # pull out the labeled pixels once
+    image = pre.take(con.image)
+
+    # do all of the grouped sums
+    stats = {}
+    stats["npix"] = np.bincount(labels, minlength=nbins).astype(float)
+    stats["light"] = grouped_nansum(labels, image, nbins)
+    stats["v_hat"] = grouped_nansum(labels, pre.take(dop.v_corr) * image, nbins)
+    stats["v_phot"] = grouped_nansum(labels, pre.take(dop.v_rot) * (image - k_hat_con * pre.take(con.ldark)), nbins)
+    stats["mag"] = grouped_nansum(labels, np.abs(pre.take(mag.B_obs)) * image, nbins)
+    stats["int_flat"] = grouped_nansum(labels, pre.take(con.iflat), nbins)
+
+    # reshape to (annulus, region)
+    for key in stats.keys():
+        stats[key] = stats[key].reshape(n_rings, n_regions)
+
+    # photospheric velocity is only computed over active pixels
+    stats["v_phot"][:, 4] = 0.0
+    return stats
+
+def get_region_sums(stats, ring, region):
+    # get sums for a region in a given annulus, merging penumbrae for 2.5
+    if region == 2.5:
+        return {key: stats[key][ring, 2] + stats[key][ring, 3] for key in stats.keys()}
+    return {key: stats[key][ring, int(region)] for key in stats.keys()}
+
+def calc_region_results(mjd, stats, mu_grid, all_pixels, all_light, regions=(1, 2, 2.5, 3, 4, 5, 6)):
+    # rows of the region output for every mu annulus and region type from
+    # the grouped sums of calc_region_stats
+    results = []
+    for j in range(len(mu_grid)-1):
+        # mu values for annuli
+        lo_mu=mu_grid[j]
+        hi_mu=mu_grid[j+1]
+
+        # compute quiet-sun velocity in mu annulus
+        quiet = get_region_sums(stats, j, 4)
+        v_quiet = quiet["v_hat"] / quiet["light"]
+
+        # loop over unique region identifiers
+        for k in regions:
+            sums = get_region_sums(stats, j, k)
+
+            # get total pix and light
+            pixels = sums["npix"]/all_pixels
+            light = sums["light"]/all_light
+
+            if ((pixels == 0.0) | (light == 0.0)):
+                vels = [0.0, 0.0, 0.0, 0.0]
+                mags = 0.0
+                ints = [0.0, 0.0]
+                results.append([mjd, k, lo_mu, hi_mu, pixels, light, *vels, mags, *ints])
+                continue
+
+            # compute velocity components in each mu annulus by region
+            v_hat = sums["v_hat"] / sums["light"]
+            v_phot = sums["v_phot"] / sums["light"]
+            if k != 4:
+                # case where region is not quiet sun, return zero for v_quiet
+                vels = [v_hat, v_phot, 0.0, v_hat - v_quiet]
+            else:
+                # case where region is quiet sun, return nonzero v_quiet
+                vels = [v_hat, v_phot, v_hat, 0.0]
+
+            # calculate mag and intensity stats
+            mags = sums["mag"] / sums["light"]
+            ints = [sums["light"] / sums["npix"], sums["int_flat"] / sums["npix"]]
+
+            # append the velocity results
+            results.append([mjd, k, lo_mu, hi_mu, pixels, light, *vels, mags, *ints])
+    return results
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from sdo_clv_pipeline.sdo_io import *
+from sdo_clv_pipeline.sdo_process import *
+from sdo_clv_pipeline.sdo_synth import *
+
+@pytest.fixture(scope="module")
+def epochs(tmp_path_factory):
+    # three epochs an hour apart, whose geometry agrees to within tolerance
+    fitsdir = str(tmp_path_factory.mktemp("batch") / "fits") + "/"
+    write_synth_data(fitsdir, n=128, n_epochs=3)
+    return list(zip(*find_data(fitsdir)))
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_batch_reuse(epochs, tmp_path, dtype):
+    # everything derived from the geometry is made once and reused by the
+    # two later epochs, in either precision
+    sink = RecordSink()
+    counts = process_batch(epochs, 0.1, 10, str(tmp_path) + "/", dtype=dtype, sink=sink)
+    assert counts["geometry"] == (2, 1)
+    assert counts["reprojection"] == (2, 1)
+    assert counts["design"] == (2, 1)
+    assert counts["ring_index"] == (2, 1)
+    assert counts["mu_rings"] == (5, 1)
+    assert len([rows for table, rows in sink.writes if table == "thresholds"]) == 3
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from sdo_clv_pipeline.sdo_io import *
+from sdo_clv_pipeline.sdo_process import *
+from sdo_clv_pipeline.sdo_synth import *
+
+# float32 agrees with float64 to within 2 mm/s in the velocities (see the
+# README) and to a relative precision of 1e-6 in everything else
+vel_atol = 2e-3
+rtol = 1e-6
+
+def run_epoch(files, datadir, dtype):
+    sink = RecordSink()
+    process_data_set(*files, datadir=datadir, sink=sink, dtype=dtype)
+    return {table: np.array(rows, dtype=float) for table, rows in sink.writes if table != "timings"}
+
+@pytest.fixture(scope="module")
+def outputs(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp("float32")
+    files = write_synth_epoch(str(tmp / "fits"), n=512)
+    return {dtype: run_epoch(files, str(tmp / "out") + "/", dtype) for dtype in (np.float64, np.float32)}
+
+@pytest.mark.parametrize("table", ["thresholds", "region_output"])
+def test_float32_matches_float64(outputs, table):
+    out64 = outputs[np.float64][table]
+    out32 = outputs[np.float32][table]
+    assert out64.shape == out32.shape
+    assert len(out64) > 0
+
+    for i, name in enumerate(result_columns[table]):
+        if ("vel" in name) or name.startswith("v_"):
+            np.testing.assert_allclose(out32[:, i], out64[:, i], rtol=0, atol=vel_atol, err_msg=name)
+        else:
+            np.testing.assert_allclose(out32[:, i], out64[:, i], rtol=rtol, atol=0, err_msg=name)
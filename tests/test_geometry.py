@@ -0,0 +1,54 @@
+import numpy as np
+import datetime as dt
+import pytest
+
+from sdo_clv_pipeline.sdo_geometry import *
+from sdo_clv_pipeline.sdo_synth import synth_header, synth_observer
+
+# agreement of the fast backend with sunpy (m for xx/yy, deg for lat/lon;
+# lon is least well conditioned at the limb, where it reaches ~4e-7 deg)
+tolerances = {"mu": 1e-10, "rr": 1e-10, "xx": 0.05, "yy": 0.05, "lat": 1e-7, "lon": 1e-6}
+
+def make_header(B0, dsun, crota2, n=256):
+    observer = dict(synth_observer, CRLT_OBS=B0, DSUN_OBS=dsun)
+    head = synth_header("con", n, dt.datetime(2014, 1, 1), observer=observer)
+    head["CROTA2"] = crota2
+    return head
+
+@pytest.mark.parametrize("B0", [-7.25, -3.2, 0.0, 7.2])
+@pytest.mark.parametrize("dsun", [1.47e11, 1.52e11])
+@pytest.mark.parametrize("crota2", [0.0, 0.07, 179.93])
+def test_fast_matches_sunpy(B0, dsun, crota2):
+    head = make_header(B0, dsun, crota2)
+    image = np.zeros((head["NAXIS2"], head["NAXIS1"]))
+    geom1 = calc_geometry_sunpy(image, head)
+    geom2 = calc_geometry_fast(head)
+
+    for name in ("mu", "rr", "xx", "yy", "lat", "lon"):
+        # same pixels off the disk
+        assert np.array_equal(np.isnan(geom1[name]), np.isnan(geom2[name])), name
+        good = ~np.isnan(geom1[name])
+        assert np.max(np.abs(geom1[name][good] - geom2[name][good])) <= tolerances[name], name
+
+    # and the same through the helper
+    diffs = compare_geometry(image, head)
+    assert all(diffs[name] <= tolerances[name] for name in diffs)
+
+def test_rows():
+    # a slice of rows is the same slice of the full geometry
+    head = make_header(-3.2, 1.4712e11, 0.0, n=64)
+    image = np.zeros((64, 64))
+    rows = slice(20, 37)
+    for geom, geom_rows in ((calc_geometry_fast(head), calc_geometry_fast(head, rows=rows)),
+                            (calc_geometry_sunpy(image, head), calc_geometry_sunpy(image, head, rows=rows))):
+        for name in geometry_names:
+            assert np.array_equal(geom[name][rows], geom_rows[name], equal_nan=True)
+
+def test_process_cache_args():
+    # the process-wide cache is kept for the same arguments and made
+    # again for others
+    cache = get_geometry_cache(dtype=np.float32)
+    assert get_geometry_cache(dtype="float32") is cache
+    assert get_geometry_cache(dtype=np.float64) is not cache
+    assert get_geometry_cache(dtype=np.float64).dtype == np.float64
+    assert get_geometry_cache(dtype=np.float64, maxsize=4).maxsize == 4
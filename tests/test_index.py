@@ -0,0 +1,44 @@
+import pytest
+
+from sdo_clv_pipeline import sdo_index
+from sdo_clv_pipeline.sdo_index import *
+from sdo_clv_pipeline.sdo_synth import *
+
+@pytest.fixture(scope="module")
+def fitsdir(tmp_path_factory):
+    fitsdir = str(tmp_path_factory.mktemp("index") / "fits") + "/"
+    write_synth_data(fitsdir, n=64, n_epochs=3)
+    return fitsdir
+
+def test_index_matches_find_data(fitsdir, tmp_path):
+    # headers read on the pool, a few files per commit
+    conn = open_index(str(tmp_path / "index.sqlite"))
+    assert update_index(conn, fitsdir, nthreads=4, batch_size=5) == (12, 0)
+    assert update_index(conn, fitsdir, nthreads=4, batch_size=5) == (0, 0)
+    conn.close()
+    files = find_data_indexed(fitsdir, index_file=str(tmp_path / "index.sqlite"))
+    assert [list(f) for f in files] == [list(f) for f in find_data(fitsdir)]
+
+def test_interrupted_build_keeps_batches(fitsdir, tmp_path, monkeypatch):
+    # the build dies on the ninth header, after two batches of four
+    fname = str(tmp_path / "index.sqlite")
+    read = sdo_index.read_header
+    calls = []
+    def failing_read_header(path):
+        calls.append(path)
+        if len(calls) > 8:
+            raise KeyboardInterrupt
+        return read(path)
+    monkeypatch.setattr(sdo_index, "read_header", failing_read_header)
+
+    conn = open_index(fname)
+    with pytest.raises(KeyboardInterrupt):
+        update_index(conn, fitsdir, nthreads=1, batch_size=4)
+    conn.close()
+    monkeypatch.undo()
+
+    # and the next build only reads the rest
+    conn = open_index(fname)
+    assert conn.execute("SELECT COUNT(*) FROM files").fetchone()[0] == 8
+    assert update_index(conn, fitsdir, nthreads=4, batch_size=4) == (4, 0)
+    conn.close()
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from sdo_clv_pipeline.legendre import *
+
+lmax = 5
+
+# coefficients of P_l(z), lowest power first
+pleg_coeffs = [[1],
+               [0, 1],
+               [-1/2, 0, 3/2],
+               [0, -3/2, 0, 5/2],
+               [3/8, 0, -30/8, 0, 35/8],
+               [0, 15/8, 0, -70/8, 0, 63/8]]
+
+def reference(z):
+    # closed form P_l and P'_l in the normalization of gen_leg_x
+    z = np.asarray(z, dtype=np.float64)
+    leg = np.zeros((lmax+1, z.size))
+    leg_d1 = np.zeros((lmax+1, z.size))
+    for l, c in enumerate(pleg_coeffs):
+        norm = np.sqrt(2*l + 1) / (np.sqrt(2) * (np.sqrt(l*(l+1)) if l > 0 else 1.0))
+        leg[l] = norm * np.polynomial.polynomial.polyval(z, c)
+        leg_d1[l] = norm * np.polynomial.polynomial.polyval(z, np.polynomial.polynomial.polyder(c))
+    return leg, leg_d1
+
+def z_grid():
+    # uniform grid plus points piling up at both poles
+    eps = 10.0**-np.arange(1, 16)
+    return np.concatenate([np.linspace(-1, 1, 101), 1 - eps, -1 + eps])
+
+def test_gen_leg_x_reference():
+    z = z_grid()
+    leg, leg_d1 = gen_leg_x(lmax, z)
+    ref, ref_d1 = reference(z)
+    assert np.allclose(leg, ref, rtol=0, atol=1e-13)
+    assert np.allclose(leg_d1, ref_d1, rtol=0, atol=1e-12)
+
+def test_gen_leg_reference():
+    theta = np.arccos(z_grid())
+    leg, leg_d1 = gen_leg(lmax, theta)
+    ref, ref_d1 = reference(np.cos(theta))
+    assert np.allclose(leg, ref, rtol=0, atol=1e-13)
+    assert np.allclose(leg_d1, -np.sin(theta) * ref_d1, rtol=0, atol=1e-12)
+
+def test_chunks():
+    z = z_grid()
+    leg, leg_d1 = gen_leg_x(lmax, z)
+    for chunk_size in (1, 7, z.size - 1, z.size, 10 * z.size):
+        leg_c, leg_d1_c = gen_leg_x(lmax, z, chunk_size=chunk_size)
+        assert np.array_equal(leg, leg_c)
+        assert np.array_equal(leg_d1, leg_d1_c)
+
+    theta = np.arccos(z)
+    leg, leg_d1 = gen_leg(lmax, theta)
+    leg_c, leg_d1_c = gen_leg(lmax, theta, chunk_size=7)
+    assert np.array_equal(leg, leg_c)
+    assert np.array_equal(leg_d1, leg_d1_c)
+
+def test_float32():
+    z = z_grid()
+    ref, ref_d1 = reference(z)
+    leg, leg_d1 = gen_leg_x(lmax, z, dtype=np.float32, chunk_size=16)
+    assert leg.dtype == np.float32
+    assert leg_d1.dtype == np.float32
+    assert np.allclose(leg, ref, rtol=0, atol=1e-5)
+    assert np.allclose(leg_d1, ref_d1, rtol=0, atol=1e-4)
+
+    theta = np.arccos(z)
+    leg, leg_d1 = gen_leg(lmax, theta, dtype=np.float32)
+    assert leg.dtype == np.float32
+    assert np.allclose(leg, ref, rtol=0, atol=1e-5)
+    assert np.allclose(leg_d1, -np.sin(theta) * ref_d1, rtol=0, atol=1e-4)
+
+def test_pyshtools():
+    # same values as the per-point PlBar_d1 loop this replaced
+    pleg = pytest.importorskip("pyshtools").legendre
+    z = z_grid()
+    leg, leg_d1 = gen_leg_x(lmax, z)
+
+    ell = np.arange(lmax+1)
+    norm = np.sqrt(ell*(ell+1)).reshape(lmax+1, 1)
+    norm[norm == 0] = 1
+    ref = np.zeros((lmax+1, z.size))
+    ref_d1 = np.zeros((lmax+1, z.size))
+    for i, zi in enumerate(z):
+        ref[:, i], ref_d1[:, i] = pleg.PlBar_d1(lmax, zi)
+    assert np.allclose(leg, ref/np.sqrt(2)/norm, rtol=0, atol=1e-13)
+
+    # PlBar_d1 divides by 1 - z**2 for the derivatives, so its round-off
+    # grows as the poles are approached (the closed form tests above pin
+    # down the values there); z = +/-1 itself is special-cased in pyshtools
+    sin2 = 1 - z**2
+    atol = 1e-12 + 1e-13 / np.where(sin2 > 0, sin2, 1.0)
+    assert np.all(np.abs(leg_d1 - ref_d1/np.sqrt(2)/norm) <= atol)
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from scipy.optimize import curve_fit
+from sdo_clv_pipeline.sdo_image import *
+from sdo_clv_pipeline.sdo_synth import *
+
+# the linear solution agrees with curve_fit to within the convergence of
+# curve_fit (relative)
+rtol = 1e-7
+
+@pytest.fixture(scope="module")
+def images(tmp_path_factory):
+    con, mag, dop, aia = write_synth_epoch(str(tmp_path_factory.mktemp("limbdark") / "fits"), n=256)
+    con = SDOImage(con)
+    con.calc_geometry()
+    aia = SDOImage(aia)
+    aia.rescale_to_hmi(con)
+    return {"con": con, "aia": aia}
+
+@pytest.mark.parametrize("name", ["con", "aia"])
+def test_linear_matches_curve_fit(images, name):
+    # curve_fit is the default; fit the rings it was fit to both ways
+    image = images[name]
+    image.calc_limb_darkening()
+    prof = image.ld_profile
+    popt, pcov = curve_fit(quad_darkening, prof["mu"], prof["clipped_mean"], p0=ld_guess.get(image.content))
+    assert np.array_equal(image.ld_coeffs, popt)
+
+    coeffs = fit_quad_darkening(prof["mu"], prof["clipped_mean"])
+    np.testing.assert_allclose(coeffs, popt, rtol=rtol, atol=0)
+
+    # and many profiles at once give the same coefficients
+    coeffs = fit_quad_darkening(prof["mu"], np.stack([prof["clipped_mean"]] * 3))
+    np.testing.assert_allclose(coeffs, np.stack([popt] * 3), rtol=rtol, atol=0)
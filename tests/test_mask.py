@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from scipy import ndimage
+from skimage.measure import regionprops
+from sdo_clv_pipeline.sdo_process import *
+from sdo_clv_pipeline.sdo_synth import *
+
+mu_thresh = 0.1
+
+def float_regions(con, dop, aia, w_active, w_quiet):
+    # region codes as SunMask.identify_regions made them before the uint8
+    # mask, in a float array with nan off the disk
+    regions = np.zeros(np.shape(con.image))
+    con_thresh1 = 0.89 * np.nansum(con.iflat * w_quiet)/np.nansum(w_quiet)
+    con_thresh2 = 0.45 * np.nansum(con.iflat * w_quiet)/np.nansum(w_quiet)
+    ind1 = con.iflat <= con_thresh2
+    indp = (con.iflat <= con_thresh1) & (con.iflat > con_thresh2)
+    ind2 = indp & (dop.v_corr <= 0)
+    ind3 = indp & (dop.v_corr > 0)
+    ind4 = (con.iflat > con_thresh1) & w_quiet
+    weights = w_active * (~ind1) * (~ind2) * (~ind3)
+    aia_thresh = np.nansum(aia.iflat * weights)/np.nansum(weights)
+    ind5a = (con.iflat > con_thresh1) & w_active
+    ind5b = (aia.iflat > aia_thresh) & (~ind1) & (~ind2) & (~ind3)
+    ind5 = ind5a | ind5b
+
+    regions[ind1] = 1
+    regions[ind2] = 2
+    regions[ind3] = 3
+    regions[ind4] = 4
+    regions[ind5] = 5
+
+    structure = ndimage.generate_binary_structure(2,2)
+    labels, nlabels = ndimage.label(regions == 5, structure=structure)
+    areas = np.array([rprop.area for rprop in regionprops(labels)]).astype(float)
+    areas *= (1e6/np.sum(con.mu > 0.0))
+    area_thresh = 20e-6 * np.nansum(con.mu > 0.0)
+    regions[np.concatenate(([False], areas > area_thresh))[labels]] = 6
+    regions[np.concatenate(([False], areas == 1))[labels]] = 4
+    regions[((con.mu >= con.mu_thresh) & (regions == 0))] = 4
+    regions[np.logical_or(con.mu <= con.mu_thresh, np.isnan(con.mu))] = np.nan
+
+    # mask_low_mu
+    regions[np.logical_or(con.mu < mu_thresh, np.isnan(con.mu))] = np.nan
+    return regions
+
+@pytest.fixture(scope="module")
+def epoch(tmp_path_factory):
+    files = write_synth_epoch(str(tmp_path_factory.mktemp("mask") / "fits"), n=256)
+    return reduce_sdo_images(*files, mu_thresh=mu_thresh)
+
+def test_uint8_mask_matches_float_mask(epoch):
+    con, mag, dop, aia, mask = epoch
+    regions = float_regions(con, dop, aia, mask.w_active, mask.w_quiet)
+
+    # the same codes, with 0 where the float mask had nan
+    assert mask.regions.dtype == np.uint8
+    assert np.array_equal(np.isnan(regions), mask.regions == 0)
+    assert np.array_equal(regions[~np.isnan(regions)], mask.regions[~np.isnan(regions)])
+    assert np.all(mask.regions[con.mu >= mu_thresh] > 0)
+
+    # and the same region fractions from the bincount
+    npix = np.nansum(con.mu >= con.mu_thresh)
+    fracs = {"umb_frac": [1], "pen_frac": [2, 3], "blu_pen_frac": [2], "red_pen_frac": [3],
+             "quiet_frac": [4], "network_frac": [5], "plage_frac": [6]}
+    for name, codes in fracs.items():
+        frac = np.nansum(np.isin(regions, codes)) / npix
+        assert getattr(mask, name) == pytest.approx(frac, rel=1e-15, abs=0), name
+    assert mask.umb_frac > 0
+    assert mask.pen_frac > 0
+    assert mask.plage_frac > 0
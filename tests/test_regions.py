@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from sdo_clv_pipeline.sdo_process import *
+from sdo_clv_pipeline.sdo_vels import *
+from sdo_clv_pipeline.sdo_synth import *
+
+mu_thresh = 0.1
+n_rings = 10
+regions = [1, 2, 2.5, 3, 4, 5, 6]
+
+def region_loop(con, mag, dop, aia, mask, mu_grid, all_pixels, all_light):
+    # the region output as it was computed before calc_region_stats, with
+    # a full-frame mask for every mu annulus and region
+    results = []
+    for j in range(n_rings-1):
+        lo_mu = mu_grid[j]
+        hi_mu = mu_grid[j+1]
+        region_mask = calc_region_mask(mask, region=None, hi_mu=hi_mu, lo_mu=lo_mu)
+        v_quiet = np.nansum(dop.v_corr * con.image * mask.is_quiet_sun() * region_mask)
+        v_quiet /= np.nansum(con.image * mask.is_quiet_sun() * region_mask)
+
+        for k in regions:
+            region_mask = calc_region_mask(mask, region=k, hi_mu=hi_mu, lo_mu=lo_mu)
+            pixels = np.nansum(region_mask)/all_pixels
+            light = np.nansum(region_mask * con.image)/all_light
+            if ((pixels == 0.0) | (light == 0.0)):
+                results.append([0.0, k, lo_mu, hi_mu, pixels, light, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0])
+                continue
+
+            if k != 4:
+                vels = calc_velocities(con, mag, dop, aia, mask, region_mask=region_mask, v_quiet=v_quiet)
+            else:
+                vels = calc_velocities(con, mag, dop, aia, mask, region_mask=region_mask, v_quiet=None)
+            mags = calc_mag_stats(con, mag, region_mask=region_mask)
+            ints = calc_int_stats(con, region_mask=region_mask)
+            results.append([0.0, k, lo_mu, hi_mu, pixels, light, *vels, mags, *ints])
+    return results
+
+@pytest.fixture(scope="module")
+def epoch(tmp_path_factory):
+    files = write_synth_epoch(str(tmp_path_factory.mktemp("regions") / "fits"), n=256)
+    return reduce_sdo_images(*files, mu_thresh=mu_thresh)
+
+def test_region_stats_match_loop(epoch):
+    con, mag, dop, aia, mask = epoch
+    mu_grid = np.linspace(mu_thresh, 1.0, n_rings)
+    all_pixels = np.nansum(con.mu >= mu_thresh)
+    all_light = np.nansum(con.image * (con.mu >= mu_thresh))
+
+    old = region_loop(con, mag, dop, aia, mask, mu_grid, all_pixels, all_light)
+    stats = calc_region_stats(con, mag, dop, mask, mu_grid)
+    new = calc_region_results(0.0, stats, mu_grid, all_pixels, all_light)
+    assert len(old) == len(new) == (n_rings - 1) * len(regions)
+
+    # compare row by row, covering the merged penumbra and empty regions
+    for row_old, row_new in zip(old, new):
+        assert np.allclose(np.array(row_new, dtype=float), np.array(row_old, dtype=float), rtol=1e-10, atol=0), row_old[:4]
+    assert any((row[1] == 2.5) and (row[4] > 0) for row in new)
+    assert any(row[4] == 0 for row in new)
@@ -0,0 +1,38 @@
+import numpy as np
+import datetime as dt
+import pytest
+
+from sdo_clv_pipeline.sdo_reproject import *
+from sdo_clv_pipeline.sdo_synth import synth_header, synth_image
+
+# agreement of the cached map with reproject_interp (relative); a float32
+# map holds the input pixel coordinates to ~1e-5 pixels
+tolerances = {np.float64: 1e-12, np.float32: 1e-5}
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+@pytest.mark.parametrize("crota2", [0.0, 0.07])
+def test_cached_map_matches_reproject(dtype, crota2):
+    # an AIA frame onto the HMI grid, as in SDOImage.rescale_to_hmi
+    date = dt.datetime(2014, 1, 1)
+    head_in = synth_header("aia", 128, date)
+    head_out = synth_header("con", 128, date)
+    head_out["CROTA2"] = crota2
+    image = synth_image("aia", head_in, rng=np.random.default_rng(0))
+
+    cache = ReprojectionCache(maxsize=1, dtype=dtype)
+    key = cache.key(head_in, head_out)
+    assert cache.get(key) is None
+    rmap = cache.put(key, calc_reprojection_map(head_in, head_out))
+
+    diffs = compare_reprojection(image, head_in, head_out, rmap=rmap)
+    assert diffs["nan_mismatch"] == 0
+    assert diffs["max_rel"] <= tolerances[dtype]
+
+    # the same headers again are a hit on the same map
+    assert cache.get(cache.key(head_in.copy(), head_out.copy())) is rmap
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_process_cache_args():
+    cache = get_reprojection_cache(dtype=np.float32)
+    assert get_reprojection_cache(dtype="float32") is cache
+    assert get_reprojection_cache(dtype=np.float64).dtype == np.float64
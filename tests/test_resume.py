@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from sdo_clv_pipeline.sdo_io import *
+from sdo_clv_pipeline.sdo_ledger import *
+from sdo_clv_pipeline.sdo_process import *
+from sdo_clv_pipeline.sdo_synth import *
+
+@pytest.fixture()
+def fitsdir(tmp_path):
+    fitsdir = str(tmp_path / "fits") + "/"
+    write_synth_data(fitsdir, n=128, n_epochs=3)
+    return fitsdir
+
+def test_ledger_seeding(fitsdir, tmp_path):
+    datadir = str(tmp_path / "out") + "/"
+    epochs = list(zip(*organize_IO(fitsdir, datadir=datadir)))
+    for files in epochs[:2]:
+        process_data_set(*files, datadir=datadir)
+
+    # the third epoch only got its thresholds row out before a crash
+    sink = RecordSink()
+    process_data_set(*epochs[2], datadir=datadir, sink=sink)
+    write_results_to_file(datadir + "thresholds.csv", *[rows for table, rows in sink.writes if table == "thresholds"])
+
+    # a new ledger is seeded with the epochs found in both tables
+    remaining = organize_IO(fitsdir, datadir=datadir, use_ledger=True)
+    assert remaining[0] == [epochs[2][0]]
+    assert EpochLedger(get_ledger_file(datadir)).summary()["done"][0] == 2
+
+    # an epoch written just before a crash, without its ledger entry, is
+    # picked up from the end of the output
+    process_data_set(*epochs[2], datadir=datadir)
+    remaining = organize_IO(fitsdir, datadir=datadir, use_ledger=True)
+    assert len(remaining[0]) == 0
+    assert EpochLedger(get_ledger_file(datadir)).summary()["done"][0] == 3
+
+def test_unfinished_epoch_dropped(fitsdir, tmp_path):
+    datadir = str(tmp_path / "out") + "/"
+    epochs = list(zip(*organize_IO(fitsdir, datadir=datadir)))
+    for files in epochs[:2]:
+        process_data_set(*files, datadir=datadir)
+    with open(datadir + "region_output.csv", "rb") as f:
+        finished = f.read()
+
+    # the third epoch only got some of its region rows out before a crash
+    sink = RecordSink()
+    process_data_set(*epochs[2], datadir=datadir, sink=sink)
+    rows = [rows for table, rows in sink.writes if table == "region_output"][0]
+    write_results_to_file(datadir + "region_output.csv", rows[:len(rows) // 2])
+
+    # without a ledger the epoch is run again, without its partial rows
+    remaining = organize_IO(fitsdir, datadir=datadir)
+    assert remaining[0] == [epochs[2][0]]
+    with open(datadir + "region_output.csv", "rb") as f:
+        assert f.read() == finished
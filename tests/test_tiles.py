@@ -0,0 +1,84 @@
+import numpy as np
+import datetime as dt
+import pytest
+
+from scipy import ndimage
+from sdo_clv_pipeline.sdo_process import *
+from sdo_clv_pipeline.sdo_tiles import *
+from sdo_clv_pipeline.sdo_synth import *
+
+# agreement of the tiled engine with the in-memory pipeline (relative);
+# the limb darkening coefficients only agree to the convergence of
+# curve_fit
+rtol = 1e-9
+ld_rtol = 1e-7
+ld_columns = ("a_aia", "b_aia", "c_aia", "a_hmi", "b_hmi", "c_hmi")
+
+def tile_labels(binary, rows):
+    # label every tile of rows separately and merge them across the seams,
+    # as TiledEpoch.identify_regions does
+    structure = ndimage.generate_binary_structure(2,2)
+    tiles = gen_tiles(binary.shape, tile_pixels=rows * binary.shape[1])
+    parts, labels = [], []
+    for sl in tiles:
+        lab, nlab = ndimage.label(binary[sl], structure=structure)
+        parts.append({"nlabels": nlab, "first": lab[0], "last": lab[-1]})
+        labels.append(lab)
+    offsets, roots = merge_tile_labels(parts)
+    return np.concatenate([roots[np.where(lab > 0, lab + off, 0)] for lab, off in zip(labels, offsets[:-1])])
+
+def same_partition(labels1, labels2):
+    # the same pixels labeled, and a one-to-one map between the labels
+    if not np.array_equal(labels1 > 0, labels2 > 0):
+        return False
+    pairs = np.unique(np.stack([labels1[labels1 > 0], labels2[labels2 > 0]]), axis=1)
+    return (np.unique(pairs[0]).size == pairs.shape[1]) and (np.unique(pairs[1]).size == pairs.shape[1])
+
+def test_seam_pairs():
+    # straight across the seam and along both diagonals
+    last = np.array([0, 1, 0, 0, 2, 0, 0])
+    first = np.array([3, 0, 0, 0, 0, 4, 5])
+    assert np.array_equal(seam_pairs(last, first), [[1, 3], [2, 4]])
+    assert seam_pairs(np.zeros(5, dtype=int), np.ones(5, dtype=int)).shape == (0, 2)
+
+def test_spot_across_seam():
+    # a disk (and a ring that meets itself only in the next tile) cut by
+    # two seams gets a single label
+    yy, xx = np.mgrid[0:40, 0:40]
+    rr = np.hypot(yy - 20, xx - 12)
+    binary = (rr < 6) | ((np.abs(np.hypot(yy - 20, xx - 30) - 7) < 1.0) & (yy >= 14))
+    labels = tile_labels(binary, rows=10)
+    assert np.unique(labels[rr < 6]).size == 1
+    full, nfull = ndimage.label(binary, structure=ndimage.generate_binary_structure(2,2))
+    assert same_partition(labels, full)
+
+@pytest.mark.parametrize("rows", [1, 3, 16, 64])
+def test_merge_matches_full_labels(rows):
+    rng = np.random.default_rng(rows)
+    binary = rng.random((64, 48)) < 0.4
+    full, nfull = ndimage.label(binary, structure=ndimage.generate_binary_structure(2,2))
+    assert same_partition(tile_labels(binary, rows), full)
+
+def test_tiled_matches_in_memory(tmp_path):
+    files = write_synth_epoch(str(tmp_path / "fits"), n=256)
+
+    # put a seam through the middle of the first spot and its plage
+    head = synth_header("con", 256, dt.datetime(2014, 1, 1))
+    x, y = disk_coords(head)
+    row = int(np.argmin(np.abs(y.ravel() - synth_params["spots"][0][1])))
+
+    out = {}
+    for engine in ("memory", "tiles"):
+        sink = RecordSink()
+        if engine == "memory":
+            process_data_set(*files, datadir=str(tmp_path) + "/", sink=sink)
+        else:
+            process_data_set_tiled(*files, datadir=str(tmp_path) + "/", sink=sink,
+                                   tile_pixels=row * 256, threads=3)
+        out[engine] = {table: np.array(rows, dtype=float) for table, rows in sink.writes if table != "timings"}
+
+    for table in ("thresholds", "region_output"):
+        assert out["tiles"][table].shape == out["memory"][table].shape
+        for i, name in enumerate(result_columns[table]):
+            np.testing.assert_allclose(out["tiles"][table][:, i], out["memory"][table][:, i],
+                                       rtol=ld_rtol if name in ld_columns else rtol, atol=0, err_msg=name)